@@ -8,7 +8,9 @@ import sys
 import time
 import threading
 import warnings
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify
+
+import stats_registry
 
 # Import configuration
 from config import USE_POSTGRESQL
@@ -76,7 +78,7 @@ def home():
         "service": "VPN Bot",
         "status": "running",
         "bot_status": bot_status,
-        "endpoints": ["/health", "/status", "/ping"],
+        "endpoints": ["/health", "/status", "/metrics", "/ping"],
         "uptime": time.time() - bot_status.get("startup_time", time.time()) if bot_status.get("startup_time") else 0
     })
 
@@ -106,6 +108,7 @@ def status():
     return jsonify({
         "service": "VPN Bot",
         "bot_status": bot_status,
+        **get_component_stats(),
         "port": os.environ.get('PORT', '5000'),
         "uptime": time.time() - bot_status.get("startup_time", time.time()) if bot_status.get("startup_time") else 0,
         "environment": {
@@ -115,6 +118,12 @@ def status():
         }
     })
 
+@app.route('/metrics')
+def metrics():
+    """Data-layer query metrics in the Prometheus text format"""
+    from db_metrics import render_prometheus
+    return Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
+
 @app.route('/ping')
 def ping():
     """Simple ping"""
@@ -158,6 +167,18 @@ def test_bot():
             "bot_status": bot_status
         }), 500
 
+def get_component_stats():
+    """Statistics of every component that registered a provider (see stats_registry.py)"""
+    stats = {}
+    try:
+        # Imported for its side effect: the data layer registers its providers on import,
+        # so /status shows them even if the bot failed to start
+        import database  # noqa: F401
+    except Exception as e:
+        stats["db_error"] = str(e)
+    stats.update(stats_registry.collect())
+    return stats
+
 def check_bot_status():
     """Check if bot is still running"""
     global bot_status
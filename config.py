@@ -57,6 +57,98 @@ if USE_POSTGRESQL:
     if os.getenv("DATABASE_URL"):
         POSTGRES_URL = os.getenv("DATABASE_URL")
 
+    # Optional streaming replica for reporting/admin reads (empty: everything runs on the primary)
+    POSTGRES_REPLICA_URL = os.getenv("POSTGRES_REPLICA_URL", "")
+
+# Dual-write mode for switching backends under live traffic (see db_dual.py). Needs both backends
+# configured (USE_POSTGRESQL=true for the PostgreSQL settings above); DB_PRIMARY serves reads.
+# Run migrate_to_postgresql.py --reset-sequences before switching DB_PRIMARY to postgresql
+DB_DUAL_WRITE = os.getenv("DB_DUAL_WRITE", "false").lower() == "true"
+DB_PRIMARY = os.getenv("DB_PRIMARY", "postgresql" if USE_POSTGRESQL else "sqlite").lower()  # "postgresql" or "sqlite"
+DB_SHADOW_READ_RATE = float(os.getenv("DB_SHADOW_READ_RATE", "0"))  # fraction of reads repeated on the shadow and compared
+DB_CONSISTENCY_CHECK_INTERVAL = int(os.getenv("DB_CONSISTENCY_CHECK_INTERVAL", "300"))  # seconds between checker runs
+DB_CONSISTENCY_CHECK_BATCH = int(os.getenv("DB_CONSISTENCY_CHECK_BATCH", "1000"))  # rows per table compared per run
+
+# Connection pool settings (PostgreSQL pool size; lifetime/health checks apply to both backends)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # seconds to wait for a free connection
+DB_POOL_MAX_LIFETIME = int(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))  # recycle connections older than this (seconds)
+DB_POOL_HEALTH_CHECK_INTERVAL = int(os.getenv("DB_POOL_HEALTH_CHECK_INTERVAL", "30"))  # ping connections idle longer than this (seconds)
+# Read replica routing (PostgreSQL, only with POSTGRES_REPLICA_URL set)
+DB_REPLICA_POOL_MAX_SIZE = int(os.getenv("DB_REPLICA_POOL_MAX_SIZE", str(DB_POOL_MAX_SIZE)))
+DB_REPLICA_MAX_LAG_SECONDS = float(os.getenv("DB_REPLICA_MAX_LAG_SECONDS", "5"))  # read_only queries fall back to the primary beyond this
+DB_REPLICA_LAG_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_LAG_CHECK_INTERVAL", "5"))  # seconds between replica lag probes
+DB_REPLICA_RETRY_AFTER = float(os.getenv("DB_REPLICA_RETRY_AFTER", "30"))  # seconds to avoid the replica after a failure
+# Per-query latency metrics (see db_metrics.py)
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "200"))  # log data-layer calls slower than this (0 = off)
+DB_SLOW_QUERY_LOG_SIZE = int(os.getenv("DB_SLOW_QUERY_LOG_SIZE", "50"))  # latest slow queries kept for /status
+# Worker threads that run database calls for async handlers (keep <= DB_POOL_MAX_SIZE)
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(DB_POOL_MAX_SIZE)))
+
+# SQLite performance profile (applied to every pooled SQLite connection)
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")  # WAL lets the scheduler read while handlers write
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")  # NORMAL is durable enough in WAL mode
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))  # bytes
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-65536"))  # negative = KiB, i.e. 64 MB page cache
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# How often to refresh planner statistics (ANALYZE / PRAGMA optimize), in seconds
+DB_MAINTENANCE_INTERVAL = int(os.getenv("DB_MAINTENANCE_INTERVAL", str(6 * 60 * 60)))
+
+# Expiry sweeps run when the in-memory expiry timeline says a subscription is due (see expiry_timeline.py);
+# each sweep only loads subscriptions with end_date in [now - EXPIRY_LOOKBACK_HOURS, now]
+EXPIRY_RECONCILE_INTERVAL = int(os.getenv("EXPIRY_RECONCILE_INTERVAL", "900"))  # seconds between full timeline reloads (+ safety sweep)
+RENEWAL_REMINDER_INTERVAL = int(os.getenv("RENEWAL_REMINDER_INTERVAL", "300"))  # seconds between renewal reminder claims
+EXPIRY_NOTIFY_CONCURRENCY = int(os.getenv("EXPIRY_NOTIFY_CONCURRENCY", "25"))  # notices in flight at once (Telegram allows ~30 msg/s)
+EXPIRY_LOOKBACK_HOURS = int(os.getenv("EXPIRY_LOOKBACK_HOURS", "168"))  # still-active subs expired up to a week ago (e.g. missed during downtime)
+RENEWAL_REMINDER_DAYS = int(os.getenv("RENEWAL_REMINDER_DAYS", "3"))  # send the first renewal reminder this many days before expiry
+# Renewal reminder stages, hours before expiry (one reminder per stage, recorded in subscriptions.reminder_stage)
+RENEWAL_REMINDER_STAGES_HOURS = tuple(sorted(
+    {float(hours) for hours in os.getenv("RENEWAL_REMINDER_STAGES_HOURS", f"{RENEWAL_REMINDER_DAYS * 24},24,1").split(",")},
+    reverse=True
+))
+EXPIRY_FETCH_BATCH_SIZE = int(os.getenv("EXPIRY_FETCH_BATCH_SIZE", "500"))  # rows fetched per round trip while streaming the window
+
+# Read-through caches for per-user subscription lookups (see db_cache.py)
+DB_CACHE_TTL_SECONDS = float(os.getenv("DB_CACHE_TTL_SECONDS", "60"))  # upper bound on staleness for writes from other processes
+DB_CACHE_MAX_ENTRIES = int(os.getenv("DB_CACHE_MAX_ENTRIES", "10000"))  # per cache; least recently used entries are evicted
+# Known-user set that lets repeat /start skip the users table (Bloom filter + LRU of profiles)
+KNOWN_USERS_EXPECTED = int(os.getenv("KNOWN_USERS_EXPECTED", "200000"))  # Bloom filter sizing
+KNOWN_USERS_FALSE_POSITIVE_RATE = float(os.getenv("KNOWN_USERS_FALSE_POSITIVE_RATE", "0.01"))
+KNOWN_USERS_LRU_SIZE = int(os.getenv("KNOWN_USERS_LRU_SIZE", "50000"))
+USER_PROFILE_FLUSH_INTERVAL = int(os.getenv("USER_PROFILE_FLUSH_INTERVAL", "60"))  # seconds between batched profile upserts
+
+# Archival of finished subscriptions into subscriptions_archive / subscription_countries_archive
+PENDING_PAYMENT_RETENTION_DAYS = int(os.getenv("PENDING_PAYMENT_RETENTION_DAYS", "2"))  # abandoned checkouts
+SUBSCRIPTION_RETENTION_DAYS = int(os.getenv("SUBSCRIPTION_RETENTION_DAYS", "90"))  # expired/cancelled, counted from end_date
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))  # subscriptions moved per transaction
+ARCHIVE_MAX_BATCHES = int(os.getenv("ARCHIVE_MAX_BATCHES", "200"))  # per run; the rest waits for the next run
+SUBSCRIPTION_ARCHIVE_INTERVAL = int(os.getenv("SUBSCRIPTION_ARCHIVE_INTERVAL", str(24 * 60 * 60)))  # seconds
+# Key revocation queue: Outline keys of an expired subscription are deleted after a grace period
+KEY_REVOCATION_GRACE_MINUTES = int(os.getenv("KEY_REVOCATION_GRACE_MINUTES", "5"))  # time left to renew after the notice
+KEY_REVOCATION_INTERVAL = int(os.getenv("KEY_REVOCATION_INTERVAL", "30"))  # seconds between queue runs
+KEY_REVOCATION_BATCH_SIZE = int(os.getenv("KEY_REVOCATION_BATCH_SIZE", "100"))  # revocations fetched per query
+KEY_REVOCATION_MAX_BATCHES = int(os.getenv("KEY_REVOCATION_MAX_BATCHES", "20"))  # per run; the rest waits for the next run
+KEY_REVOCATION_MAX_ATTEMPTS = int(os.getenv("KEY_REVOCATION_MAX_ATTEMPTS", "5"))  # then the subscription is expired anyway
+KEY_REVOCATION_RETRY_SECONDS = int(os.getenv("KEY_REVOCATION_RETRY_SECONDS", "60"))  # doubled after every failed attempt
+# Only the process holding the scheduler lease runs the periodic jobs (see leader_lease.py)
+SCHEDULER_LEADER_ELECTION = os.getenv("SCHEDULER_LEADER_ELECTION", "true").lower() == "true"
+SCHEDULER_LEASE_TTL = int(os.getenv("SCHEDULER_LEASE_TTL", "30"))  # seconds a SQLite lease outlives its last renewal
+SCHEDULER_LEASE_INTERVAL = int(os.getenv("SCHEDULER_LEASE_INTERVAL", "10"))  # seconds between renewals / takeover attempts
+# Outline API calls run on their own threads, capped per server (see outline_async.py and key_revocation.py)
+OUTLINE_EXECUTOR_WORKERS = int(os.getenv("OUTLINE_EXECUTOR_WORKERS", "16"))  # Outline API threads shared by all servers
+OUTLINE_MAX_CONCURRENCY_PER_SERVER = int(os.getenv("OUTLINE_MAX_CONCURRENCY_PER_SERVER", "4"))  # Outline API calls in flight per server
+KEY_PROVISION_ATTEMPTS = int(os.getenv("KEY_PROVISION_ATTEMPTS", "2"))  # rounds of key creation before a package is rolled back
+# Pre-created keys per country that activation claims instead of creating them after payment
+KEY_POOL_LOW_WATER = int(os.getenv("KEY_POOL_LOW_WATER", "3"))  # refill a country's pool below this many keys; 0 disables the pool
+KEY_POOL_TARGET = max(KEY_POOL_LOW_WATER, int(os.getenv("KEY_POOL_TARGET", "10")))  # ... back up to this many
+KEY_POOL_REFILL_BATCH = int(os.getenv("KEY_POOL_REFILL_BATCH", "10"))  # keys created per country per refill run
+KEY_POOL_REFILL_INTERVAL = int(os.getenv("KEY_POOL_REFILL_INTERVAL", "60"))  # seconds
+if KEY_POOL_REFILL_BATCH < 1:
+    raise ValueError(f"KEY_POOL_REFILL_BATCH must be at least 1, got {KEY_POOL_REFILL_BATCH}")
+KEY_DELETE_RETRIES = int(os.getenv("KEY_DELETE_RETRIES", "2"))  # immediate retries of a failed delete within a batch
+KEY_DELETE_RETRY_DELAY = float(os.getenv("KEY_DELETE_RETRY_DELAY", "0.5"))  # seconds, doubled after every retry
+
 # Duration Plans (separate from country selection)
 DURATION_PLANS = {
     "1_month": {
@@ -143,6 +235,13 @@ COMMAND_RATE_LIMIT = {"default": 3, "subscribe": 10} # seconds per command, defa
 CALLBACK_RATE_LIMIT = 2 # seconds between callback queries from the same user
 MESSAGE_RATE_LIMIT = 1 # seconds between general messages (less critical but can be useful)
 
+# Outbound Telegram message scheduler (see message_scheduler.py)
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))  # messages per second across all chats
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))  # messages per second to one chat
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))  # short bursts allowed per chat (e.g. a reply plus a menu)
+TELEGRAM_QUEUE_MAX_PER_LANE = int(os.getenv("TELEGRAM_QUEUE_MAX_PER_LANE", "10000"))  # senders wait beyond this
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))  # RetryAfter retries per message
+
 VLESS_SERVERS = {
     "server1": {
         "name": "VLESS Server 1",
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""
+Shared pytest fixtures for the data-layer tests.
+"""
+
+import pytest
+
+from db_cache import KnownUserSet
+from db_pool import SQLiteConnectionProvider
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """database.py on the SQLite backend, pointed at a fresh database file for one test."""
+    import database
+
+    pool = SQLiteConnectionProvider(str(tmp_path / "test.db"), on_connect=database.configure_sqlite_connection)
+    monkeypatch.setattr(database, "sqlite_pool", pool)
+    monkeypatch.setattr(database, "USE_POSTGRESQL", False)
+    monkeypatch.setattr(database, "PRIMARY_BACKEND", "sqlite")
+    monkeypatch.setattr(database, "SHADOW_BACKEND", None)
+    monkeypatch.setattr(database, "dual_write", None)
+    monkeypatch.setattr(database, "known_users", KnownUserSet("known_users", 1000, 0.01, 100))
+    monkeypatch.setattr(database, "_schema_ready", False)
+    database.active_subscriptions_cache.clear()
+    database.subscription_countries_cache.clear()
+    database.init_db()
+    yield database
+    pool.close_all()
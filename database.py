@@ -1,6 +1,26 @@
-import sqlite3
 import datetime
-from config import DB_PATH, USE_POSTGRESQL
+import json
+import threading
+from config import (
+    DB_PATH, USE_POSTGRESQL, DB_POOL_MAX_LIFETIME, DB_POOL_HEALTH_CHECK_INTERVAL,
+    SQLITE_JOURNAL_MODE, SQLITE_SYNCHRONOUS, SQLITE_MMAP_SIZE, SQLITE_CACHE_SIZE, SQLITE_BUSY_TIMEOUT_MS,
+    EXPIRY_FETCH_BATCH_SIZE, DB_CACHE_TTL_SECONDS, DB_CACHE_MAX_ENTRIES, KNOWN_USERS_EXPECTED,
+    KNOWN_USERS_FALSE_POSITIVE_RATE, KNOWN_USERS_LRU_SIZE, PENDING_PAYMENT_RETENTION_DAYS,
+    SUBSCRIPTION_RETENTION_DAYS, ARCHIVE_BATCH_SIZE, ARCHIVE_MAX_BATCHES, DB_DUAL_WRITE, DB_PRIMARY,
+    DB_SHADOW_READ_RATE, DB_CONSISTENCY_CHECK_BATCH
+)
+from db_pool import SQLiteConnectionProvider
+from db_migrations import apply_migrations
+from db_rows import (
+    ActiveSubscription, AdminSubscription, ArchivedSubscription, ExpiringSubscription, KeyRevocation,
+    RenewalReminder, SubscriptionKey, SubscriptionSnapshot, group_subscription_rows, iter_cursor, keyset_page,
+    to_datetime
+)
+from db_cache import TTLCache, KnownUserSet
+from db_dual import ConsistencyChecker, DualWriteMonitor
+import stats_registry
+from db_metrics import instrument, timed_query
+from leader_lease import AdvisoryLockLease, SQLiteLease
 
 # Import PostgreSQL functions if PostgreSQL is enabled
 postgresql_functions = {}
@@ -8,406 +28,1148 @@ if USE_POSTGRESQL:
     try:
         from database_postgresql import (
             init_db as init_postgresql_db,
-            add_user_if_not_exists as add_user_if_not_exists_postgresql,
+            upsert_users as upsert_users_postgresql,
+            iter_user_profiles as iter_user_profiles_postgresql,
             create_subscription_record as create_subscription_record_postgresql,
             update_subscription_country_package as update_subscription_country_package_postgresql,
             add_subscription_country as add_subscription_country_postgresql,
             activate_subscription as activate_subscription_postgresql,
+            provision_subscription as provision_subscription_postgresql,
             get_active_subscriptions as get_active_subscriptions_postgresql,
             get_subscription_countries as get_subscription_countries_postgresql,
             get_expired_soon_or_active_subscriptions as get_expired_soon_or_active_subscriptions_postgresql,
+            iter_subscriptions_in_expiry_window as iter_subscriptions_in_expiry_window_postgresql,
+            iter_active_subscription_end_dates as iter_active_subscription_end_dates_postgresql,
             mark_subscription_expired as mark_subscription_expired_postgresql,
+            claim_renewal_reminders as claim_renewal_reminders_postgresql,
+            mark_renewal_reminders as mark_renewal_reminders_postgresql,
+            release_renewal_reminder as release_renewal_reminder_postgresql,
             get_all_active_subscriptions_for_admin as get_all_active_subscriptions_for_admin_postgresql,
+            get_admin_subscriptions_page as get_admin_subscriptions_page_postgresql,
+            count_admin_subscriptions as count_admin_subscriptions_postgresql,
             get_subscription_by_id as get_subscription_by_id_postgresql,
             get_subscription_for_admin as get_subscription_for_admin_postgresql,
             cancel_subscription_by_admin as cancel_subscription_by_admin_postgresql,
-            renew_subscription
+            renew_subscription,
+            archive_subscriptions_batch as archive_subscriptions_batch_postgresql,
+            get_archived_subscriptions as get_archived_subscriptions_postgresql,
+            enqueue_key_revocation as enqueue_key_revocation_postgresql,
+            enqueue_overdue_key_revocations as enqueue_overdue_key_revocations_postgresql,
+            get_due_key_revocations as get_due_key_revocations_postgresql,
+            drop_renewed_key_revocations as drop_renewed_key_revocations_postgresql,
+            reschedule_key_revocation as reschedule_key_revocation_postgresql,
+            complete_key_revocations as complete_key_revocations_postgresql,
+            count_key_revocations as count_key_revocations_postgresql,
+            add_dead_letter_keys as add_dead_letter_keys_postgresql,
+            count_dead_letter_keys as count_dead_letter_keys_postgresql,
+            add_pooled_keys as add_pooled_keys_postgresql,
+            claim_pooled_keys as claim_pooled_keys_postgresql,
+            remove_pooled_keys as remove_pooled_keys_postgresql,
+            count_pooled_keys as count_pooled_keys_postgresql,
+            discard_stale_pooled_keys as discard_stale_pooled_keys_postgresql,
+            get_users_after as get_users_after_postgresql,
+            get_subscription_snapshots_after as get_subscription_snapshots_after_postgresql,
+            get_pool_stats as get_pool_stats_postgresql,
+            open_session_connection,
+            set_session as set_postgresql_session
         )
         postgresql_functions = {
             'init_db': init_postgresql_db,
-            'add_user_if_not_exists': add_user_if_not_exists_postgresql,
+            'upsert_users': upsert_users_postgresql,
+            'iter_user_profiles': iter_user_profiles_postgresql,
             'create_subscription_record': create_subscription_record_postgresql,
             'update_subscription_country_package': update_subscription_country_package_postgresql,
             'add_subscription_country': add_subscription_country_postgresql,
             'activate_subscription': activate_subscription_postgresql,
+            'provision_subscription': provision_subscription_postgresql,
             'get_active_subscriptions': get_active_subscriptions_postgresql,
             'get_subscription_countries': get_subscription_countries_postgresql,
             'get_expired_soon_or_active_subscriptions': get_expired_soon_or_active_subscriptions_postgresql,
+            'iter_subscriptions_in_expiry_window': iter_subscriptions_in_expiry_window_postgresql,
+            'iter_active_subscription_end_dates': iter_active_subscription_end_dates_postgresql,
             'mark_subscription_expired': mark_subscription_expired_postgresql,
+            'claim_renewal_reminders': claim_renewal_reminders_postgresql,
+            'mark_renewal_reminders': mark_renewal_reminders_postgresql,
+            'release_renewal_reminder': release_renewal_reminder_postgresql,
             'get_all_active_subscriptions_for_admin': get_all_active_subscriptions_for_admin_postgresql,
+            'get_admin_subscriptions_page': get_admin_subscriptions_page_postgresql,
+            'count_admin_subscriptions': count_admin_subscriptions_postgresql,
             'get_subscription_by_id': get_subscription_by_id_postgresql,
             'get_subscription_for_admin': get_subscription_for_admin_postgresql,
             'cancel_subscription_by_admin': cancel_subscription_by_admin_postgresql,
-            'renew_subscription': renew_subscription
+            'renew_subscription': renew_subscription,
+            'archive_subscriptions_batch': archive_subscriptions_batch_postgresql,
+            'get_archived_subscriptions': get_archived_subscriptions_postgresql,
+            'enqueue_key_revocation': enqueue_key_revocation_postgresql,
+            'enqueue_overdue_key_revocations': enqueue_overdue_key_revocations_postgresql,
+            'get_due_key_revocations': get_due_key_revocations_postgresql,
+            'drop_renewed_key_revocations': drop_renewed_key_revocations_postgresql,
+            'reschedule_key_revocation': reschedule_key_revocation_postgresql,
+            'complete_key_revocations': complete_key_revocations_postgresql,
+            'count_key_revocations': count_key_revocations_postgresql,
+            'add_dead_letter_keys': add_dead_letter_keys_postgresql,
+            'count_dead_letter_keys': count_dead_letter_keys_postgresql,
+            'add_pooled_keys': add_pooled_keys_postgresql,
+            'claim_pooled_keys': claim_pooled_keys_postgresql,
+            'remove_pooled_keys': remove_pooled_keys_postgresql,
+            'count_pooled_keys': count_pooled_keys_postgresql,
+            'discard_stale_pooled_keys': discard_stale_pooled_keys_postgresql,
+            'get_users_after': get_users_after_postgresql,
+            'get_subscription_snapshots_after': get_subscription_snapshots_after_postgresql,
+            'get_pool_stats': get_pool_stats_postgresql
         }
     except ImportError as e:
         print(f"Warning: PostgreSQL module not found ({e}), falling back to SQLite")
         USE_POSTGRESQL = False
 
-def init_db():
-    """Initialize database based on configuration."""
-    if USE_POSTGRESQL and postgresql_functions:
-        return postgresql_functions['init_db']()
+# Backend routing. Normally every call goes to the one configured backend. In dual-write
+# mode both are live: DB_PRIMARY serves reads and takes writes first, and every write is
+# replayed on the other backend (the shadow), see db_dual.py.
+DUAL_WRITE = DB_DUAL_WRITE and bool(postgresql_functions)
+if DB_DUAL_WRITE and not DUAL_WRITE:
+    print("Warning: DB_DUAL_WRITE needs the PostgreSQL backend (USE_POSTGRESQL=true); dual-write disabled")
+if DUAL_WRITE:
+    if DB_PRIMARY not in ("postgresql", "sqlite"):
+        raise ValueError(f"DB_PRIMARY must be 'postgresql' or 'sqlite', got {DB_PRIMARY!r}")
+    PRIMARY_BACKEND = DB_PRIMARY
+    SHADOW_BACKEND = "sqlite" if DB_PRIMARY == "postgresql" else "postgresql"
+    dual_write = DualWriteMonitor(PRIMARY_BACKEND, SHADOW_BACKEND, DB_SHADOW_READ_RATE)
+    print(f"Dual-write mode: primary={PRIMARY_BACKEND}, shadow={SHADOW_BACKEND}")
+else:
+    PRIMARY_BACKEND = "postgresql" if USE_POSTGRESQL and postgresql_functions else "sqlite"
+    SHADOW_BACKEND = None
+    dual_write = None
+USES_SQLITE = "sqlite" in (PRIMARY_BACKEND, SHADOW_BACKEND)
+
+_instrumented = {}
+
+def _backend_function(backend, name):
+    """The implementation of data-layer call `name` on `backend` ("postgresql" or "sqlite"), timed by db_metrics."""
+    func = _instrumented.get((backend, name))
+    if func is None:
+        impl = postgresql_functions[name] if backend == "postgresql" else globals()[f"{name}_sqlite"]
+        func = _instrumented[(backend, name)] = instrument(name, backend, impl)
+    return func
+
+def _read(name, *args):
+    """Run a read on the primary backend (sampled reads are compared against the shadow)."""
+    result = _backend_function(PRIMARY_BACKEND, name)(*args)
+    if dual_write:
+        dual_write.shadow_read(name, result, _backend_function(SHADOW_BACKEND, name), *args)
+    return result
+
+def _write(name, *args):
+    """Run a write on the primary backend, then replay it on the shadow in dual-write mode."""
+    result = _backend_function(PRIMARY_BACKEND, name)(*args)
+    _replay(name, *args)
+    return result
+
+def _replay(name, *args):
+    """Apply a write to the shadow backend only (dual-write mode).
+
+    Writes that choose their own rows (claims, due batches) must not be
+    replayed as they are: the shadow could choose different rows. They run
+    on the primary alone and replay what the primary chose through this.
+    """
+    if dual_write:
+        dual_write.replay_write(name, _backend_function(SHADOW_BACKEND, name), *args)
+
+# Called with (subscription_id, end_date) after a write in this process changes when an active
+# subscription ends; end_date is None once it is no longer active (see expiry_timeline.py)
+_end_date_listeners = []
+
+def add_end_date_listener(listener):
+    """Register a callback for subscription end-date changes (it runs on the writing thread)."""
+    _end_date_listeners.append(listener)
+
+def _notify_end_date(subscription_id, end_date):
+    for listener in _end_date_listeners:
+        try:
+            listener(subscription_id, end_date)
+        except Exception as e:
+            print(f"Warning: end date listener failed for subscription {subscription_id}: {e}")
+
+def configure_sqlite_connection(conn):
+    """Apply the SQLite performance profile to a freshly opened connection."""
+    conn.execute(f"PRAGMA busy_timeout = {int(SQLITE_BUSY_TIMEOUT_MS)}")
+    conn.execute(f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+    conn.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA mmap_size = {int(SQLITE_MMAP_SIZE)}")
+    conn.execute(f"PRAGMA cache_size = {int(SQLITE_CACHE_SIZE)}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+
+# Read-through caches (invalidated by the writes below) and the known-user set behind add_user_if_not_exists
+active_subscriptions_cache = TTLCache("active_subscriptions", DB_CACHE_TTL_SECONDS, DB_CACHE_MAX_ENTRIES)  # by user_id
+subscription_countries_cache = TTLCache("subscription_countries", DB_CACHE_TTL_SECONDS, DB_CACHE_MAX_ENTRIES)  # by subscription id
+known_users = KnownUserSet("known_users", KNOWN_USERS_EXPECTED, KNOWN_USERS_FALSE_POSITIVE_RATE, KNOWN_USERS_LRU_SIZE)
+
+# One persistent SQLite connection per thread, recycled after DB_POOL_MAX_LIFETIME seconds
+sqlite_pool = SQLiteConnectionProvider(
+    DB_PATH,
+    max_lifetime=DB_POOL_MAX_LIFETIME,
+    health_check_interval=DB_POOL_HEALTH_CHECK_INTERVAL,
+    on_connect=configure_sqlite_connection,
+)
+
+def get_sqlite_connection(immediate=False):
+    """Borrow this thread's SQLite connection. Use as a context manager; commits on success.
+
+    Pass `immediate=True` for read-then-write transactions that must hold the write lock from the start.
+    """
+    return sqlite_pool.connection(immediate=immediate)
+
+def create_scheduler_lease(name, holder, ttl):
+    """The lease electing the process that runs the periodic jobs, on the primary backend (see leader_lease.py)."""
+    if PRIMARY_BACKEND == "postgresql":
+        return AdvisoryLockLease(open_session_connection, name)
+    return SQLiteLease(get_sqlite_connection, name, holder, ttl)
+
+def set_db_session(key):
+    """Tag this context's queries with a session (e.g. the Telegram user id) so its reads see its own writes on a replica."""
+    if PRIMARY_BACKEND == "postgresql":
+        set_postgresql_session(key)
+
+def get_pool_stats():
+    """Return connection pool usage and wait statistics for the primary backend."""
+    if PRIMARY_BACKEND == "postgresql":
+        return postgresql_functions['get_pool_stats']()
     else:
-        return init_sqlite_db()
+        return sqlite_pool.stats()
+
+stats_registry.register("db_pool", get_pool_stats)
+
+# Schema migrations run once per process; later init calls are in-memory no-ops
+_schema_lock = threading.Lock()
+_schema_ready = False
+_vless_schema_ready = False
+
+def init_db():
+    """Bring the database schema up to date (versioned migrations, see db_migrations.py)."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        if "postgresql" in (PRIMARY_BACKEND, SHADOW_BACKEND):
+            postgresql_functions['init_db']()
+        if USES_SQLITE:
+            init_sqlite_db()
+        _schema_ready = True
 
 def init_sqlite_db():
     """Initialize SQLite database."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    # Users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    # Subscriptions table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS subscriptions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            duration_plan_id TEXT,
-            country_package_id TEXT,
-            start_date TIMESTAMP,
-            end_date TIMESTAMP,
-            status TEXT DEFAULT 'pending_payment', -- pending_payment, active, expired, cancelled
-            payment_id TEXT, -- For tracking payments with gateways
-            FOREIGN KEY(user_id) REFERENCES users(user_id)
-        )
-    ''')
-    
-    # Subscription countries table - links subscriptions to countries and their VPN keys
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS subscription_countries (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            subscription_id INTEGER,
-            country_code TEXT, -- e.g., 'germany', 'france'
-            outline_key_id TEXT,
-            outline_access_url TEXT,
-            FOREIGN KEY(subscription_id) REFERENCES subscriptions(id) ON DELETE CASCADE
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    with get_sqlite_connection() as conn:
+        applied = apply_migrations(conn, "core", "sqlite")
+    print(f"SQLite database initialized (applied migrations: {applied or 'none'}).")
 
 def init_vless_db():
-    """Initialize VLESS subscriptions table."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS vless_subscriptions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            vless_uuid TEXT,
-            vless_uri TEXT,
-            start_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            end_date TIMESTAMP,
-            status TEXT DEFAULT 'active',
-            FOREIGN KEY(user_id) REFERENCES users(user_id)
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    """Initialize the VLESS subscriptions table in the SQLite database (only the first call does any work)."""
+    global _vless_schema_ready
+    if _vless_schema_ready:
+        return
+    with _schema_lock:
+        if _vless_schema_ready:
+            return
+        with get_sqlite_connection() as conn:
+            apply_migrations(conn, "vless", "sqlite")
+        _vless_schema_ready = True
+
+def run_db_maintenance():
+    """Refresh query planner statistics (SQLite: ANALYZE / PRAGMA optimize plus a WAL checkpoint)."""
+    # PostgreSQL keeps its statistics fresh through autovacuum/autoanalyze
+    if USES_SQLITE:
+        return run_sqlite_maintenance()
+
+def run_sqlite_maintenance():
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+        if not cursor.fetchone():
+            # First run: gather full statistics so the planner picks up the indexes right away
+            cursor.execute("ANALYZE")
+        else:
+            cursor.execute("PRAGMA optimize")
+    with get_sqlite_connection() as conn:
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    print("SQLite maintenance completed.")
 
 def add_user_if_not_exists(user_id, username, first_name):
-    """Add a user if they don't already exist."""
-    if USE_POSTGRESQL and postgresql_functions:
-        return postgresql_functions['add_user_if_not_exists'](user_id, username, first_name)
-    else:
-        return add_user_if_not_exists_sqlite(user_id, username, first_name)
-
-def add_user_if_not_exists_sqlite(user_id, username, first_name):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-    if not cursor.fetchone():
-        cursor.execute("INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)",
-                       (user_id, username, first_name))
-        conn.commit()
-    conn.close()
+    """Add a user if they don't already exist.
+
+    Users already in the known-user set cost no database work; their profile
+    changes are queued for flush_user_profile_updates().
+    """
+    if known_users.observe(user_id, username, first_name):
+        return
+    upsert_users([(user_id, username, first_name)])
+    known_users.add(user_id, username, first_name)
+
+def upsert_users(rows):
+    """Insert or update users from (user_id, username, first_name) rows in one statement."""
+    if not rows:
+        return
+    return _write('upsert_users', rows)
+
+def upsert_users_sqlite(rows):
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE
+            SET username = excluded.username, first_name = excluded.first_name
+            WHERE users.username IS NOT excluded.username OR users.first_name IS NOT excluded.first_name
+        ''', rows)
+
+def flush_user_profile_updates():
+    """Write queued user inserts/profile changes in one batch. Returns the number of rows written."""
+    rows = known_users.take_pending()
+    if not rows:
+        return 0
+    try:
+        upsert_users(rows)
+    except Exception:
+        known_users.requeue(rows)
+        raise
+    known_users.mark_flushed(len(rows))
+    return len(rows)
+
+def iter_user_profiles(batch_size=5000):
+    """Stream (user_id, username, first_name) for every user."""
+    return _backend_function(PRIMARY_BACKEND, 'iter_user_profiles')(batch_size)
+
+def iter_user_profiles_sqlite(batch_size):
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id, username, first_name FROM users ORDER BY join_date, user_id")
+        yield from iter_cursor(cursor, batch_size)
+
+def warm_known_users():
+    """Load existing users into the known-user set (call once at startup). Returns the number loaded."""
+    count = 0
+    for user_id, username, first_name in iter_user_profiles():
+        known_users.add(user_id, username, first_name)
+        count += 1
+    print(f"Known-user set warmed with {count} users.")
+    return count
 
 def create_subscription_record(user_id, duration_plan_id, duration_days):
     """Create a pending subscription record."""
-    if USE_POSTGRESQL and postgresql_functions:
-        return postgresql_functions['create_subscription_record'](user_id, duration_plan_id, duration_days)
-    else:
-        return create_subscription_record_sqlite(user_id, duration_plan_id, duration_days)
-
-def create_subscription_record_sqlite(user_id, duration_plan_id, duration_days):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    # Create a pending record, activation happens after payment
-    cursor.execute('''
-        INSERT INTO subscriptions (user_id, duration_plan_id, status)
-        VALUES (?, ?, 'pending_payment')
-    ''', (user_id, duration_plan_id))
-    subscription_db_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    # The subscription references users(user_id): write this user's queued upsert first
+    pending_user = known_users.take_pending(user_id)
+    if pending_user:
+        try:
+            upsert_users(pending_user)
+        except Exception:
+            known_users.requeue(pending_user)
+            raise
+    created_at = datetime.datetime.utcnow()
+    subscription_db_id = _backend_function(PRIMARY_BACKEND, 'create_subscription_record')(
+        user_id, duration_plan_id, duration_days, created_at)
+    if dual_write:
+        # The shadow must store the row under the id the primary assigned
+        dual_write.replay_write('create_subscription_record',
+                                _backend_function(SHADOW_BACKEND, 'create_subscription_record'),
+                                user_id, duration_plan_id, duration_days, created_at, subscription_db_id)
+    return subscription_db_id
+
+def create_subscription_record_sqlite(user_id, duration_plan_id, duration_days, created_at=None, subscription_db_id=None):
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        # Create a pending record, activation happens after payment
+        cursor.execute('''
+            INSERT INTO subscriptions (id, user_id, duration_plan_id, status, created_at)
+            VALUES (?, ?, ?, 'pending_payment', ?)
+        ''', (subscription_db_id, user_id, duration_plan_id, created_at or datetime.datetime.utcnow()))
+        subscription_db_id = cursor.lastrowid
     return subscription_db_id
 
 def update_subscription_country_package(subscription_id, country_package_id):
     """Update subscription with the selected country package."""
-    if USE_POSTGRESQL and postgresql_functions:
-        return postgresql_functions['update_subscription_country_package'](subscription_id, country_package_id)
-    else:
-        return update_subscription_country_package_sqlite(subscription_id, country_package_id)
+    return _write('update_subscription_country_package', subscription_id, country_package_id)
 
 def update_subscription_country_package_sqlite(subscription_id, country_package_id):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE subscriptions
-        SET country_package_id = ?
-        WHERE id = ?
-    ''', (country_package_id, subscription_id))
-    conn.commit()
-    conn.close()
-
-def add_subscription_country(subscription_id, country_code, outline_key_id, outline_access_url):
-    """Add a country to a subscription with its VPN key."""
-    if USE_POSTGRESQL and postgresql_functions:
-        return postgresql_functions['add_subscription_country'](subscription_id, country_code, outline_key_id, outline_access_url)
-    else:
-        return add_subscription_country_sqlite(subscription_id, country_code, outline_key_id, outline_access_url)
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE subscriptions
+            SET country_package_id = ?
+            WHERE id = ?
+        ''', (country_package_id, subscription_id))
+
+def add_subscription_country(subscription_id, user_id, country_code, outline_key_id, outline_access_url):
+    """Add a country to a subscription (owned by `user_id`) with its VPN key."""
+    result = _write('add_subscription_country', subscription_id, country_code, outline_key_id, outline_access_url)
+    _invalidate_subscription_caches(subscription_id, user_id)
+    return result
 
 def add_subscription_country_sqlite(subscription_id, country_code, outline_key_id, outline_access_url):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO subscription_countries (subscription_id, country_code, outline_key_id, outline_access_url)
-        VALUES (?, ?, ?, ?)
-    ''', (subscription_id, country_code, outline_key_id, outline_access_url))
-    conn.commit()
-    conn.close()
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO subscription_countries (subscription_id, country_code, outline_key_id, outline_access_url)
+            VALUES (?, ?, ?, ?)
+        ''', (subscription_id, country_code, outline_key_id, outline_access_url))
 
+@timed_query()
 def add_vless_subscription(user_id, vless_uuid, vless_uri, end_date):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO vless_subscriptions (user_id, vless_uuid, vless_uri, end_date)
-        VALUES (?, ?, ?, ?)
-    ''', (user_id, vless_uuid, vless_uri, end_date))
-    conn.commit()
-    conn.close()
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO vless_subscriptions (user_id, vless_uuid, vless_uri, end_date)
+            VALUES (?, ?, ?, ?)
+        ''', (user_id, vless_uuid, vless_uri, end_date))
 
+@timed_query()
 def get_vless_subscriptions(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, vless_uuid, vless_uri, start_date, end_date, status FROM vless_subscriptions WHERE user_id = ?
-    ''', (user_id,))
-    results = cursor.fetchall()
-    conn.close()
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, vless_uuid, vless_uri, start_date, end_date, status FROM vless_subscriptions WHERE user_id = ?
+        ''', (user_id,))
+        results = cursor.fetchall()
     return results
 
-def activate_subscription(subscription_db_id, duration_days, payment_id="MANUAL_CRYPTO"):
-    """Activate a subscription with start and end dates."""
-    if USE_POSTGRESQL and postgresql_functions:
-        return postgresql_functions['activate_subscription'](subscription_db_id, duration_days, payment_id)
-    else:
-        return activate_subscription_sqlite(subscription_db_id, duration_days, payment_id)
+def activate_subscription(subscription_db_id, user_id, duration_days, payment_id="MANUAL_CRYPTO"):
+    """Activate a subscription (owned by `user_id`) with start and end dates."""
+    # Dates are fixed here so both backends store the same values in dual-write mode
+    start_date = datetime.datetime.utcnow()
+    result = _write('activate_subscription', subscription_db_id, duration_days, payment_id, start_date)
+    _invalidate_subscription_caches(subscription_db_id, user_id)
+    _notify_end_date(subscription_db_id, start_date + datetime.timedelta(days=duration_days))
+    return result
+
+def activate_subscription_sqlite(subscription_db_id, duration_days, payment_id="MANUAL_CRYPTO", start_date=None):
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        start_date = start_date or datetime.datetime.utcnow()
+        end_date = start_date + datetime.timedelta(days=duration_days)
+        cursor.execute('''
+            UPDATE subscriptions
+            SET start_date = ?, end_date = ?, status = 'active', payment_id = ?,
+                reminder_stage = 0, reminder_sent_at = NULL
+            WHERE id = ?
+        ''', (start_date, end_date, payment_id, subscription_db_id))
+    print(f"Subscription {subscription_db_id} activated. Ends on {end_date}")
+
+def provision_subscription(subscription_id, user_id, country_package_id, keys, duration_days,
+                           payment_id="MANUAL_CRYPTO"):
+    """Set the country package, add every country key and activate the subscription in a single transaction.
 
-def activate_subscription_sqlite(subscription_db_id, duration_days, payment_id="MANUAL_CRYPTO"):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    The subscription is owned by `user_id`. `keys` is a list of (country_code, outline_key_id, outline_access_url).
+    Returns the new end date; raises ValueError if the subscription does not exist.
+    """
+    if not keys:
+        raise ValueError("provision_subscription needs at least one key")
     start_date = datetime.datetime.utcnow()
+    result = _write('provision_subscription', subscription_id, country_package_id, keys, duration_days, payment_id,
+                    start_date)
+    _invalidate_subscription_caches(subscription_id, user_id)
+    _notify_end_date(subscription_id, start_date + datetime.timedelta(days=duration_days))
+    return result
+
+def provision_subscription_sqlite(subscription_id, country_package_id, keys, duration_days, payment_id="MANUAL_CRYPTO",
+                                  start_date=None):
+    start_date = start_date or datetime.datetime.utcnow()
     end_date = start_date + datetime.timedelta(days=duration_days)
-    cursor.execute('''
-        UPDATE subscriptions
-        SET start_date = ?, end_date = ?, status = 'active', payment_id = ?
-        WHERE id = ?
-    ''', (start_date, end_date, payment_id, subscription_db_id))
-    conn.commit()
-    conn.close()
-    print(f"Subscription {subscription_db_id} activated. Ends on {end_date}")
+    values = ', '.join(['(?, ?, ?, ?)'] * len(keys))
+    params = []
+    for country_code, outline_key_id, outline_access_url in keys:
+        params.extend((subscription_id, country_code, outline_key_id, outline_access_url))
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE subscriptions
+            SET country_package_id = ?, start_date = ?, end_date = ?, status = 'active', payment_id = ?,
+                reminder_stage = 0, reminder_sent_at = NULL
+            WHERE id = ?
+        ''', (country_package_id, start_date, end_date, payment_id, subscription_id))
+        if cursor.rowcount == 0:
+            raise ValueError(f"Subscription {subscription_id} not found")
+        cursor.execute(f'''
+            INSERT INTO subscription_countries (subscription_id, country_code, outline_key_id, outline_access_url)
+            VALUES {values}
+        ''', params)
+    print(f"Subscription {subscription_id} provisioned with {len(keys)} key(s). Ends on {end_date}")
+    return end_date
 
 def get_active_subscriptions(user_id):
-    """Get all active subscriptions for a user."""
-    if USE_POSTGRESQL and postgresql_functions:
-        return postgresql_functions['get_active_subscriptions'](user_id)
-    else:
-        return get_active_subscriptions_sqlite(user_id)
+    """Get all active subscriptions for a user (served from active_subscriptions_cache)."""
+    def load():
+        return _read('get_active_subscriptions', user_id)
+    # A cached entry can outlive the end date of its subscriptions, so drop those on every read
+    now = datetime.datetime.utcnow()
+    return [sub for sub in active_subscriptions_cache.get_or_load(user_id, load) if sub.end_date and sub.end_date > now]
 
 def get_active_subscriptions_sqlite(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT s.id, s.duration_plan_id, s.country_package_id, s.end_date, s.status,
-               GROUP_CONCAT(sc.country_code) as countries,
-               GROUP_CONCAT(sc.outline_access_url) as access_urls
-        FROM subscriptions s
-        LEFT JOIN subscription_countries sc ON s.id = sc.subscription_id
-        WHERE s.user_id = ? AND s.status = 'active' AND s.end_date > CURRENT_TIMESTAMP
-        GROUP BY s.id
-        ORDER BY s.end_date DESC
-    ''', (user_id,))
-    subs = cursor.fetchall()
-    conn.close()
-    return subs
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT s.id, s.duration_plan_id, s.country_package_id, s.end_date, s.status,
+                   sc.country_code, sc.outline_key_id, sc.outline_access_url
+            FROM subscriptions s
+            LEFT JOIN subscription_countries sc ON s.id = sc.subscription_id
+            WHERE s.user_id = ? AND s.status = 'active' AND s.end_date > CURRENT_TIMESTAMP
+            ORDER BY s.end_date DESC, s.id, sc.id
+        ''', (user_id,))
+        return list(group_subscription_rows(cursor.fetchall(), ActiveSubscription, date_index=3))
 
 def get_subscription_countries(subscription_id):
-    """Get all countries and their VPN keys for a specific subscription."""
-    if USE_POSTGRESQL and postgresql_functions:
-        return postgresql_functions['get_subscription_countries'](subscription_id)
-    else:
-        return get_subscription_countries_sqlite(subscription_id)
+    """Get all countries and their VPN keys for a specific subscription (served from subscription_countries_cache)."""
+    def load():
+        return _read('get_subscription_countries', subscription_id)
+    return subscription_countries_cache.get_or_load(subscription_id, load)
 
 def get_subscription_countries_sqlite(subscription_id):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT country_code, outline_key_id, outline_access_url
-        FROM subscription_countries
-        WHERE subscription_id = ?
-    ''', (subscription_id,))
-    countries = cursor.fetchall()
-    conn.close()
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT country_code, outline_key_id, outline_access_url
+            FROM subscription_countries
+            WHERE subscription_id = ?
+        ''', (subscription_id,))
+        countries = cursor.fetchall()
     return countries
 
 def get_expired_soon_or_active_subscriptions():
     """Gets subscriptions that are active or will expire soon (for checking)."""
-    if USE_POSTGRESQL and postgresql_functions:
-        return postgresql_functions['get_expired_soon_or_active_subscriptions']()
-    else:
-        return get_expired_soon_or_active_subscriptions_sqlite()
+    return _read('get_expired_soon_or_active_subscriptions')
 
 def get_expired_soon_or_active_subscriptions_sqlite():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    # Check subscriptions that are active and their end_date is in the past
-    cursor.execute('''
-        SELECT s.id, s.user_id, s.status, s.end_date,
-               GROUP_CONCAT(sc.outline_key_id) as key_ids,
-               GROUP_CONCAT(sc.country_code) as countries
-        FROM subscriptions s
-        LEFT JOIN subscription_countries sc ON s.id = sc.subscription_id
-        WHERE s.status = 'active'
-        GROUP BY s.id
-    ''')
-    subs = cursor.fetchall()
-    conn.close()
-    return subs
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        # Check subscriptions that are active and their end_date is in the past
+        cursor.execute('''
+            SELECT s.id, s.user_id, s.status, s.end_date,
+                   sc.country_code, sc.outline_key_id, sc.outline_access_url
+            FROM subscriptions s
+            LEFT JOIN subscription_countries sc ON s.id = sc.subscription_id
+            WHERE s.status = 'active'
+            ORDER BY s.id, sc.id
+        ''')
+        return list(group_subscription_rows(cursor.fetchall(), ExpiringSubscription, date_index=3))
 
-def mark_subscription_expired(subscription_id):
-    """Mark a subscription as expired."""
-    if USE_POSTGRESQL and postgresql_functions:
-        return postgresql_functions['mark_subscription_expired'](subscription_id)
-    else:
-        return mark_subscription_expired_sqlite(subscription_id)
+def iter_subscriptions_in_expiry_window(window_start, window_end, batch_size=EXPIRY_FETCH_BATCH_SIZE):
+    """Stream active subscriptions whose end_date falls in [window_start, window_end], fetched in batches.
+
+    Subscriptions already queued for key revocation are left out.
+    """
+    return _backend_function(PRIMARY_BACKEND, 'iter_subscriptions_in_expiry_window')(window_start, window_end, batch_size)
+
+def iter_subscriptions_in_expiry_window_sqlite(window_start, window_end, batch_size):
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        # Range scan on idx_subscriptions_status_end instead of joining the whole active set
+        cursor.execute('''
+            SELECT s.id, s.user_id, s.status, s.end_date, s.duration_plan_id,
+                   sc.country_code, sc.outline_key_id, sc.outline_access_url
+            FROM subscriptions s
+            LEFT JOIN subscription_countries sc ON s.id = sc.subscription_id
+            WHERE s.status = 'active' AND s.end_date BETWEEN ? AND ?
+              AND NOT EXISTS (SELECT 1 FROM key_revocations r WHERE r.subscription_id = s.id)
+            ORDER BY s.end_date, s.id, sc.id
+        ''', (window_start, window_end))
+        yield from group_subscription_rows(iter_cursor(cursor, batch_size), ExpiringSubscription, date_index=3)
+
+def iter_active_subscription_end_dates(batch_size=EXPIRY_FETCH_BATCH_SIZE):
+    """Stream (id, end_date) of every active subscription not yet queued for key revocation."""
+    return _backend_function(PRIMARY_BACKEND, 'iter_active_subscription_end_dates')(batch_size)
+
+def iter_active_subscription_end_dates_sqlite(batch_size):
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        # Covered by idx_subscriptions_status_end
+        cursor.execute('''
+            SELECT s.id, s.end_date FROM subscriptions s
+            WHERE s.status = 'active' AND s.end_date IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM key_revocations r WHERE r.subscription_id = s.id)
+        ''')
+        for subscription_id, end_date in iter_cursor(cursor, batch_size):
+            yield subscription_id, to_datetime(end_date)
+
+def mark_subscription_expired(subscription_id, user_id):
+    """Mark a subscription (owned by `user_id`) as expired."""
+    result = _write('mark_subscription_expired', subscription_id)
+    _invalidate_subscription_caches(subscription_id, user_id)
+    _notify_end_date(subscription_id, None)
+    return result
 
 def mark_subscription_expired_sqlite(subscription_id):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE subscriptions SET status = 'expired' WHERE id = ?", (subscription_id,))
-    conn.commit()
-    conn.close()
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE subscriptions SET status = 'expired' WHERE id = ?", (subscription_id,))
     print(f"Subscription {subscription_id} marked as expired in DB.")
 
+def claim_renewal_reminders(stage, now, horizon, limit):
+    """Claim up to `limit` active subscriptions ending within `horizon` of `now` that are due for reminder `stage`.
+
+    A subscription is due if fewer than `stage` reminders were sent for its
+    current end date. Claimed rows are recorded as reminded at this stage
+    before they are returned, so every stage is sent at most once; a reminder
+    that could not be sent is handed back with release_renewal_reminder().
+    Returns RenewalReminder rows, soonest end date first.
+    """
+    claimed = _backend_function(PRIMARY_BACKEND, 'claim_renewal_reminders')(stage, now, now + horizon, limit)
+    if claimed:
+        _replay('mark_renewal_reminders', [reminder.id for reminder in claimed], stage, now)
+    return claimed
+
+def claim_renewal_reminders_sqlite(stage, now, end_before, limit):
+    with get_sqlite_connection(immediate=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, user_id, end_date, reminder_stage, reminder_sent_at FROM subscriptions
+            WHERE status = 'active' AND end_date > ? AND end_date <= ? AND reminder_stage < ?
+            ORDER BY end_date
+            LIMIT ?
+        ''', (now, end_before, stage, limit))
+        claimed = [RenewalReminder(sub_id, user_id, to_datetime(end_date), stage, previous_stage, to_datetime(sent_at))
+                   for sub_id, user_id, end_date, previous_stage, sent_at in cursor.fetchall()]
+        if claimed:
+            placeholders = ','.join('?' * len(claimed))
+            cursor.execute(f'''
+                UPDATE subscriptions SET reminder_stage = ?, reminder_sent_at = ?
+                WHERE id IN ({placeholders})
+            ''', (stage, now, *[reminder.id for reminder in claimed]))
+        return claimed
+
+def mark_renewal_reminders_sqlite(subscription_ids, stage, sent_at):
+    with get_sqlite_connection() as conn:
+        placeholders = ','.join('?' * len(subscription_ids))
+        conn.execute(f'''
+            UPDATE subscriptions SET reminder_stage = ?, reminder_sent_at = ?
+            WHERE id IN ({placeholders})
+        ''', (stage, sent_at, *subscription_ids))
+
+def release_renewal_reminder(reminder):
+    """Return a claimed reminder whose message could not be sent, so a later run claims it again.
+
+    Nothing changes if the subscription was renewed (or reminded again) since the claim.
+    """
+    return _write('release_renewal_reminder', reminder.id, reminder.stage, reminder.previous_stage,
+                  reminder.previous_sent_at)
+
+def release_renewal_reminder_sqlite(subscription_id, stage, previous_stage, previous_sent_at):
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE subscriptions SET reminder_stage = ?, reminder_sent_at = ?
+            WHERE id = ? AND reminder_stage = ?
+        ''', (previous_stage, previous_sent_at, subscription_id, stage))
+
 def get_all_active_subscriptions_for_admin():
     """Gets all active or recently expired subscriptions for admin view."""
-    if USE_POSTGRESQL and postgresql_functions:
-        return postgresql_functions['get_all_active_subscriptions_for_admin']()
-    else:
-        return get_all_active_subscriptions_for_admin_sqlite()
+    return _read('get_all_active_subscriptions_for_admin')
 
 def get_all_active_subscriptions_for_admin_sqlite():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT s.id, s.user_id, u.username, u.first_name, s.duration_plan_id, s.country_package_id, s.end_date, s.status,
-               GROUP_CONCAT(sc.country_code) as countries
-        FROM subscriptions s
-        JOIN users u ON s.user_id = u.user_id
-        LEFT JOIN subscription_countries sc ON s.id = sc.subscription_id
-        WHERE s.status IN ('active', 'pending_payment', 'expired')
-        GROUP BY s.id
-        ORDER BY s.user_id, s.end_date DESC
-    ''')
-    subs = cursor.fetchall()
-    conn.close()
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT s.id, s.user_id, u.username, u.first_name, s.duration_plan_id, s.country_package_id, s.end_date, s.status,
+                   GROUP_CONCAT(sc.country_code) as countries
+            FROM subscriptions s
+            JOIN users u ON s.user_id = u.user_id
+            LEFT JOIN subscription_countries sc ON s.id = sc.subscription_id
+            WHERE s.status IN ('active', 'pending_payment', 'expired')
+            GROUP BY s.id
+            ORDER BY s.user_id, s.end_date DESC
+        ''')
+        subs = cursor.fetchall()
     return subs
 
+# Statuses listed in the admin deletion flow
+ADMIN_SUBSCRIPTION_STATUSES = ('active', 'pending_payment', 'expired')
+
+def get_admin_subscriptions_page(after=None, limit=10, statuses=ADMIN_SUBSCRIPTION_STATUSES):
+    """Get one page of subscriptions for the admin view, ordered by user_id, end_date DESC, id DESC.
+
+    `after` is the keyset cursor returned with the previous page (None for the first page).
+    Returns (rows, next_cursor); next_cursor is None on the last page. Rows have the same
+    columns as get_all_active_subscriptions_for_admin().
+    """
+    return _read('get_admin_subscriptions_page', after, limit, statuses)
+
+def get_admin_subscriptions_page_sqlite(after, limit, statuses):
+    status_placeholders = ','.join('?' * len(statuses))
+    params = list(statuses)
+    keyset = ''
+    if after is not None:
+        after_user_id, after_end_date, after_id = after
+        # NULL end dates (pending payments) sort last within a user, as '' < any timestamp
+        keyset = '''AND s.user_id >= ? AND (s.user_id > ? OR (s.user_id = ? AND (
+                        COALESCE(s.end_date, '') < COALESCE(?, '')
+                        OR (COALESCE(s.end_date, '') = COALESCE(?, '') AND s.id < ?))))'''
+        params += [after_user_id, after_user_id, after_user_id, after_end_date, after_end_date, after_id]
+    params.append(limit + 1)
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        # Countries are aggregated per returned row only, so the cost is O(page), not O(table)
+        cursor.execute(f'''
+            SELECT s.id, s.user_id, u.username, u.first_name, s.duration_plan_id, s.country_package_id, s.end_date, s.status,
+                   (SELECT GROUP_CONCAT(sc.country_code) FROM subscription_countries sc
+                    WHERE sc.subscription_id = s.id) as countries
+            FROM subscriptions s
+            JOIN users u ON s.user_id = u.user_id
+            WHERE s.status IN ({status_placeholders}) {keyset}
+            ORDER BY s.user_id, COALESCE(s.end_date, '') DESC, s.id DESC
+            LIMIT ?
+        ''', params)
+        rows = cursor.fetchall()
+    return keyset_page(rows, limit)
+
+def count_admin_subscriptions(statuses=ADMIN_SUBSCRIPTION_STATUSES):
+    """Count the subscriptions shown in the admin view."""
+    return _read('count_admin_subscriptions', statuses)
+
+def count_admin_subscriptions_sqlite(statuses):
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT COUNT(*) FROM subscriptions WHERE status IN ({','.join('?' * len(statuses))})",
+                       tuple(statuses))
+        return cursor.fetchone()[0]
+
 def get_subscription_by_id(subscription_id):
     """Get subscription details by ID."""
-    if USE_POSTGRESQL and postgresql_functions:
-        return postgresql_functions['get_subscription_by_id'](subscription_id)
-    else:
-        return get_subscription_by_id_sqlite(subscription_id)
+    return _read('get_subscription_by_id', subscription_id)
 
 def get_subscription_by_id_sqlite(subscription_id):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, user_id, duration_plan_id, country_package_id, start_date, end_date, status, payment_id
-        FROM subscriptions
-        WHERE id = ?
-    ''', (subscription_id,))
-    sub = cursor.fetchone()
-    conn.close()
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, user_id, duration_plan_id, country_package_id, start_date, end_date, status, payment_id
+            FROM subscriptions
+            WHERE id = ?
+        ''', (subscription_id,))
+        sub = cursor.fetchone()
     return sub
 
+def _invalidate_subscription_caches(subscription_id, user_id):
+    """Drop cached reads that depend on a subscription of `user_id` after it was written."""
+    subscription_countries_cache.invalidate(subscription_id)
+    active_subscriptions_cache.invalidate(user_id)
+
 def get_subscription_for_admin(subscription_id):
     """Get subscription details by ID in the format expected by admin functions."""
-    if USE_POSTGRESQL and postgresql_functions:
-        return postgresql_functions['get_subscription_for_admin'](subscription_id)
-    else:
-        return get_subscription_for_admin_sqlite(subscription_id)
+    return _read('get_subscription_for_admin', subscription_id)
 
 def get_subscription_for_admin_sqlite(subscription_id):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT s.id, s.user_id, s.status,
-               GROUP_CONCAT(sc.outline_key_id) as key_ids,
-               GROUP_CONCAT(sc.country_code) as countries
-        FROM subscriptions s
-        LEFT JOIN subscription_countries sc ON s.id = sc.subscription_id
-        WHERE s.id = ?
-        GROUP BY s.id
-    ''', (subscription_id,))
-    sub = cursor.fetchone()
-    conn.close()
-    return sub
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT s.id, s.user_id, s.status,
+                   sc.country_code, sc.outline_key_id, sc.outline_access_url
+            FROM subscriptions s
+            LEFT JOIN subscription_countries sc ON s.id = sc.subscription_id
+            WHERE s.id = ?
+            ORDER BY sc.id
+        ''', (subscription_id,))
+        return next(group_subscription_rows(cursor.fetchall(), AdminSubscription), None)
 
-def cancel_subscription_by_admin(subscription_db_id):
-    """Cancel a subscription by admin."""
-    if USE_POSTGRESQL and postgresql_functions:
-        return postgresql_functions['cancel_subscription_by_admin'](subscription_db_id)
-    else:
-        return cancel_subscription_by_admin_sqlite(subscription_db_id)
+def cancel_subscription_by_admin(subscription_db_id, user_id):
+    """Cancel a subscription (owned by `user_id`) by admin."""
+    result = _write('cancel_subscription_by_admin', subscription_db_id)
+    _invalidate_subscription_caches(subscription_db_id, user_id)
+    _notify_end_date(subscription_db_id, None)
+    return result
 
 def cancel_subscription_by_admin_sqlite(subscription_db_id):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE subscriptions SET status = 'cancelled_by_admin' WHERE id = ?", (subscription_db_id,))
-    conn.commit()
-    updated_rows = cursor.rowcount
-    conn.close()
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE subscriptions SET status = 'cancelled_by_admin' WHERE id = ?", (subscription_db_id,))
+        updated_rows = cursor.rowcount
     print(f"Subscription {subscription_db_id} marked as 'cancelled_by_admin' in DB.")
     return updated_rows > 0
 
 def renew_subscription(subscription_id, user_id, new_end_date, payment_id):
     """Renew a subscription by updating its end_date, status, and payment_id."""
-    if USE_POSTGRESQL and postgresql_functions:
-        return postgresql_functions['renew_subscription'](subscription_id, user_id, new_end_date, payment_id)
-    else:
-        return renew_subscription_sqlite(subscription_id, user_id, new_end_date, payment_id)
+    result = _write('renew_subscription', subscription_id, user_id, new_end_date, payment_id)
+    _invalidate_subscription_caches(subscription_id, user_id)
+    _notify_end_date(subscription_id, to_datetime(new_end_date))
+    return result
 
 def renew_subscription_sqlite(subscription_id, user_id, new_end_date, payment_id):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE subscriptions
-        SET end_date = ?, status = 'active', payment_id = ?
-        WHERE id = ? AND user_id = ?
-    ''', (new_end_date, payment_id, subscription_id, user_id))
-    conn.commit()
-    conn.close()
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE subscriptions
+            SET end_date = ?, status = 'active', payment_id = ?, reminder_stage = 0, reminder_sent_at = NULL
+            WHERE id = ? AND user_id = ?
+        ''', (new_end_date, payment_id, subscription_id, user_id))
+
+# Key revocation queue: expired subscriptions whose Outline keys are deleted after a grace period.
+# The queue lives in the database (key_revocations), so a restart during the grace period loses nothing.
+
+def enqueue_key_revocation(subscription_id, user_id, due_at):
+    """Queue the keys of an expired subscription for deletion at `due_at`.
+
+    Idempotent per subscription: returns True only if the subscription was not queued yet.
+    """
+    return _write('enqueue_key_revocation', subscription_id, user_id, due_at)
+
+def enqueue_key_revocation_sqlite(subscription_id, user_id, due_at):
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT OR IGNORE INTO key_revocations (subscription_id, user_id, due_at, created_at)
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+        ''', (subscription_id, user_id, due_at))
+        return cursor.rowcount > 0
+
+def enqueue_overdue_key_revocations(expired_before, due_at):
+    """Queue every still-active subscription that expired before `expired_before` and is not queued yet.
+
+    Startup recovery for expirations whose revocation was never queued (e.g. lost
+    with an in-memory job). Returns the number of subscriptions queued.
+    """
+    return _write('enqueue_overdue_key_revocations', expired_before, due_at)
+
+def enqueue_overdue_key_revocations_sqlite(expired_before, due_at):
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT OR IGNORE INTO key_revocations (subscription_id, user_id, due_at, created_at)
+            SELECT id, user_id, ?, CURRENT_TIMESTAMP FROM subscriptions
+            WHERE status = 'active' AND end_date <= ?
+        ''', (due_at, expired_before))
+        return cursor.rowcount
+
+def get_due_key_revocations(now, limit):
+    """Return up to `limit` due revocations as KeyRevocation rows, oldest first.
+
+    Entries whose subscription was renewed (or is otherwise no longer an expired
+    active subscription) are dropped first, in the same transaction. The keys of
+    an entry that failed partially are narrowed to the ones still to delete.
+    """
+    revocations = _backend_function(PRIMARY_BACKEND, 'get_due_key_revocations')(now, limit)
+    _replay('drop_renewed_key_revocations', now)
+    return [revocation._replace(keys=_pending_revocation_keys(revocation)) for revocation in revocations]
+
+def _pending_revocation_keys(revocation):
+    keys = tuple(key for key in revocation.keys if key.outline_key_id)
+    if revocation.pending_keys is None:
+        return keys
+    pending = {tuple(key) for key in json.loads(revocation.pending_keys)}
+    return tuple(key for key in keys if (key.country_code, str(key.outline_key_id)) in pending)
+
+def get_due_key_revocations_sqlite(now, limit):
+    with get_sqlite_connection(immediate=True) as conn:
+        drop_renewed_key_revocations_sqlite(now)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT r.subscription_id, r.user_id, r.attempts, r.pending_keys,
+                   sc.country_code, sc.outline_key_id, sc.outline_access_url
+            FROM (SELECT * FROM key_revocations WHERE due_at <= ? ORDER BY due_at, subscription_id LIMIT ?) r
+            LEFT JOIN subscription_countries sc ON r.subscription_id = sc.subscription_id
+            ORDER BY r.due_at, r.subscription_id, sc.id
+        ''', (now, limit))
+        return list(group_subscription_rows(cursor.fetchall(), KeyRevocation))
+
+def drop_renewed_key_revocations_sqlite(now):
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            DELETE FROM key_revocations
+            WHERE due_at <= ? AND NOT EXISTS (
+                SELECT 1 FROM subscriptions s
+                WHERE s.id = key_revocations.subscription_id AND s.status = 'active' AND s.end_date <= ?
+            )
+        ''', (now, now))
+        if cursor.rowcount:
+            print(f"Key revocation: dropped {cursor.rowcount} renewed or finished subscription(s) from the queue")
+
+def reschedule_key_revocation(subscription_id, due_at, remaining_keys, error):
+    """Retry a partially failed revocation at `due_at`, for the keys in `remaining_keys` only."""
+    pending_keys = json.dumps([[key.country_code, str(key.outline_key_id)] for key in remaining_keys])
+    return _write('reschedule_key_revocation', subscription_id, due_at, pending_keys, error)
+
+def reschedule_key_revocation_sqlite(subscription_id, due_at, pending_keys, error):
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE key_revocations
+            SET due_at = ?, pending_keys = ?, last_error = ?, attempts = attempts + 1
+            WHERE subscription_id = ?
+        ''', (due_at, pending_keys, error, subscription_id))
+
+def complete_key_revocations(revocations, now):
+    """Mark the subscriptions of finished revocations expired and remove them from the queue, in one transaction.
+
+    A subscription renewed after its entry was fetched is left active.
+    """
+    if not revocations:
+        return
+    subscription_ids = [revocation.subscription_id for revocation in revocations]
+    _write('complete_key_revocations', subscription_ids, now)
+    for revocation in revocations:
+        _invalidate_subscription_caches(revocation.subscription_id, revocation.user_id)
+
+def complete_key_revocations_sqlite(subscription_ids, now):
+    placeholders = ','.join('?' * len(subscription_ids))
+    with get_sqlite_connection(immediate=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            UPDATE subscriptions SET status = 'expired'
+            WHERE id IN ({placeholders}) AND status = 'active' AND end_date <= ?
+        ''', (*subscription_ids, now))
+        cursor.execute(f"DELETE FROM key_revocations WHERE subscription_id IN ({placeholders})", subscription_ids)
+
+def count_key_revocations(now):
+    """Return (queued, due) sizes of the key revocation queue."""
+    return _read('count_key_revocations', now)
+
+def count_key_revocations_sqlite(now):
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*), COALESCE(SUM(due_at <= ?), 0) FROM key_revocations", (now,))
+        return tuple(cursor.fetchone())
+
+def add_dead_letter_keys(subscription_id, failed, source):
+    """Record keys that could not be deleted after every retry; `failed` is a list of (key, error).
+
+    A key that is already recorded is left as it is.
+    """
+    if not failed:
+        return
+    entries = [(key.country_code, str(key.outline_key_id), error) for key, error in failed]
+    created_at = datetime.datetime.utcnow()
+    return _write('add_dead_letter_keys', subscription_id, entries, source, created_at)
+
+def add_dead_letter_keys_sqlite(subscription_id, entries, source, created_at):
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT OR IGNORE INTO key_dead_letters
+                (subscription_id, country_code, outline_key_id, source, last_error, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(subscription_id, country, key_id, source, error, created_at) for country, key_id, error in entries])
+    print(f"Dead-lettered {len(entries)} undeletable key(s) of subscription {subscription_id} ({source})")
+
+def count_dead_letter_keys():
+    """Number of recorded keys that could not be deleted."""
+    return _read('count_dead_letter_keys')
+
+def count_dead_letter_keys_sqlite():
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM key_dead_letters")
+        return cursor.fetchone()[0]
+
+def add_pooled_keys(keys):
+    """Add pre-created, unassigned keys to the key pool.
+
+    `keys` is a list of (country_code, server_id, outline_key_id, outline_access_url).
+    """
+    if not keys:
+        return
+    return _write('add_pooled_keys', keys, datetime.datetime.utcnow())
+
+def add_pooled_keys_sqlite(keys, created_at):
+    with get_sqlite_connection() as conn:
+        conn.executemany('''
+            INSERT OR IGNORE INTO key_pool (country_code, server_id, outline_key_id, outline_access_url, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(country, server_id, str(key_id), access_url, created_at)
+              for country, server_id, key_id, access_url in keys])
+
+def claim_pooled_keys(servers):
+    """Take one pooled key for every (country_code, server_id) in `servers`, removing it from the pool.
+
+    Returns SubscriptionKeys for the countries whose pool was not empty. A
+    key is handed out only once, even when several processes claim at the
+    same time.
+    """
+    if not servers:
+        return []
+    claimed = _backend_function(PRIMARY_BACKEND, 'claim_pooled_keys')(list(servers))
+    if claimed:
+        _replay('remove_pooled_keys', [(key.country_code, str(key.outline_key_id)) for key in claimed])
+    return claimed
+
+def claim_pooled_keys_sqlite(servers):
+    with get_sqlite_connection(immediate=True) as conn:
+        cursor = conn.cursor()
+        claimed = []
+        for country, server_id in servers:
+            cursor.execute('''
+                SELECT id, outline_key_id, outline_access_url FROM key_pool
+                WHERE country_code = ? AND server_id = ?
+                ORDER BY created_at, outline_key_id
+                LIMIT 1
+            ''', (country, server_id))
+            row = cursor.fetchone()
+            if row:
+                cursor.execute("DELETE FROM key_pool WHERE id = ?", (row[0],))
+                claimed.append(SubscriptionKey(country, row[1], row[2]))
+        return claimed
+
+def remove_pooled_keys_sqlite(keys):
+    with get_sqlite_connection() as conn:
+        conn.executemany("DELETE FROM key_pool WHERE country_code = ? AND outline_key_id = ?", keys)
+
+def count_pooled_keys():
+    """Pool depth: unassigned keys per (country_code, server_id)."""
+    return _read('count_pooled_keys')
+
+def count_pooled_keys_sqlite():
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT country_code, server_id, COUNT(*) FROM key_pool GROUP BY country_code, server_id")
+        return {(country, server_id): count for country, server_id, count in cursor.fetchall()}
+
+def discard_stale_pooled_keys(servers):
+    """Remove pooled keys created on an earlier server of a country; `servers` maps country_code to its current server_id.
+
+    Returns the removed keys as SubscriptionKeys: they still exist on the
+    Outline side and must be deleted (or dead-lettered) by the caller.
+    """
+    if not servers:
+        return []
+    return _write('discard_stale_pooled_keys', dict(servers))
+
+def discard_stale_pooled_keys_sqlite(servers):
+    with get_sqlite_connection(immediate=True) as conn:
+        cursor = conn.cursor()
+        stale = []
+        for country, server_id in servers.items():
+            cursor.execute('''
+                SELECT outline_key_id, outline_access_url FROM key_pool WHERE country_code = ? AND server_id <> ?
+            ''', (country, server_id))
+            stale.extend(SubscriptionKey(country, key_id, access_url) for key_id, access_url in cursor.fetchall())
+            cursor.execute("DELETE FROM key_pool WHERE country_code = ? AND server_id <> ?", (country, server_id))
+        return stale
+
+# Finished subscriptions that are moved to the archive once past SUBSCRIPTION_RETENTION_DAYS
+ARCHIVABLE_STATUSES = ('expired', 'cancelled', 'cancelled_by_admin')
+
+def archive_subscriptions(pending_days=PENDING_PAYMENT_RETENTION_DAYS, retention_days=SUBSCRIPTION_RETENTION_DAYS,
+                          batch_size=ARCHIVE_BATCH_SIZE, max_batches=ARCHIVE_MAX_BATCHES):
+    """Move abandoned checkouts and long-finished subscriptions (with their countries) to the archive tables.
+
+    Each batch of up to `batch_size` subscriptions is moved in its own transaction, so
+    live tables are never locked for long. Returns counts of what was moved.
+    """
+    now = datetime.datetime.utcnow()
+    pending_cutoff = now - datetime.timedelta(days=pending_days)
+    ended_cutoff = now - datetime.timedelta(days=retention_days)
+    totals = {"subscriptions": 0, "subscription_countries": 0, "batches": 0}
+    for _ in range(max_batches):
+        # The shadow picks its batch with the same cutoffs and ORDER BY id, so consistent stores move the same rows
+        moved, moved_countries = _write('archive_subscriptions_batch',
+                                        pending_cutoff, ended_cutoff, ARCHIVABLE_STATUSES, batch_size)
+        if not moved:
+            break
+        for subscription_id, user_id in moved:
+            _invalidate_subscription_caches(subscription_id, user_id)
+        totals["subscriptions"] += len(moved)
+        totals["subscription_countries"] += moved_countries
+        totals["batches"] += 1
+        if len(moved) < batch_size:
+            break
+    return totals
+
+def archive_subscriptions_batch_sqlite(pending_cutoff, ended_cutoff, statuses, batch_size):
+    status_placeholders = ','.join('?' * len(statuses))
+    # Take the write lock before choosing rows, so none of them can be activated or renewed meanwhile
+    with get_sqlite_connection(immediate=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT id, user_id FROM subscriptions
+            WHERE (status = 'pending_payment' AND created_at < ?)
+               OR (status IN ({status_placeholders}) AND COALESCE(end_date, created_at) < ?)
+            ORDER BY id
+            LIMIT ?
+        ''', (pending_cutoff, *statuses, ended_cutoff, batch_size))
+        moved = cursor.fetchall()
+        if not moved:
+            return [], 0
+        ids = [subscription_id for subscription_id, _ in moved]
+        id_placeholders = ','.join('?' * len(ids))
+        cursor.execute(f'''
+            INSERT OR REPLACE INTO subscription_countries_archive
+                (id, subscription_id, country_code, outline_key_id, outline_access_url)
+            SELECT id, subscription_id, country_code, outline_key_id, outline_access_url
+            FROM subscription_countries WHERE subscription_id IN ({id_placeholders})
+        ''', ids)
+        moved_countries = cursor.rowcount
+        cursor.execute(f'''
+            INSERT OR REPLACE INTO subscriptions_archive
+                (id, user_id, duration_plan_id, country_package_id, start_date, end_date, status, payment_id, created_at)
+            SELECT id, user_id, duration_plan_id, country_package_id, start_date, end_date, status, payment_id, created_at
+            FROM subscriptions WHERE id IN ({id_placeholders})
+        ''', ids)
+        cursor.execute(f"DELETE FROM subscription_countries WHERE subscription_id IN ({id_placeholders})", ids)
+        cursor.execute(f"DELETE FROM subscriptions WHERE id IN ({id_placeholders})", ids)
+    return moved, moved_countries
+
+def get_archived_subscriptions(user_id, limit=20):
+    """Get a user's archived subscriptions, newest first, as ArchivedSubscription rows."""
+    return _read('get_archived_subscriptions', user_id, limit)
+
+def get_archived_subscriptions_sqlite(user_id, limit):
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT s.id, s.duration_plan_id, s.country_package_id, s.start_date, s.end_date, s.status, s.archived_at,
+                   sc.country_code, sc.outline_key_id, sc.outline_access_url
+            FROM (SELECT * FROM subscriptions_archive WHERE user_id = ? ORDER BY id DESC LIMIT ?) s
+            LEFT JOIN subscription_countries_archive sc ON s.id = sc.subscription_id
+            ORDER BY s.id DESC, sc.id
+        ''', (user_id, limit))
+        return list(group_subscription_rows(cursor.fetchall(), ArchivedSubscription, date_index=(3, 4, 6)))
+
+def get_users_after_sqlite(after_user_id, limit):
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT user_id, username, first_name FROM users
+            WHERE (? IS NULL OR user_id > ?)
+            ORDER BY user_id
+            LIMIT ?
+        ''', (after_user_id, after_user_id, limit))
+        return cursor.fetchall()
+
+def get_subscription_snapshots_after_sqlite(after_id, limit):
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT s.id, s.user_id, s.duration_plan_id, s.country_package_id, s.start_date, s.end_date, s.status,
+                   s.payment_id, s.created_at, sc.country_code, sc.outline_key_id, sc.outline_access_url
+            FROM (SELECT * FROM subscriptions WHERE (? IS NULL OR id > ?) ORDER BY id LIMIT ?) s
+            LEFT JOIN subscription_countries sc ON s.id = sc.subscription_id
+            ORDER BY s.id, sc.id
+        ''', (after_id, after_id, limit))
+        return list(group_subscription_rows(cursor.fetchall(), SubscriptionSnapshot, date_index=(4, 5, 8)))
+
+# One checker per table; each run compares the next key range of both
+consistency_checkers = {
+    'users': ConsistencyChecker('users'),
+    'subscriptions': ConsistencyChecker('subscriptions'),
+}
+_CONSISTENCY_FETCHERS = {'users': 'get_users_after', 'subscriptions': 'get_subscription_snapshots_after'}
+
+def check_backend_consistency(batch_size=DB_CONSISTENCY_CHECK_BATCH):
+    """Diff the next id range of every table between primary and shadow (dual-write mode only).
+
+    Returns {table: findings} for this run, or None when dual-write is off.
+    """
+    if not dual_write:
+        return None
+    results = {}
+    for table, checker in consistency_checkers.items():
+        fetcher = _CONSISTENCY_FETCHERS[table]
+        results[table] = checker.check_next(_backend_function(PRIMARY_BACKEND, fetcher),
+                                            _backend_function(SHADOW_BACKEND, fetcher), batch_size)
+    return results
+
+def get_dual_write_stats():
+    """Shadow write/read counters and consistency checker progress (None when dual-write is off)."""
+    if not dual_write:
+        return None
+    stats = dual_write.stats()
+    stats["consistency"] = {table: checker.stats() for table, checker in consistency_checkers.items()}
+    return stats
+
+stats_registry.register("db_dual_write", get_dual_write_stats)
 
 if __name__ == '__main__':
     init_db() # Initialize DB when script is run directly
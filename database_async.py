@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Awaitable versions of the database.py functions for async handlers.
+
+Every call runs on a dedicated, bounded thread pool (DB_EXECUTOR_WORKERS
+threads), so a slow query no longer stalls the PTB event loop. Each worker
+thread keeps its own pooled connection.
+"""
+
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+import vless_database
+from config import DB_EXECUTOR_WORKERS, EXPIRY_FETCH_BATCH_SIZE
+from db_metrics import record_executor_wait
+
+_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking data-layer call on the database executor and await its result."""
+    loop = asyncio.get_running_loop()
+    submitted = time.perf_counter()
+
+    def call():
+        record_executor_wait((time.perf_counter() - submitted) * 1000)
+        return func(*args, **kwargs)
+
+    # Carry the caller's context (e.g. the database session set by database.set_db_session) into the worker
+    return await loop.run_in_executor(_executor, contextvars.copy_context().run, call)
+
+def _awaitable(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_db(func, *args, **kwargs)
+    return wrapper
+
+_STREAM_END = object()
+
+async def stream_db(func, *args, chunk_size=500, max_chunks=2, **kwargs):
+    """Consume a blocking row iterator on the database executor and yield its rows asynchronously.
+
+    The iterator runs entirely on one worker thread (and therefore on one
+    connection); rows are handed over in chunks through a bounded queue, so at
+    most `max_chunks` chunks are buffered if the consumer is slower than the
+    database. Leaving the `async for` early stops the producer and releases the
+    connection.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=max_chunks)
+    stop = threading.Event()
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def produce():
+        rows = None
+        try:
+            rows = func(*args, **kwargs)
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    if stop.is_set():
+                        return
+                    put(chunk)
+                    chunk = []
+            if chunk and not stop.is_set():
+                put(chunk)
+            put(_STREAM_END)
+        except Exception as e:
+            # Covers the call itself as well as the iteration
+            put(e)
+        except BaseException:
+            # Never leave the consumer waiting on the queue
+            put(_STREAM_END)
+            raise
+        finally:
+            close = getattr(rows, "close", None)
+            if close:
+                close()
+
+    producer = loop.run_in_executor(_executor, contextvars.copy_context().run, produce)
+    try:
+        while True:
+            item = await queue.get()
+            if item is _STREAM_END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            for row in item:
+                yield row
+    finally:
+        stop.set()
+        # Unblock a producer waiting on a full queue, then wait for it to release its connection
+        while not producer.done():
+            try:
+                queue.get_nowait()
+            except asyncio.QueueEmpty:
+                await asyncio.sleep(0.01)
+        await producer
+
+def shutdown_executor(wait=True):
+    """Stop the database executor (call on application shutdown)."""
+    _executor.shutdown(wait=wait)
+
+# --- database.py ---
+init_db = _awaitable(database.init_db)
+get_pool_stats = _awaitable(database.get_pool_stats)
+run_db_maintenance = _awaitable(database.run_db_maintenance)
+flush_user_profile_updates = _awaitable(database.flush_user_profile_updates)
+warm_known_users = _awaitable(database.warm_known_users)
+add_user_if_not_exists = _awaitable(database.add_user_if_not_exists)
+create_subscription_record = _awaitable(database.create_subscription_record)
+update_subscription_country_package = _awaitable(database.update_subscription_country_package)
+add_subscription_country = _awaitable(database.add_subscription_country)
+activate_subscription = _awaitable(database.activate_subscription)
+provision_subscription = _awaitable(database.provision_subscription)
+get_active_subscriptions = _awaitable(database.get_active_subscriptions)
+get_subscription_countries = _awaitable(database.get_subscription_countries)
+get_expired_soon_or_active_subscriptions = _awaitable(database.get_expired_soon_or_active_subscriptions)
+
+def stream_subscriptions_in_expiry_window(window_start, window_end):
+    """Async-iterate the active subscriptions whose end_date falls in the given window (not yet queued for revocation)."""
+    return stream_db(database.iter_subscriptions_in_expiry_window, window_start, window_end,
+                     chunk_size=EXPIRY_FETCH_BATCH_SIZE)
+
+def stream_active_subscription_end_dates():
+    """Async-iterate (id, end_date) of every active subscription not yet queued for revocation (expiry timeline)."""
+    return stream_db(database.iter_active_subscription_end_dates, chunk_size=EXPIRY_FETCH_BATCH_SIZE)
+
+mark_subscription_expired = _awaitable(database.mark_subscription_expired)
+claim_renewal_reminders = _awaitable(database.claim_renewal_reminders)
+release_renewal_reminder = _awaitable(database.release_renewal_reminder)
+get_all_active_subscriptions_for_admin = _awaitable(database.get_all_active_subscriptions_for_admin)
+get_admin_subscriptions_page = _awaitable(database.get_admin_subscriptions_page)
+count_admin_subscriptions = _awaitable(database.count_admin_subscriptions)
+get_subscription_by_id = _awaitable(database.get_subscription_by_id)
+get_subscription_for_admin = _awaitable(database.get_subscription_for_admin)
+cancel_subscription_by_admin = _awaitable(database.cancel_subscription_by_admin)
+renew_subscription = _awaitable(database.renew_subscription)
+init_vless_db = _awaitable(database.init_vless_db)
+add_vless_subscription = _awaitable(database.add_vless_subscription)
+get_vless_subscriptions = _awaitable(database.get_vless_subscriptions)
+archive_subscriptions = _awaitable(database.archive_subscriptions)
+get_archived_subscriptions = _awaitable(database.get_archived_subscriptions)
+check_backend_consistency = _awaitable(database.check_backend_consistency)
+enqueue_key_revocation = _awaitable(database.enqueue_key_revocation)
+enqueue_overdue_key_revocations = _awaitable(database.enqueue_overdue_key_revocations)
+get_due_key_revocations = _awaitable(database.get_due_key_revocations)
+reschedule_key_revocation = _awaitable(database.reschedule_key_revocation)
+complete_key_revocations = _awaitable(database.complete_key_revocations)
+count_key_revocations = _awaitable(database.count_key_revocations)
+add_dead_letter_keys = _awaitable(database.add_dead_letter_keys)
+count_dead_letter_keys = _awaitable(database.count_dead_letter_keys)
+add_pooled_keys = _awaitable(database.add_pooled_keys)
+claim_pooled_keys = _awaitable(database.claim_pooled_keys)
+count_pooled_keys = _awaitable(database.count_pooled_keys)
+discard_stale_pooled_keys = _awaitable(database.discard_stale_pooled_keys)
+
+# --- vless_database.py (VLESS lookups used by the bot's handlers) ---
+get_user_subscription = _awaitable(vless_database.get_user_subscription)
+remove_vless_subscription = _awaitable(vless_database.remove_vless_subscription)
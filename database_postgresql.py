@@ -1,256 +1,863 @@
 import psycopg2
 import psycopg2.extras
+import contextvars
 import datetime
-from config import POSTGRES_URL, USE_POSTGRESQL
+import functools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from config import (
+    POSTGRES_URL, POSTGRES_REPLICA_URL, USE_POSTGRESQL, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT,
+    DB_POOL_MAX_LIFETIME, DB_POOL_HEALTH_CHECK_INTERVAL, DB_REPLICA_POOL_MAX_SIZE, DB_REPLICA_MAX_LAG_SECONDS,
+    DB_REPLICA_LAG_CHECK_INTERVAL, DB_REPLICA_RETRY_AFTER
+)
+from db_pool import PoolTimeout, PostgresConnectionPool
+from db_migrations import apply_migrations
+from db_rows import (
+    ActiveSubscription, AdminSubscription, ArchivedSubscription, ExpiringSubscription, KeyRevocation,
+    RenewalReminder, SubscriptionKey, SubscriptionSnapshot, group_subscription_rows, iter_cursor,
+    keyset_page
+)
 
-def get_connection():
-    """Get a PostgreSQL connection."""
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Return the process-wide PostgreSQL connection pool, creating it on first use."""
+    global _pool
     if not USE_POSTGRESQL:
         raise ValueError("PostgreSQL is not enabled in configuration")
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = PostgresConnectionPool(
+                    POSTGRES_URL,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    timeout=DB_POOL_TIMEOUT,
+                    max_lifetime=DB_POOL_MAX_LIFETIME,
+                    health_check_interval=DB_POOL_HEALTH_CHECK_INTERVAL,
+                )
+    return _pool
+
+logger = logging.getLogger(__name__)
+
+def open_session_connection():
+    """A dedicated connection outside the pool, for session state such as advisory locks."""
     return psycopg2.connect(POSTGRES_URL)
 
-def init_db():
-    """Initialize PostgreSQL database with all required tables."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    # Users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id BIGINT PRIMARY KEY,
-            username VARCHAR(255),
-            first_name VARCHAR(255),
-            join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Subscriptions table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS subscriptions (
-            id SERIAL PRIMARY KEY,
-            user_id BIGINT,
-            duration_plan_id VARCHAR(50),
-            country_package_id VARCHAR(50),
-            start_date TIMESTAMP,
-            end_date TIMESTAMP,
-            status VARCHAR(50) DEFAULT 'pending_payment',
-            payment_id VARCHAR(255),
-            FOREIGN KEY(user_id) REFERENCES users(user_id)
-        )
-    ''')
-    
-    # Subscription countries table - links subscriptions to countries and their VPN keys
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS subscription_countries (
-            id SERIAL PRIMARY KEY,
-            subscription_id INTEGER,
-            country_code VARCHAR(50),
-            outline_key_id VARCHAR(255),
-            outline_access_url TEXT,
-            FOREIGN KEY(subscription_id) REFERENCES subscriptions(id) ON DELETE CASCADE
-        )
-    ''')
-    
-    # Create indexes for better performance
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_user_id ON subscriptions(user_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_status ON subscriptions(status)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_end_date ON subscriptions(end_date)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_subscription_countries_subscription_id ON subscription_countries(subscription_id)')
-    
-    conn.commit()
-    conn.close()
-    print("PostgreSQL database initialized successfully.")
-
-def add_user_if_not_exists(user_id, username, first_name):
-    """Add a user if they don't already exist."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
-    if not cursor.fetchone():
-        cursor.execute("INSERT INTO users (user_id, username, first_name) VALUES (%s, %s, %s)",
-                       (user_id, username, first_name))
+# Query routing. Every query function runs on the primary unless it is tagged with @routed():
+PRIMARY = "primary"                    # writes, and reads that must see the very latest data
+READ_YOUR_WRITES = "read_your_writes"  # replica only once it has replayed the session's last write
+READ_ONLY = "read_only"                # replica unless it lags more than DB_REPLICA_MAX_LAG_SECONDS
+
+_replica_pool = None
+_route_local = threading.local()
+_replica_lock = threading.Lock()
+_lag_check_lock = threading.Lock()
+_replica_state = {
+    "checked_at": None,  # monotonic start of the last successful lag probe
+    "replay_lsn": None,  # WAL position (bytes) the replica had replayed at that probe; inf if it is not in recovery
+    "caught_up": False,
+    "lag_seconds": None,
+    "lag_bytes": None,
+    "down_until": 0.0,
+    "last_error": None,
+}
+_routing_stats = {"replica": 0, "primary": 0, "fallback_lag": 0, "fallback_error": 0}
+
+# Read-your-writes bookkeeping: the WAL position after the last write transaction of each
+# session (see set_session), and of the whole process for calls made outside a session
+_session = contextvars.ContextVar("db_session", default=None)
+_MAX_TRACKED_SESSIONS = 10000
+_session_lsns = OrderedDict()  # session key -> LSN of its last commit, oldest write first
+_forgotten_lsn = 0             # highest LSN of a session evicted from _session_lsns
+_process_lsn = 0
+
+def set_session(key):
+    """Tag the queries of the current context (e.g. one Telegram update) with a session key such as the user id."""
+    _session.set(key)
+
+def _connect_read_only(dsn):
+    return psycopg2.connect(dsn, options="-c default_transaction_read_only=on")
+
+def get_replica_pool():
+    """Return the read replica pool (POSTGRES_REPLICA_URL), creating it on first use."""
+    global _replica_pool
+    if not POSTGRES_REPLICA_URL:
+        raise ValueError("No read replica configured (POSTGRES_REPLICA_URL)")
+    if _replica_pool is None:
+        with _pool_lock:
+            if _replica_pool is None:
+                _replica_pool = PostgresConnectionPool(
+                    POSTGRES_REPLICA_URL,
+                    min_size=0,
+                    max_size=DB_REPLICA_POOL_MAX_SIZE,
+                    timeout=DB_POOL_TIMEOUT,
+                    max_lifetime=DB_POOL_MAX_LIFETIME,
+                    health_check_interval=DB_POOL_HEALTH_CHECK_INTERVAL,
+                    connect=_connect_read_only,
+                )
+    return _replica_pool
+
+@contextmanager
+def _write_connection():
+    with get_pool().connection() as conn:
+        yield conn
+        # Commit, then note the WAL position a replica must reach to show this write
         conn.commit()
-    conn.close()
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), '0/0')")
+        _record_commit_lsn(int(cursor.fetchone()[0]))
 
-def create_subscription_record(user_id, duration_plan_id, duration_days):
-    """Create a pending subscription record."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO subscriptions (user_id, duration_plan_id, status)
-        VALUES (%s, %s, 'pending_payment')
-        RETURNING id
-    ''', (user_id, duration_plan_id))
-    subscription_db_id = cursor.fetchone()[0]
-    conn.commit()
-    conn.close()
+def _record_commit_lsn(lsn):
+    global _process_lsn, _forgotten_lsn
+    key = _session.get()
+    with _replica_lock:
+        _process_lsn = max(_process_lsn, lsn)
+        if key is not None:
+            _session_lsns[key] = max(lsn, _session_lsns.pop(key, 0))
+            if len(_session_lsns) > _MAX_TRACKED_SESSIONS:
+                _forgotten_lsn = max(_forgotten_lsn, _session_lsns.popitem(last=False)[1])
+
+def _required_lsn():
+    """The WAL position a replica must have replayed for the current session to read its own writes."""
+    key = _session.get()
+    with _replica_lock:
+        if key is None:
+            return _process_lsn
+        return _session_lsns.get(key, _forgotten_lsn)
+
+def get_connection(write=False):
+    """Borrow a pooled PostgreSQL connection. Use as a context manager; commits on success.
+
+    Inside a @routed function that was sent to the replica, this is a read-only replica connection.
+    Pass `write=True` from functions that write, so read-your-writes routing learns their commit position.
+    """
+    if getattr(_route_local, "replica", False):
+        return get_replica_pool().connection()
+    if write and POSTGRES_REPLICA_URL:
+        return _write_connection()
+    return get_pool().connection()
+
+def _count_route(key):
+    with _replica_lock:
+        _routing_stats[key] += 1
+
+def _mark_replica_failed(error):
+    logger.warning(f"Read replica unavailable, using the primary for {DB_REPLICA_RETRY_AFTER:.0f}s: {error}")
+    with _replica_lock:
+        _replica_state["down_until"] = time.monotonic() + DB_REPLICA_RETRY_AFTER
+        _replica_state["last_error"] = str(error)
+        _routing_stats["fallback_error"] += 1
+
+def _probe_replica_lag():
+    """Compare the replica's replay position with the primary's current WAL position."""
+    started = time.monotonic()
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT pg_current_wal_lsn()")
+            primary_lsn = cursor.fetchone()[0]
+        with get_replica_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT pg_is_in_recovery(),
+                       COALESCE(pg_wal_lsn_diff(%s, pg_last_wal_replay_lsn()), 0),
+                       COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0),
+                       COALESCE(pg_wal_lsn_diff(pg_last_wal_replay_lsn(), '0/0'), 0)
+            ''', (primary_lsn,))
+            in_recovery, lag_bytes, replay_age, replay_lsn = cursor.fetchone()
+    except (psycopg2.Error, PoolTimeout) as e:
+        _mark_replica_failed(e)
+        return
+    caught_up = not in_recovery or lag_bytes <= 0
+    replay_lsn = int(replay_lsn) if in_recovery else float("inf")
+    with _replica_lock:
+        # Sessions whose last write the replica has replayed no longer need tracking
+        while _session_lsns and next(iter(_session_lsns.values())) <= replay_lsn:
+            _session_lsns.popitem(last=False)
+        _replica_state.update(
+            checked_at=started,
+            replay_lsn=replay_lsn,
+            caught_up=caught_up,
+            # Time since the last replayed transaction only means lag while WAL is still outstanding
+            lag_seconds=0.0 if caught_up else float(replay_age),
+            lag_bytes=max(0, int(lag_bytes)),
+        )
+
+def _use_replica(route):
+    """Decide whether a query tagged `route` may run on the replica right now."""
+    if route == PRIMARY or not POSTGRES_REPLICA_URL:
+        return False
+    now = time.monotonic()
+    with _replica_lock:
+        if now < _replica_state["down_until"]:
+            return False
+        checked_at = _replica_state["checked_at"]
+    if checked_at is None or now - checked_at > DB_REPLICA_LAG_CHECK_INTERVAL:
+        # One thread probes; the others route on the previous result
+        if _lag_check_lock.acquire(blocking=False):
+            try:
+                _probe_replica_lag()
+            finally:
+                _lag_check_lock.release()
+    with _replica_lock:
+        state = dict(_replica_state)
+    if time.monotonic() < state["down_until"] or state["checked_at"] is None:
+        return False
+    if route == READ_ONLY:
+        usable = state["lag_seconds"] <= DB_REPLICA_MAX_LAG_SECONDS
+    else:
+        # The replica had replayed the WAL up to this session's last commit
+        usable = state["replay_lsn"] >= _required_lsn()
+    if not usable:
+        _count_route("fallback_lag")
+    return usable
+
+def routed(route):
+    """Tag a read-only query function with where it may run (READ_ONLY or READ_YOUR_WRITES).
+
+    When the replica is unusable (lagging, or failing) the function runs on the
+    primary; a connection error on the replica retries it once on the primary.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # Restore the caller's routing afterwards: routed functions may call each other
+            previous = getattr(_route_local, "replica", False)
+            try:
+                if _use_replica(route):
+                    _route_local.replica = True
+                    try:
+                        result = func(*args, **kwargs)
+                        _count_route("replica")
+                        return result
+                    except (psycopg2.OperationalError, psycopg2.InterfaceError, PoolTimeout) as e:
+                        _mark_replica_failed(e)
+                _route_local.replica = False
+                _count_route("primary")
+                return func(*args, **kwargs)
+            finally:
+                _route_local.replica = previous
+        wrapper.route = route
+        return wrapper
+    return decorator
+
+def get_replica_stats():
+    """Replica pool usage, last lag probe and routing counters (None without a replica)."""
+    if not POSTGRES_REPLICA_URL:
+        return None
+    with _replica_lock:
+        stats = {"routing": dict(_routing_stats), **_replica_state}
+    stats["down"] = time.monotonic() < stats.pop("down_until")
+    stats.pop("checked_at")
+    stats.pop("replay_lsn")
+    with _replica_lock:
+        stats["tracked_sessions"] = len(_session_lsns)
+    stats["pool"] = _replica_pool.stats() if _replica_pool is not None else None
+    return stats
+
+def get_pool_stats():
+    """Return usage and wait statistics for the PostgreSQL pool (and the replica, if configured)."""
+    stats = get_pool().stats()
+    if POSTGRES_REPLICA_URL:
+        stats["replica"] = get_replica_stats()
+    return stats
+
+def close_pool():
+    """Close all pooled PostgreSQL connections."""
+    global _pool, _replica_pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close_all()
+            _pool = None
+        if _replica_pool is not None:
+            _replica_pool.close_all()
+            _replica_pool = None
+
+def init_db():
+    """Initialize PostgreSQL database with all required tables (versioned migrations, see db_migrations.py)."""
+    with get_connection(write=True) as conn:
+        applied = apply_migrations(conn, "core", "postgresql")
+    print(f"PostgreSQL database initialized successfully (applied migrations: {applied or 'none'}).")
+
+def upsert_users(rows):
+    """Insert or update (user_id, username, first_name) rows in one statement; unchanged rows are not rewritten."""
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        psycopg2.extras.execute_values(cursor, '''
+            INSERT INTO users (user_id, username, first_name) VALUES %s
+            ON CONFLICT (user_id) DO UPDATE
+            SET username = EXCLUDED.username, first_name = EXCLUDED.first_name
+            WHERE users.username IS DISTINCT FROM EXCLUDED.username
+               OR users.first_name IS DISTINCT FROM EXCLUDED.first_name
+        ''', rows)
+
+def iter_user_profiles(batch_size=5000):
+    """Stream (user_id, username, first_name) for every user, most recently joined last."""
+    with get_connection() as conn:
+        cursor = conn.cursor(name='user_profiles')
+        cursor.itersize = batch_size
+        cursor.execute("SELECT user_id, username, first_name FROM users ORDER BY join_date, user_id")
+        try:
+            yield from iter_cursor(cursor, batch_size)
+        finally:
+            cursor.close()
+
+def create_subscription_record(user_id, duration_plan_id, duration_days, created_at=None, subscription_db_id=None):
+    """Create a pending subscription record (under `subscription_db_id` when the id was assigned elsewhere)."""
+    created_at = created_at or datetime.datetime.utcnow()
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        if subscription_db_id is None:
+            cursor.execute('''
+                INSERT INTO subscriptions (user_id, duration_plan_id, status, created_at)
+                VALUES (%s, %s, 'pending_payment', %s)
+                RETURNING id
+            ''', (user_id, duration_plan_id, created_at))
+            return cursor.fetchone()[0]
+        cursor.execute('''
+            INSERT INTO subscriptions (id, user_id, duration_plan_id, status, created_at)
+            VALUES (%s, %s, %s, 'pending_payment', %s)
+        ''', (subscription_db_id, user_id, duration_plan_id, created_at))
     return subscription_db_id
 
 def update_subscription_country_package(subscription_id, country_package_id):
     """Update subscription with the selected country package."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE subscriptions
-        SET country_package_id = %s
-        WHERE id = %s
-    ''', (country_package_id, subscription_id))
-    conn.commit()
-    conn.close()
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE subscriptions
+            SET country_package_id = %s
+            WHERE id = %s
+        ''', (country_package_id, subscription_id))
 
 def add_subscription_country(subscription_id, country_code, outline_key_id, outline_access_url):
     """Add a country to a subscription with its VPN key."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO subscription_countries (subscription_id, country_code, outline_key_id, outline_access_url)
-        VALUES (%s, %s, %s, %s)
-    ''', (subscription_id, country_code, outline_key_id, outline_access_url))
-    conn.commit()
-    conn.close()
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO subscription_countries (subscription_id, country_code, outline_key_id, outline_access_url)
+            VALUES (%s, %s, %s, %s)
+        ''', (subscription_id, country_code, outline_key_id, outline_access_url))
 
-def activate_subscription(subscription_db_id, duration_days, payment_id="MANUAL_CRYPTO"):
+def activate_subscription(subscription_db_id, duration_days, payment_id="MANUAL_CRYPTO", start_date=None):
     """Activate a subscription with start and end dates."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    start_date = datetime.datetime.utcnow()
-    end_date = start_date + datetime.timedelta(days=duration_days)
-    cursor.execute('''
-        UPDATE subscriptions
-        SET start_date = %s, end_date = %s, status = 'active', payment_id = %s
-        WHERE id = %s
-    ''', (start_date, end_date, payment_id, subscription_db_id))
-    conn.commit()
-    conn.close()
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        start_date = start_date or datetime.datetime.utcnow()
+        end_date = start_date + datetime.timedelta(days=duration_days)
+        cursor.execute('''
+            UPDATE subscriptions
+            SET start_date = %s, end_date = %s, status = 'active', payment_id = %s,
+                reminder_stage = 0, reminder_sent_at = NULL
+            WHERE id = %s
+        ''', (start_date, end_date, payment_id, subscription_db_id))
     print(f"Subscription {subscription_db_id} activated. Ends on {end_date}")
 
+def provision_subscription(subscription_id, country_package_id, keys, duration_days, payment_id="MANUAL_CRYPTO",
+                           start_date=None):
+    """Store the package, all country keys and the activation in one statement and one transaction.
+
+    `keys` is a list of (country_code, outline_key_id, outline_access_url). Raises ValueError if the
+    subscription does not exist.
+    """
+    start_date = start_date or datetime.datetime.utcnow()
+    end_date = start_date + datetime.timedelta(days=duration_days)
+    values = ', '.join(['(%s, %s, %s)'] * len(keys))
+    params = [country_package_id, start_date, end_date, payment_id, subscription_id]
+    for key in keys:
+        params.extend(key)
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            WITH activated AS (
+                UPDATE subscriptions
+                SET country_package_id = %s, start_date = %s, end_date = %s, status = 'active', payment_id = %s,
+                    reminder_stage = 0, reminder_sent_at = NULL
+                WHERE id = %s
+                RETURNING id
+            )
+            INSERT INTO subscription_countries (subscription_id, country_code, outline_key_id, outline_access_url)
+            SELECT activated.id, k.country_code, k.outline_key_id, k.outline_access_url
+            FROM activated, (VALUES {values}) AS k(country_code, outline_key_id, outline_access_url)
+        ''', params)
+        # No key rows inserted means the UPDATE matched no subscription
+        if cursor.rowcount == 0:
+            raise ValueError(f"Subscription {subscription_id} not found")
+    print(f"Subscription {subscription_id} provisioned with {len(keys)} key(s). Ends on {end_date}")
+    return end_date
+
+@routed(READ_YOUR_WRITES)
 def get_active_subscriptions(user_id):
     """Get all active subscriptions for a user."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT s.id, s.duration_plan_id, s.country_package_id, s.end_date, s.status,
-               STRING_AGG(sc.country_code, ',') as countries,
-               STRING_AGG(sc.outline_access_url, ',') as access_urls
-        FROM subscriptions s
-        LEFT JOIN subscription_countries sc ON s.id = sc.subscription_id
-        WHERE s.user_id = %s AND s.status = 'active' AND s.end_date > CURRENT_TIMESTAMP
-        GROUP BY s.id, s.duration_plan_id, s.country_package_id, s.end_date, s.status
-        ORDER BY s.end_date DESC
-    ''', (user_id,))
-    subs = cursor.fetchall()
-    conn.close()
-    return subs
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT s.id, s.duration_plan_id, s.country_package_id, s.end_date, s.status,
+                   sc.country_code, sc.outline_key_id, sc.outline_access_url
+            FROM subscriptions s
+            LEFT JOIN subscription_countries sc ON s.id = sc.subscription_id
+            WHERE s.user_id = %s AND s.status = 'active' AND s.end_date > CURRENT_TIMESTAMP
+            ORDER BY s.end_date DESC, s.id, sc.id
+        ''', (user_id,))
+        return list(group_subscription_rows(cursor.fetchall(), ActiveSubscription))
 
+@routed(READ_YOUR_WRITES)
 def get_subscription_countries(subscription_id):
     """Get all countries and their VPN keys for a specific subscription."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT country_code, outline_key_id, outline_access_url
-        FROM subscription_countries
-        WHERE subscription_id = %s
-    ''', (subscription_id,))
-    countries = cursor.fetchall()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT country_code, outline_key_id, outline_access_url
+            FROM subscription_countries
+            WHERE subscription_id = %s
+        ''', (subscription_id,))
+        countries = cursor.fetchall()
     return countries
 
 def get_expired_soon_or_active_subscriptions():
     """Gets subscriptions that are active or will expire soon (for checking)."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT s.id, s.user_id, s.status, s.end_date,
-               STRING_AGG(sc.outline_key_id, ',') as key_ids,
-               STRING_AGG(sc.country_code, ',') as countries
-        FROM subscriptions s
-        LEFT JOIN subscription_countries sc ON s.id = sc.subscription_id
-        WHERE s.status = 'active'
-        GROUP BY s.id, s.user_id, s.status, s.end_date
-    ''')
-    subs = cursor.fetchall()
-    conn.close()
-    return subs
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT s.id, s.user_id, s.status, s.end_date,
+                   sc.country_code, sc.outline_key_id, sc.outline_access_url
+            FROM subscriptions s
+            LEFT JOIN subscription_countries sc ON s.id = sc.subscription_id
+            WHERE s.status = 'active'
+            ORDER BY s.id, sc.id
+        ''')
+        return list(group_subscription_rows(cursor.fetchall(), ExpiringSubscription))
+
+def iter_subscriptions_in_expiry_window(window_start, window_end, batch_size=500):
+    """Stream active subscriptions whose end_date falls in [window_start, window_end] (not yet queued for revocation).
+
+    Uses a server-side (named) cursor so only `batch_size` rows are held in memory at a time.
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor(name='expiry_window')
+        cursor.itersize = batch_size
+        cursor.execute('''
+            SELECT s.id, s.user_id, s.status, s.end_date, s.duration_plan_id,
+                   sc.country_code, sc.outline_key_id, sc.outline_access_url
+            FROM subscriptions s
+            LEFT JOIN subscription_countries sc ON s.id = sc.subscription_id
+            WHERE s.status = 'active' AND s.end_date BETWEEN %s AND %s
+              AND NOT EXISTS (SELECT 1 FROM key_revocations r WHERE r.subscription_id = s.id)
+            ORDER BY s.end_date, s.id, sc.id
+        ''', (window_start, window_end))
+        try:
+            yield from group_subscription_rows(iter_cursor(cursor, batch_size), ExpiringSubscription)
+        finally:
+            cursor.close()
+
+def iter_active_subscription_end_dates(batch_size=500):
+    """Stream (id, end_date) of every active subscription not yet queued for key revocation."""
+    with get_connection() as conn:
+        cursor = conn.cursor(name='active_end_dates')
+        cursor.itersize = batch_size
+        cursor.execute('''
+            SELECT s.id, s.end_date FROM subscriptions s
+            WHERE s.status = 'active' AND s.end_date IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM key_revocations r WHERE r.subscription_id = s.id)
+        ''')
+        try:
+            yield from iter_cursor(cursor, batch_size)
+        finally:
+            cursor.close()
 
 def mark_subscription_expired(subscription_id):
     """Mark a subscription as expired."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE subscriptions SET status = 'expired' WHERE id = %s", (subscription_id,))
-    conn.commit()
-    conn.close()
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE subscriptions SET status = 'expired' WHERE id = %s", (subscription_id,))
     print(f"Subscription {subscription_id} marked as expired in DB.")
 
+def claim_renewal_reminders(stage, now, end_before, limit):
+    """Claim active subscriptions ending in (now, end_before] that are due for reminder `stage` (PostgreSQL)."""
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            WITH due AS (
+                SELECT id, reminder_stage, reminder_sent_at FROM subscriptions
+                WHERE status = 'active' AND end_date > %s AND end_date <= %s AND reminder_stage < %s
+                ORDER BY end_date
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE subscriptions s SET reminder_stage = %s, reminder_sent_at = %s
+            FROM due WHERE s.id = due.id
+            RETURNING s.id, s.user_id, s.end_date, s.reminder_stage, due.reminder_stage, due.reminder_sent_at
+        ''', (now, end_before, stage, limit, stage, now))
+        return sorted((RenewalReminder(*row) for row in cursor.fetchall()), key=lambda reminder: reminder.end_date)
+
+def mark_renewal_reminders(subscription_ids, stage, sent_at):
+    """Record reminder `stage` as sent on specific subscriptions (PostgreSQL)."""
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE subscriptions SET reminder_stage = %s, reminder_sent_at = %s
+            WHERE id = ANY(%s)
+        ''', (stage, sent_at, list(subscription_ids)))
+
+def release_renewal_reminder(subscription_id, stage, previous_stage, previous_sent_at):
+    """Undo the claim of reminder `stage` unless the subscription moved on since (PostgreSQL)."""
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE subscriptions SET reminder_stage = %s, reminder_sent_at = %s
+            WHERE id = %s AND reminder_stage = %s
+        ''', (previous_stage, previous_sent_at, subscription_id, stage))
+
+@routed(READ_ONLY)
 def get_all_active_subscriptions_for_admin():
     """Gets all active or recently expired subscriptions for admin view."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT s.id, s.user_id, u.username, u.first_name, s.duration_plan_id, s.country_package_id, s.end_date, s.status,
-               STRING_AGG(sc.country_code, ',') as countries
-        FROM subscriptions s
-        JOIN users u ON s.user_id = u.user_id
-        LEFT JOIN subscription_countries sc ON s.id = sc.subscription_id
-        WHERE s.status IN ('active', 'pending_payment', 'expired')
-        GROUP BY s.id, s.user_id, u.username, u.first_name, s.duration_plan_id, s.country_package_id, s.end_date, s.status
-        ORDER BY s.user_id, s.end_date DESC
-    ''')
-    subs = cursor.fetchall()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT s.id, s.user_id, u.username, u.first_name, s.duration_plan_id, s.country_package_id, s.end_date, s.status,
+                   STRING_AGG(sc.country_code, ',') as countries
+            FROM subscriptions s
+            JOIN users u ON s.user_id = u.user_id
+            LEFT JOIN subscription_countries sc ON s.id = sc.subscription_id
+            WHERE s.status IN ('active', 'pending_payment', 'expired')
+            GROUP BY s.id, s.user_id, u.username, u.first_name, s.duration_plan_id, s.country_package_id, s.end_date, s.status
+            ORDER BY s.user_id, s.end_date DESC
+        ''')
+        subs = cursor.fetchall()
     return subs
 
+@routed(READ_ONLY)
+def get_admin_subscriptions_page(after, limit, statuses):
+    """Get one keyset-paginated page of subscriptions for the admin view; returns (rows, next_cursor)."""
+    params = [tuple(statuses)]
+    keyset = ''
+    if after is not None:
+        after_user_id, after_end_date, after_id = after
+        # NULL end dates (pending payments) sort last within a user
+        keyset = '''AND s.user_id >= %s AND (s.user_id > %s OR (s.user_id = %s AND (
+                        COALESCE(s.end_date, '-infinity'::timestamp) < COALESCE(%s::timestamp, '-infinity'::timestamp)
+                        OR (COALESCE(s.end_date, '-infinity'::timestamp) = COALESCE(%s::timestamp, '-infinity'::timestamp)
+                            AND s.id < %s))))'''
+        params += [after_user_id, after_user_id, after_user_id, after_end_date, after_end_date, after_id]
+    params.append(limit + 1)
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT s.id, s.user_id, u.username, u.first_name, s.duration_plan_id, s.country_package_id, s.end_date, s.status,
+                   (SELECT STRING_AGG(sc.country_code, ',') FROM subscription_countries sc
+                    WHERE sc.subscription_id = s.id) as countries
+            FROM subscriptions s
+            JOIN users u ON s.user_id = u.user_id
+            WHERE s.status IN %s {keyset}
+            ORDER BY s.user_id, COALESCE(s.end_date, '-infinity'::timestamp) DESC, s.id DESC
+            LIMIT %s
+        ''', params)
+        rows = cursor.fetchall()
+    return keyset_page(rows, limit)
+
+@routed(READ_ONLY)
+def count_admin_subscriptions(statuses):
+    """Count the subscriptions shown in the admin view."""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM subscriptions WHERE status IN %s", (tuple(statuses),))
+        return cursor.fetchone()[0]
+
+@routed(READ_YOUR_WRITES)
 def get_subscription_by_id(subscription_id):
     """Get subscription details by ID."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, user_id, duration_plan_id, country_package_id, start_date, end_date, status, payment_id
-        FROM subscriptions
-        WHERE id = %s
-    ''', (subscription_id,))
-    sub = cursor.fetchone()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, user_id, duration_plan_id, country_package_id, start_date, end_date, status, payment_id
+            FROM subscriptions
+            WHERE id = %s
+        ''', (subscription_id,))
+        sub = cursor.fetchone()
     return sub
 
+@routed(READ_YOUR_WRITES)
 def get_subscription_for_admin(subscription_id):
     """Get subscription details by ID in the format expected by admin functions."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT s.id, s.user_id, s.status,
-               STRING_AGG(sc.outline_key_id, ',') as key_ids,
-               STRING_AGG(sc.country_code, ',') as countries
-        FROM subscriptions s
-        LEFT JOIN subscription_countries sc ON s.id = sc.subscription_id
-        WHERE s.id = %s
-        GROUP BY s.id, s.user_id, s.status
-    ''', (subscription_id,))
-    sub = cursor.fetchone()
-    conn.close()
-    return sub
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT s.id, s.user_id, s.status,
+                   sc.country_code, sc.outline_key_id, sc.outline_access_url
+            FROM subscriptions s
+            LEFT JOIN subscription_countries sc ON s.id = sc.subscription_id
+            WHERE s.id = %s
+            ORDER BY sc.id
+        ''', (subscription_id,))
+        return next(group_subscription_rows(cursor.fetchall(), AdminSubscription), None)
 
 def cancel_subscription_by_admin(subscription_db_id):
     """Cancel a subscription by admin."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE subscriptions SET status = 'cancelled_by_admin' WHERE id = %s", (subscription_db_id,))
-    conn.commit()
-    updated_rows = cursor.rowcount
-    conn.close()
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE subscriptions SET status = 'cancelled_by_admin' WHERE id = %s", (subscription_db_id,))
+        updated_rows = cursor.rowcount
     print(f"Subscription {subscription_db_id} marked as 'cancelled_by_admin' in DB.")
     return updated_rows > 0
 
 def renew_subscription(subscription_id, user_id, new_end_date, payment_id):
     """Renew a subscription by updating its end_date, status, and payment_id (PostgreSQL)."""
-    conn = get_connection()
-    cursor = conn.cursor()
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE subscriptions
+            SET end_date = %s, status = 'active', payment_id = %s, reminder_stage = 0, reminder_sent_at = NULL
+            WHERE id = %s AND user_id = %s
+        ''', (new_end_date, payment_id, subscription_id, user_id))
+
+def archive_subscriptions_batch(pending_cutoff, ended_cutoff, statuses, batch_size):
+    """Move one batch of archivable subscriptions and their countries to the archive tables (PostgreSQL).
+
+    Returns ([(id, user_id)], number of countries moved).
+    """
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        # FOR UPDATE keeps the rows from being renewed (and new countries from being added) meanwhile;
+        # SKIP LOCKED lets a second archiver take the next batch instead of waiting
+        cursor.execute('''
+            SELECT id, user_id FROM subscriptions
+            WHERE (status = 'pending_payment' AND created_at < %s)
+               OR (status = ANY(%s) AND COALESCE(end_date, created_at) < %s)
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        ''', (pending_cutoff, list(statuses), ended_cutoff, batch_size))
+        moved = cursor.fetchall()
+        if not moved:
+            return [], 0
+        ids = [subscription_id for subscription_id, _ in moved]
+        cursor.execute('''
+            INSERT INTO subscription_countries_archive
+                (id, subscription_id, country_code, outline_key_id, outline_access_url)
+            SELECT id, subscription_id, country_code, outline_key_id, outline_access_url
+            FROM subscription_countries WHERE subscription_id = ANY(%s)
+            ON CONFLICT (id) DO NOTHING
+        ''', (ids,))
+        moved_countries = cursor.rowcount
+        cursor.execute('''
+            INSERT INTO subscriptions_archive
+                (id, user_id, duration_plan_id, country_package_id, start_date, end_date, status, payment_id, created_at)
+            SELECT id, user_id, duration_plan_id, country_package_id, start_date, end_date, status, payment_id, created_at
+            FROM subscriptions WHERE id = ANY(%s)
+            ON CONFLICT (id) DO NOTHING
+        ''', (ids,))
+        cursor.execute("DELETE FROM subscription_countries WHERE subscription_id = ANY(%s)", (ids,))
+        cursor.execute("DELETE FROM subscriptions WHERE id = ANY(%s)", (ids,))
+    return moved, moved_countries
+
+def enqueue_key_revocation(subscription_id, user_id, due_at):
+    """Queue an expired subscription's keys for deletion; True if it was not queued yet (PostgreSQL)."""
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO key_revocations (subscription_id, user_id, due_at)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (subscription_id) DO NOTHING
+        ''', (subscription_id, user_id, due_at))
+        return cursor.rowcount > 0
+
+def enqueue_overdue_key_revocations(expired_before, due_at):
+    """Queue still-active subscriptions that expired before `expired_before`; returns how many (PostgreSQL)."""
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO key_revocations (subscription_id, user_id, due_at)
+            SELECT id, user_id, %s FROM subscriptions
+            WHERE status = 'active' AND end_date <= %s
+            ON CONFLICT (subscription_id) DO NOTHING
+        ''', (due_at, expired_before))
+        return cursor.rowcount
+
+def get_due_key_revocations(now, limit):
+    """Drop renewed entries, then return up to `limit` due revocations as KeyRevocation rows (PostgreSQL)."""
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        _drop_renewed_key_revocations(cursor, now)
+        cursor.execute('''
+            SELECT r.subscription_id, r.user_id, r.attempts, r.pending_keys,
+                   sc.country_code, sc.outline_key_id, sc.outline_access_url
+            FROM (SELECT * FROM key_revocations WHERE due_at <= %s ORDER BY due_at, subscription_id LIMIT %s) r
+            LEFT JOIN subscription_countries sc ON r.subscription_id = sc.subscription_id
+            ORDER BY r.due_at, r.subscription_id, sc.id
+        ''', (now, limit))
+        return list(group_subscription_rows(cursor.fetchall(), KeyRevocation))
+
+def drop_renewed_key_revocations(now):
+    """Dequeue due entries whose subscription is no longer an expired active one (PostgreSQL)."""
+    with get_connection(write=True) as conn:
+        _drop_renewed_key_revocations(conn.cursor(), now)
+
+def _drop_renewed_key_revocations(cursor, now):
     cursor.execute('''
-        UPDATE subscriptions
-        SET end_date = %s, status = 'active', payment_id = %s
-        WHERE id = %s AND user_id = %s
-    ''', (new_end_date, payment_id, subscription_id, user_id))
-    conn.commit()
-    conn.close()
+        DELETE FROM key_revocations r
+        WHERE r.due_at <= %s AND NOT EXISTS (
+            SELECT 1 FROM subscriptions s
+            WHERE s.id = r.subscription_id AND s.status = 'active' AND s.end_date <= %s
+        )
+    ''', (now, now))
+    if cursor.rowcount:
+        print(f"Key revocation: dropped {cursor.rowcount} renewed or finished subscription(s) from the queue")
+
+def reschedule_key_revocation(subscription_id, due_at, pending_keys, error):
+    """Retry a partially failed revocation later, for the keys in `pending_keys` (PostgreSQL)."""
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE key_revocations
+            SET due_at = %s, pending_keys = %s, last_error = %s, attempts = attempts + 1
+            WHERE subscription_id = %s
+        ''', (due_at, pending_keys, error, subscription_id))
+
+def complete_key_revocations(subscription_ids, now):
+    """Mark finished revocations' subscriptions expired and dequeue them, in one transaction (PostgreSQL)."""
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE subscriptions SET status = 'expired'
+            WHERE id = ANY(%s) AND status = 'active' AND end_date <= %s
+        ''', (list(subscription_ids), now))
+        cursor.execute("DELETE FROM key_revocations WHERE subscription_id = ANY(%s)", (list(subscription_ids),))
+
+def count_key_revocations(now):
+    """Return (queued, due) sizes of the key revocation queue (PostgreSQL)."""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*), COUNT(*) FILTER (WHERE due_at <= %s) FROM key_revocations", (now,))
+        return tuple(cursor.fetchone())
+
+def add_dead_letter_keys(subscription_id, entries, source, created_at):
+    """Record undeletable keys, (country_code, key_id, error) each; already recorded keys are kept (PostgreSQL)."""
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        psycopg2.extras.execute_values(cursor, '''
+            INSERT INTO key_dead_letters
+                (subscription_id, country_code, outline_key_id, source, last_error, created_at)
+            VALUES %s
+            ON CONFLICT (country_code, outline_key_id) DO NOTHING
+        ''', [(subscription_id, country, key_id, source, error, created_at) for country, key_id, error in entries])
+    print(f"Dead-lettered {len(entries)} undeletable key(s) of subscription {subscription_id} ({source})")
+
+@routed(READ_ONLY)
+def count_dead_letter_keys():
+    """Number of recorded keys that could not be deleted (PostgreSQL)."""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM key_dead_letters")
+        return cursor.fetchone()[0]
+
+def add_pooled_keys(keys, created_at):
+    """Add unassigned keys, (country_code, server_id, key_id, access_url) each, to the key pool (PostgreSQL)."""
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        psycopg2.extras.execute_values(cursor, '''
+            INSERT INTO key_pool (country_code, server_id, outline_key_id, outline_access_url, created_at)
+            VALUES %s
+            ON CONFLICT (country_code, server_id, outline_key_id) DO NOTHING
+        ''', [(country, server_id, str(key_id), access_url, created_at)
+              for country, server_id, key_id, access_url in keys])
+
+def claim_pooled_keys(servers):
+    """Take and remove the oldest pooled key of every (country_code, server_id) in one statement (PostgreSQL).
+
+    SKIP LOCKED lets concurrent activations each take a different key
+    instead of queueing behind the same row.
+    """
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            DELETE FROM key_pool WHERE id IN (
+                SELECT p.id
+                FROM unnest(%s::text[], %s::text[]) AS s(country_code, server_id)
+                CROSS JOIN LATERAL (
+                    SELECT id FROM key_pool
+                    WHERE key_pool.country_code = s.country_code AND key_pool.server_id = s.server_id
+                    ORDER BY created_at, outline_key_id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                ) p
+            )
+            RETURNING country_code, outline_key_id, outline_access_url
+        ''', ([country for country, _ in servers], [server_id for _, server_id in servers]))
+        return [SubscriptionKey(*row) for row in cursor.fetchall()]
+
+def remove_pooled_keys(keys):
+    """Remove specific pooled keys, (country_code, outline_key_id) each (PostgreSQL)."""
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            DELETE FROM key_pool p
+            USING unnest(%s::text[], %s::text[]) AS k(country_code, outline_key_id)
+            WHERE p.country_code = k.country_code AND p.outline_key_id = k.outline_key_id
+        ''', ([country for country, _ in keys], [key_id for _, key_id in keys]))
+
+@routed(READ_ONLY)
+def count_pooled_keys():
+    """Unassigned keys per (country_code, server_id) (PostgreSQL)."""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT country_code, server_id, COUNT(*) FROM key_pool GROUP BY country_code, server_id")
+        return {(country, server_id): count for country, server_id, count in cursor.fetchall()}
+
+def discard_stale_pooled_keys(servers):
+    """Remove and return the pooled keys that belong to a previous server of their country (PostgreSQL)."""
+    with get_connection(write=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            DELETE FROM key_pool p
+            USING unnest(%s::text[], %s::text[]) AS s(country_code, server_id)
+            WHERE p.country_code = s.country_code AND p.server_id <> s.server_id
+            RETURNING p.country_code, p.outline_key_id, p.outline_access_url
+        ''', (list(servers), list(servers.values())))
+        return [SubscriptionKey(*row) for row in cursor.fetchall()]
+
+@routed(READ_ONLY)
+def get_archived_subscriptions(user_id, limit=20):
+    """Get a user's archived subscriptions, newest first, as ArchivedSubscription rows (PostgreSQL)."""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT s.id, s.duration_plan_id, s.country_package_id, s.start_date, s.end_date, s.status, s.archived_at,
+                   sc.country_code, sc.outline_key_id, sc.outline_access_url
+            FROM (SELECT * FROM subscriptions_archive WHERE user_id = %s ORDER BY id DESC LIMIT %s) s
+            LEFT JOIN subscription_countries_archive sc ON s.id = sc.subscription_id
+            ORDER BY s.id DESC, sc.id
+        ''', (user_id, limit))
+        return list(group_subscription_rows(cursor.fetchall(), ArchivedSubscription, date_index=(3, 4, 6)))
+
+def get_users_after(after_user_id, limit):
+    """Users with user_id > after_user_id in key order, for the dual-write consistency checker (PostgreSQL)."""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT user_id, username, first_name FROM users
+            WHERE (%s IS NULL OR user_id > %s)
+            ORDER BY user_id
+            LIMIT %s
+        ''', (after_user_id, after_user_id, limit))
+        return cursor.fetchall()
+
+def get_subscription_snapshots_after(after_id, limit):
+    """Full subscription rows with their keys after `after_id`, for the consistency checker (PostgreSQL)."""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT s.id, s.user_id, s.duration_plan_id, s.country_package_id, s.start_date, s.end_date, s.status,
+                   s.payment_id, s.created_at, sc.country_code, sc.outline_key_id, sc.outline_access_url
+            FROM (SELECT * FROM subscriptions WHERE (%s IS NULL OR id > %s) ORDER BY id LIMIT %s) s
+            LEFT JOIN subscription_countries sc ON s.id = sc.subscription_id
+            ORDER BY s.id, sc.id
+        ''', (after_id, after_id, limit))
+        return list(group_subscription_rows(cursor.fetchall(), SubscriptionSnapshot, date_index=(4, 5, 8)))
 
 if __name__ == '__main__':
     init_db()  # Initialize DB when script is run directly
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Read-through TTL/LRU caches for the hottest per-user lookups, and the set of users known to have a row.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+
+import stats_registry
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _register(cache):
+    with _registry_lock:
+        _registry.append(cache)
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, name, ttl=60, max_entries=10000):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # key -> (expires_at, value), most recently used on the right
+        self._lock = threading.Lock()
+        # key -> [version, loads in flight], only while a key is being loaded. Invalidating the
+        # key bumps its version, so a load that raced with a write to that key is not stored
+        self._loading = {}
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+        _register(self)
+
+    def get_or_load(self, key, loader):
+        """Return the cached value for `key`, calling `loader()` and caching its result on a miss."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._data.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return value
+                del self._data[key]
+                self._stats["expirations"] += 1
+            self._stats["misses"] += 1
+            loading = self._loading.setdefault(key, [0, 0])
+            loading[1] += 1
+            version = loading[0]
+
+        try:
+            value = loader()
+        except BaseException:
+            with self._lock:
+                self._done_loading(key)
+            raise
+
+        with self._lock:
+            if self._loading[key][0] == version:
+                self._data[key] = (time.monotonic() + self.ttl, value)
+                self._data.move_to_end(key)
+                while len(self._data) > self.max_entries:
+                    self._data.popitem(last=False)
+                    self._stats["evictions"] += 1
+            self._done_loading(key)
+        return value
+
+    def _done_loading(self, key):
+        loading = self._loading[key]
+        loading[1] -= 1
+        if not loading[1]:
+            del self._loading[key]
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._loading:
+                self._loading[key][0] += 1
+            self._data.pop(key, None)
+            self._stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            for loading in self._loading.values():
+                loading[0] += 1
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._data)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        return stats
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over integer keys (no false negatives)."""
+
+    def __init__(self, expected_items, false_positive_rate=0.01):
+        expected_items = max(1, expected_items)
+        self.num_bits = max(8, int(-expected_items * math.log(false_positive_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / expected_items * math.log(2)))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    @staticmethod
+    def _mix(x):
+        # splitmix64 finalizer
+        x = (x + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        return x ^ (x >> 31)
+
+    def _positions(self, key):
+        h1 = self._mix(key)
+        h2 = self._mix(h1) | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class KnownUserSet:
+    """Users known to have a `users` row: a Bloom filter of ids plus an LRU of their last seen profile.
+
+    `observe()` decides whether a /start needs a synchronous write. Profile
+    changes, and users that are only "probably known" (Bloom hit, LRU miss),
+    are queued and written later in one batched upsert. A Bloom false positive
+    is therefore still inserted, just a flush later.
+    """
+
+    def __init__(self, name, expected_users, false_positive_rate, lru_size):
+        self.name = name
+        self._bloom = BloomFilter(expected_users, false_positive_rate)
+        self._profiles = OrderedDict()  # user_id -> (username, first_name)
+        self._lru_size = lru_size
+        self._pending = {}  # user_id -> (username, first_name) awaiting the next flush
+        self._lock = threading.Lock()
+        self._stats = {"known": 0, "probably_known": 0, "new": 0, "profile_changes": 0, "flushed": 0}
+        _register(self)
+
+    def _remember(self, user_id, profile):
+        self._profiles[user_id] = profile
+        self._profiles.move_to_end(user_id)
+        while len(self._profiles) > self._lru_size:
+            self._profiles.popitem(last=False)
+
+    def observe(self, user_id, username, first_name):
+        """Return True if no synchronous write is needed for this user (any update was queued)."""
+        profile = (username, first_name)
+        with self._lock:
+            cached = self._profiles.get(user_id)
+            if cached is not None:
+                self._profiles.move_to_end(user_id)
+                if cached == profile:
+                    self._stats["known"] += 1
+                else:
+                    self._stats["profile_changes"] += 1
+                    self._pending[user_id] = profile
+                    self._remember(user_id, profile)
+                return True
+            if user_id in self._bloom:
+                self._stats["probably_known"] += 1
+                self._pending[user_id] = profile
+                self._remember(user_id, profile)
+                return True
+            self._stats["new"] += 1
+            return False
+
+    def add(self, user_id, username, first_name):
+        """Record a user whose row is known to be written."""
+        with self._lock:
+            if user_id not in self._bloom:
+                self._bloom.add(user_id)
+            self._remember(user_id, (username, first_name))
+
+    def take_pending(self, user_id=None):
+        """Remove and return queued upserts as [(user_id, username, first_name)], for one user or all."""
+        with self._lock:
+            if user_id is not None:
+                profile = self._pending.pop(user_id, None)
+                return [(user_id, *profile)] if profile else []
+            pending, self._pending = self._pending, {}
+        return [(uid, username, first_name) for uid, (username, first_name) in pending.items()]
+
+    def requeue(self, rows):
+        """Put rows back after a failed flush (newer queued profiles win)."""
+        with self._lock:
+            for user_id, username, first_name in rows:
+                self._pending.setdefault(user_id, (username, first_name))
+
+    def mark_flushed(self, count):
+        with self._lock:
+            self._stats["flushed"] += count
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["bloom_items"] = self._bloom.count
+            stats["bloom_bits"] = self._bloom.num_bits
+            stats["lru_size"] = len(self._profiles)
+            stats["pending"] = len(self._pending)
+        return stats
+
+
+def get_cache_stats():
+    """Return the counters of every cache created in this process, keyed by cache name."""
+    with _registry_lock:
+        caches = list(_registry)
+    return {cache.name: cache.stats() for cache in caches}
+
+
+stats_registry.register("db_cache", get_cache_stats)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Dual-write and shadow-read support for moving between the SQLite and PostgreSQL backends under live traffic.
+"""
+
+import datetime
+import logging
+import random
+import re
+import threading
+
+from db_rows import to_datetime
+
+logger = logging.getLogger(__name__)
+
+_TIMESTAMP = re.compile(r"^\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}")
+# Divergent rows/ids listed per log line
+_MAX_LOGGED = 10
+
+
+def normalize(value):
+    """Make a result comparable across backends (SQLite returns timestamps as text, PostgreSQL as datetime)."""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(sep=" ")
+    if isinstance(value, str) and _TIMESTAMP.match(value):
+        try:
+            return to_datetime(value).isoformat(sep=" ")
+        except ValueError:
+            return value
+    if isinstance(value, (tuple, list)):
+        return tuple(normalize(item) for item in value)
+    return value
+
+
+def _short(value, limit=300):
+    text = repr(value)
+    return text if len(text) <= limit else text[:limit] + "..."
+
+
+class DualWriteMonitor:
+    """Replays writes on the shadow backend and compares sampled reads; keeps counters for /status."""
+
+    def __init__(self, primary, shadow, shadow_read_rate=0.0):
+        self.primary = primary
+        self.shadow = shadow
+        self.shadow_read_rate = shadow_read_rate
+        self._lock = threading.Lock()
+        self._stats = {
+            "shadow_writes": 0,
+            "shadow_write_failures": 0,
+            "shadow_reads": 0,
+            "shadow_read_failures": 0,
+            "read_divergences": 0,
+        }
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def replay_write(self, name, func, *args):
+        """Apply a write that already succeeded on the primary to the shadow."""
+        try:
+            func(*args)
+        except Exception as e:
+            self._count("shadow_write_failures")
+            logger.error(f"Dual write: {name} failed on shadow backend {self.shadow}: {e}")
+            return
+        self._count("shadow_writes")
+
+    def shadow_read(self, name, primary_result, func, *args):
+        """Repeat a sampled read on the shadow and log it if the result differs from the primary's."""
+        if self.shadow_read_rate <= 0 or random.random() >= self.shadow_read_rate:
+            return
+        try:
+            shadow_result = func(*args)
+        except Exception as e:
+            self._count("shadow_read_failures")
+            logger.error(f"Dual write: shadow read {name} failed on {self.shadow}: {e}")
+            return
+        self._count("shadow_reads")
+        if normalize(primary_result) != normalize(shadow_result):
+            self._count("read_divergences")
+            logger.warning(
+                f"Dual write: {name}{_short(args)} diverged: "
+                f"{self.primary}={_short(primary_result)} {self.shadow}={_short(shadow_result)}"
+            )
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["primary"] = self.primary
+        stats["shadow"] = self.shadow
+        stats["shadow_read_rate"] = self.shadow_read_rate
+        return stats
+
+
+class ConsistencyChecker:
+    """Incrementally diffs one table between the two backends, a key range per call.
+
+    The fetch functions take (after_key, limit) and return up to `limit` rows
+    with key > after_key (all rows from the start if after_key is None),
+    ordered by key. The key is the first column.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self._cursor = None
+        self._lock = threading.Lock()
+        self._stats = {"checked": 0, "missing_in_shadow": 0, "missing_in_primary": 0, "mismatched": 0,
+                       "passes": 0, "last_pass_clean": None}
+        self._pass_clean = True
+
+    def check_next(self, fetch_primary, fetch_shadow, batch_size):
+        """Compare the next key range. Returns this batch's findings as a dict."""
+        with self._lock:
+            after = self._cursor
+            primary_rows = fetch_primary(after, batch_size)
+            shadow_rows = fetch_shadow(after, batch_size)
+
+            # Only keys both sides have fully covered can be compared: stop at the smaller
+            # last key of a full batch
+            upper = None
+            for rows in (primary_rows, shadow_rows):
+                if len(rows) >= batch_size:
+                    last_key = rows[-1][0]
+                    upper = last_key if upper is None else min(upper, last_key)
+            primary = {row[0]: row for row in primary_rows if upper is None or row[0] <= upper}
+            shadow = {row[0]: row for row in shadow_rows if upper is None or row[0] <= upper}
+
+            missing_in_shadow = sorted(primary.keys() - shadow.keys())
+            missing_in_primary = sorted(shadow.keys() - primary.keys())
+            mismatched = sorted(key for key in primary.keys() & shadow.keys()
+                                if normalize(primary[key]) != normalize(shadow[key]))
+
+            self._stats["checked"] += len(primary.keys() | shadow.keys())
+            self._stats["missing_in_shadow"] += len(missing_in_shadow)
+            self._stats["missing_in_primary"] += len(missing_in_primary)
+            self._stats["mismatched"] += len(mismatched)
+            if missing_in_shadow or missing_in_primary or mismatched:
+                self._pass_clean = False
+                logger.warning(
+                    f"Consistency check {self.table} (after {after}): "
+                    f"missing in shadow {missing_in_shadow[:_MAX_LOGGED]}, "
+                    f"missing in primary {missing_in_primary[:_MAX_LOGGED]}, "
+                    f"mismatched {mismatched[:_MAX_LOGGED]}"
+                )
+                for key in mismatched[:_MAX_LOGGED]:
+                    logger.warning(f"  {self.table} {key}: primary={_short(primary[key])} shadow={_short(shadow[key])}")
+
+            if upper is None:
+                # Both sides exhausted: the pass is complete, start over next time
+                self._stats["passes"] += 1
+                self._stats["last_pass_clean"] = self._pass_clean
+                self._pass_clean = True
+                self._cursor = None
+            else:
+                self._cursor = upper
+
+            return {
+                "table": self.table,
+                "after": after,
+                "upto": upper,
+                "missing_in_shadow": missing_in_shadow,
+                "missing_in_primary": missing_in_primary,
+                "mismatched": mismatched,
+            }
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cursor"] = self._cursor
+        return stats
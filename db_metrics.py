@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Per-query latency histograms, row counts, pool waits and a redacted slow-query log for the data layer.
+"""
+
+import functools
+import inspect
+import logging
+import threading
+import time
+from collections import deque
+
+import stats_registry
+from config import DB_SLOW_QUERY_MS, DB_SLOW_QUERY_LOG_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds, milliseconds (the last bucket is +Inf)
+BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_settings = {"slow_query_ms": DB_SLOW_QUERY_MS}
+_slow_queries = deque(maxlen=max(1, DB_SLOW_QUERY_LOG_SIZE))
+_lock = threading.Lock()
+_metrics = {}  # (name, backend) -> QueryStats
+_executor_wait = {"count": 0, "total_ms": 0.0, "max_ms": 0.0}
+# Calls in progress on this thread; pool waits are charged to each of them
+_local = threading.local()
+
+
+class QueryStats:
+    """Histogram and counters of one named query on one backend (guarded by the module lock)."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.pool_wait_ms = 0.0
+
+    def observe(self, duration_ms, rows, pool_wait_ms, failed):
+        index = len(BUCKETS_MS)
+        for i, bound in enumerate(BUCKETS_MS):
+            if duration_ms <= bound:
+                index = i
+                break
+        self.buckets[index] += 1
+        self.count += 1
+        self.errors += failed
+        self.rows += rows
+        self.total_ms += duration_ms
+        self.max_ms = max(self.max_ms, duration_ms)
+        self.pool_wait_ms += pool_wait_ms
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (max_ms for the +Inf bucket)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                return float(BUCKETS_MS[i]) if i < len(BUCKETS_MS) else round(self.max_ms, 3)
+        return round(self.max_ms, 3)
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "rows": self.rows,
+            "avg_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 3),
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "pool_wait_ms": round(self.pool_wait_ms, 3),
+            "buckets": dict(zip([str(b) for b in BUCKETS_MS] + ["+Inf"], self.buckets)),
+        }
+
+
+def count_rows(result):
+    """Rows returned by a data-layer call: list length, the rows of a (rows, cursor) page, 0 for None, else 1."""
+    if result is None:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    if type(result) is tuple and len(result) == 2 and isinstance(result[0], list):
+        return len(result[0])
+    return 1
+
+
+def redact(value):
+    """A log-safe rendering of one query parameter: only None and flags are shown, ids, dates and text are not."""
+    if value is None or isinstance(value, bool):
+        return repr(value)
+    if isinstance(value, (str, bytes)):
+        return f"<{type(value).__name__} len={len(value)}>"
+    if isinstance(value, (list, tuple, set, frozenset, dict)):
+        return f"<{type(value).__name__} len={len(value)}>"
+    return f"<{type(value).__name__}>"
+
+
+def record_pool_wait(wait_ms):
+    """Charge time spent waiting for a pooled connection to the queries running on this thread."""
+    for frame in getattr(_local, "frames", ()):
+        frame[0] += wait_ms
+
+
+def record_executor_wait(wait_ms):
+    """Record how long a call queued before a database worker thread picked it up."""
+    with _lock:
+        _executor_wait["count"] += 1
+        _executor_wait["total_ms"] += wait_ms
+        _executor_wait["max_ms"] = max(_executor_wait["max_ms"], wait_ms)
+
+
+def _observe(name, backend, duration_ms, rows, pool_wait_ms, failed, args):
+    with _lock:
+        stats = _metrics.get((name, backend))
+        if stats is None:
+            stats = _metrics[(name, backend)] = QueryStats()
+        stats.observe(duration_ms, rows, pool_wait_ms, failed)
+        threshold = _settings["slow_query_ms"]
+        slow = 0 < threshold <= duration_ms
+        if slow:
+            params = ", ".join(redact(arg) for arg in args)
+            _slow_queries.append({
+                "query": name,
+                "backend": backend,
+                "duration_ms": round(duration_ms, 3),
+                "pool_wait_ms": round(pool_wait_ms, 3),
+                "rows": rows,
+                "failed": bool(failed),
+                "params": params,
+                "at": time.time(),
+            })
+    if slow:
+        logger.warning(f"Slow query {name} on {backend}: {duration_ms:.1f} ms "
+                       f"(pool wait {pool_wait_ms:.1f} ms, {rows} rows{', failed' if failed else ''}) params=({params})")
+
+
+def _timed_rows(name, backend, rows, started, args):
+    """Wrap a row iterator so the whole iteration is measured (pool waits inside it are not attributed)."""
+    count = 0
+    failed = False
+    try:
+        for row in rows:
+            count += 1
+            yield row
+    except GeneratorExit:
+        raise
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        close = getattr(rows, "close", None)
+        if close:
+            close()
+        _observe(name, backend, (time.perf_counter() - started) * 1000, count, 0.0, failed, args)
+
+
+def instrument(name, backend, func):
+    """Return `func` wrapped so that each call is recorded as query `name` on `backend`.
+
+    Generators are timed until they are exhausted or closed, and every row
+    they yield is counted.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        frame = [0.0]
+        frames = getattr(_local, "frames", None)
+        if frames is None:
+            frames = _local.frames = []
+        frames.append(frame)
+        started = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException:
+            frames.pop()
+            _observe(name, backend, (time.perf_counter() - started) * 1000, 0, frame[0], True, args)
+            raise
+        frames.pop()
+        if inspect.isgenerator(result):
+            return _timed_rows(name, backend, result, started, args)
+        _observe(name, backend, (time.perf_counter() - started) * 1000, count_rows(result), frame[0], False, args)
+        return result
+    return wrapper
+
+
+def timed_query(name=None, backend="sqlite"):
+    """Decorator form of instrument(); the query name defaults to the function name."""
+    def decorate(func):
+        return instrument(name or func.__name__, backend, func)
+    return decorate
+
+
+def get_query_metrics():
+    """Per-query statistics ({name: {backend: {...}}}), worker queue waits and the latest slow queries."""
+    with _lock:
+        queries = {}
+        for (name, backend), stats in sorted(_metrics.items()):
+            queries.setdefault(name, {})[backend] = stats.as_dict()
+        executor_wait = dict(_executor_wait)
+        slow_queries = list(_slow_queries)
+        threshold = _settings["slow_query_ms"]
+    executor_wait["avg_ms"] = round(executor_wait["total_ms"] / executor_wait["count"], 3) if executor_wait["count"] else 0.0
+    executor_wait["total_ms"] = round(executor_wait["total_ms"], 3)
+    executor_wait["max_ms"] = round(executor_wait["max_ms"], 3)
+    return {
+        "queries": queries,
+        "executor_wait": executor_wait,
+        "slow_query_ms": threshold,
+        "slow_queries": slow_queries,
+    }
+
+
+def render_prometheus():
+    """The query metrics in the Prometheus text exposition format."""
+    with _lock:
+        snapshot = [(name, backend, list(stats.buckets), stats.count, stats.total_ms, stats.errors, stats.rows,
+                     stats.pool_wait_ms) for (name, backend), stats in sorted(_metrics.items())]
+        executor_wait = dict(_executor_wait)
+
+    lines = [
+        "# HELP db_query_duration_seconds Data-layer call latency.",
+        "# TYPE db_query_duration_seconds histogram",
+    ]
+    for name, backend, buckets, count, total_ms, _, _, _ in snapshot:
+        labels = f'query="{name}",backend="{backend}"'
+        cumulative = 0
+        for bound, n in zip(BUCKETS_MS, buckets):
+            cumulative += n
+            lines.append(f'db_query_duration_seconds_bucket{{{labels},le="{bound / 1000:g}"}} {cumulative}')
+        lines.append(f'db_query_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+        lines.append(f"db_query_duration_seconds_sum{{{labels}}} {total_ms / 1000:.6f}")
+        lines.append(f"db_query_duration_seconds_count{{{labels}}} {count}")
+    for metric, help_text, index, scale in (
+        ("db_query_errors_total", "Data-layer calls that raised.", 5, None),
+        ("db_query_rows_total", "Rows returned by data-layer calls.", 6, None),
+        ("db_query_pool_wait_seconds_total", "Time data-layer calls waited for a pooled connection.", 7, 1000),
+    ):
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} counter")
+        for entry in snapshot:
+            value = f"{entry[index] / scale:.6f}" if scale else entry[index]
+            lines.append(f'{metric}{{query="{entry[0]}",backend="{entry[1]}"}} {value}')
+    lines += [
+        "# HELP db_executor_wait_seconds Time calls queued for a database worker thread.",
+        "# TYPE db_executor_wait_seconds summary",
+        f"db_executor_wait_seconds_sum {executor_wait['total_ms'] / 1000:.6f}",
+        f"db_executor_wait_seconds_count {executor_wait['count']}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+stats_registry.register("db_queries", get_query_metrics)
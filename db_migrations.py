@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+"""
+Versioned schema migrations for the SQLite and PostgreSQL backends.
+
+Each migration component has an ordered list of migrations:
+- "core" covers users, subscriptions and subscription_countries.
+- "vless" covers the VLESS subscription store.
+
+Applied versions are recorded in a `schema_version` table. The migrations run
+once at process start via database.init_db() / vless_database.init_vless_db().
+Each migration runs in its own transaction under a lock (BEGIN IMMEDIATE on
+SQLite, an advisory lock on PostgreSQL), so two processes starting together
+apply it exactly once.
+
+To change the schema, append a Migration with the next version number. Never
+edit one that has shipped.
+"""
+
+import logging
+from typing import Callable, List, NamedTuple, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+Step = Union[str, Callable]
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    sqlite: Optional[List[Step]] = None  # None: not applicable to this backend (recorded as applied)
+    postgresql: Optional[List[Step]] = None
+
+
+SCHEMA_VERSION_DDL = '''
+    CREATE TABLE IF NOT EXISTS schema_version (
+        component VARCHAR(50) NOT NULL,
+        version INTEGER NOT NULL,
+        description TEXT,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (component, version)
+    )
+'''
+
+# Arbitrary key for pg_advisory_xact_lock, shared by every process running migrations
+_PG_MIGRATION_LOCK_KEY = 0x76706e5f6d6967  # "vpn_mig"
+
+
+def _sqlite_columns(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in cursor.fetchall()}
+
+
+def _sqlite_upgrade_legacy_subscriptions(cursor):
+    """Fold the single-country schema into subscriptions + subscription_countries.
+
+    Same outcome as migrate_database_schema.py / migrate_to_multi_country.py /
+    fix_migration.py, including resuming a half-finished run (a leftover
+    subscriptions_new table). A no-op on databases created by the current code.
+    """
+    columns = _sqlite_columns(cursor, "subscriptions")
+    legacy_plan = "plan_id" in columns and "duration_plan_id" not in columns
+    legacy_keys = "outline_key_id" in columns
+    if not legacy_plan and not legacy_keys:
+        return
+
+    plan_column = "plan_id" if legacy_plan else "duration_plan_id"
+    package_column = "country_package_id" if "country_package_id" in columns else "NULL"
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS subscriptions_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            duration_plan_id TEXT,
+            country_package_id TEXT,
+            start_date TIMESTAMP,
+            end_date TIMESTAMP,
+            status TEXT DEFAULT 'pending_payment',
+            payment_id TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+    ''')
+    cursor.execute(f'''
+        INSERT OR IGNORE INTO subscriptions_new
+            (id, user_id, duration_plan_id, country_package_id, start_date, end_date, status, payment_id)
+        SELECT id, user_id, {plan_column}, {package_column}, start_date, end_date, status, payment_id
+        FROM subscriptions
+    ''')
+    if legacy_keys:
+        # Single-country subscriptions were all on the German server
+        cursor.execute('''
+            INSERT INTO subscription_countries (subscription_id, country_code, outline_key_id, outline_access_url)
+            SELECT s.id, 'germany', s.outline_key_id, s.outline_access_url
+            FROM subscriptions s
+            WHERE s.outline_key_id IS NOT NULL AND s.outline_key_id != ''
+              AND NOT EXISTS (SELECT 1 FROM subscription_countries sc
+                              WHERE sc.subscription_id = s.id AND sc.outline_key_id = s.outline_key_id)
+        ''')
+    cursor.execute("DROP TABLE subscriptions")
+    cursor.execute("ALTER TABLE subscriptions_new RENAME TO subscriptions")
+    cursor.execute('''
+        UPDATE subscriptions
+        SET country_package_id = '5_countries'
+        WHERE country_package_id IS NULL AND status = 'active'
+    ''')
+
+
+def _sqlite_add_vless_expiry_date(cursor):
+    # Tables created by database.init_vless_db() had no expiry_date column
+    if "expiry_date" not in _sqlite_columns(cursor, "vless_subscriptions"):
+        cursor.execute("ALTER TABLE vless_subscriptions ADD COLUMN expiry_date TIMESTAMP")
+
+
+MIGRATIONS = {
+    "core": [
+        Migration(
+            1, "base tables",
+            sqlite=[
+                '''CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    first_name TEXT,
+                    join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )''',
+                '''CREATE TABLE IF NOT EXISTS subscriptions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    duration_plan_id TEXT,
+                    country_package_id TEXT,
+                    start_date TIMESTAMP,
+                    end_date TIMESTAMP,
+                    status TEXT DEFAULT 'pending_payment', -- pending_payment, active, expired, cancelled
+                    payment_id TEXT, -- For tracking payments with gateways
+                    FOREIGN KEY(user_id) REFERENCES users(user_id)
+                )''',
+                # Links subscriptions to countries and their VPN keys
+                '''CREATE TABLE IF NOT EXISTS subscription_countries (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    subscription_id INTEGER,
+                    country_code TEXT, -- e.g., 'germany', 'france'
+                    outline_key_id TEXT,
+                    outline_access_url TEXT,
+                    FOREIGN KEY(subscription_id) REFERENCES subscriptions(id) ON DELETE CASCADE
+                )''',
+            ],
+            postgresql=[
+                '''CREATE TABLE IF NOT EXISTS users (
+                    user_id BIGINT PRIMARY KEY,
+                    username VARCHAR(255),
+                    first_name VARCHAR(255),
+                    join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )''',
+                '''CREATE TABLE IF NOT EXISTS subscriptions (
+                    id SERIAL PRIMARY KEY,
+                    user_id BIGINT,
+                    duration_plan_id VARCHAR(50),
+                    country_package_id VARCHAR(50),
+                    start_date TIMESTAMP,
+                    end_date TIMESTAMP,
+                    status VARCHAR(50) DEFAULT 'pending_payment',
+                    payment_id VARCHAR(255),
+                    FOREIGN KEY(user_id) REFERENCES users(user_id)
+                )''',
+                '''CREATE TABLE IF NOT EXISTS subscription_countries (
+                    id SERIAL PRIMARY KEY,
+                    subscription_id INTEGER,
+                    country_code VARCHAR(50),
+                    outline_key_id VARCHAR(255),
+                    outline_access_url TEXT,
+                    FOREIGN KEY(subscription_id) REFERENCES subscriptions(id) ON DELETE CASCADE
+                )''',
+            ],
+        ),
+        Migration(
+            2, "upgrade legacy single-country subscriptions",
+            sqlite=[_sqlite_upgrade_legacy_subscriptions],
+            postgresql=[],  # PostgreSQL databases were always created with the multi-country schema
+        ),
+        Migration(
+            3, "indexes for the hot queries",
+            sqlite=[
+                'CREATE INDEX IF NOT EXISTS idx_subscriptions_user_status_end ON subscriptions(user_id, status, end_date)',
+                'CREATE INDEX IF NOT EXISTS idx_subscriptions_status_end ON subscriptions(status, end_date)',
+                # Keyset pagination order of the admin subscription list
+                "CREATE INDEX IF NOT EXISTS idx_subscriptions_admin_keyset ON subscriptions(user_id, COALESCE(end_date, '') DESC, id DESC)",
+                'CREATE INDEX IF NOT EXISTS idx_subscription_countries_subscription_id ON subscription_countries(subscription_id)',
+            ],
+            postgresql=[
+                'CREATE INDEX IF NOT EXISTS idx_subscriptions_user_id ON subscriptions(user_id)',
+                'CREATE INDEX IF NOT EXISTS idx_subscriptions_status ON subscriptions(status)',
+                'CREATE INDEX IF NOT EXISTS idx_subscriptions_end_date ON subscriptions(end_date)',
+                'CREATE INDEX IF NOT EXISTS idx_subscriptions_status_end_date ON subscriptions(status, end_date)',
+                '''CREATE INDEX IF NOT EXISTS idx_subscriptions_admin_keyset
+                   ON subscriptions (user_id, COALESCE(end_date, '-infinity'::timestamp) DESC, id DESC)''',
+                'CREATE INDEX IF NOT EXISTS idx_subscription_countries_subscription_id ON subscription_countries(subscription_id)',
+            ],
+        ),
+        Migration(
+            4, "subscriptions.created_at and archive tables",
+            sqlite=[
+                # SQLite cannot add a column with a CURRENT_TIMESTAMP default: inserts set it explicitly
+                'ALTER TABLE subscriptions ADD COLUMN created_at TIMESTAMP',
+                'UPDATE subscriptions SET created_at = COALESCE(start_date, CURRENT_TIMESTAMP) WHERE created_at IS NULL',
+                'CREATE INDEX IF NOT EXISTS idx_subscriptions_status_created ON subscriptions(status, created_at)',
+                '''CREATE TABLE IF NOT EXISTS subscriptions_archive (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER,
+                    duration_plan_id TEXT,
+                    country_package_id TEXT,
+                    start_date TIMESTAMP,
+                    end_date TIMESTAMP,
+                    status TEXT,
+                    payment_id TEXT,
+                    created_at TIMESTAMP,
+                    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )''',
+                '''CREATE TABLE IF NOT EXISTS subscription_countries_archive (
+                    id INTEGER PRIMARY KEY,
+                    subscription_id INTEGER,
+                    country_code TEXT,
+                    outline_key_id TEXT,
+                    outline_access_url TEXT,
+                    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )''',
+                'CREATE INDEX IF NOT EXISTS idx_subscriptions_archive_user_id ON subscriptions_archive(user_id, id)',
+                'CREATE INDEX IF NOT EXISTS idx_subscription_countries_archive_subscription_id ON subscription_countries_archive(subscription_id)',
+            ],
+            postgresql=[
+                'ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP',
+                'UPDATE subscriptions SET created_at = COALESCE(start_date, created_at) WHERE start_date IS NOT NULL',
+                'CREATE INDEX IF NOT EXISTS idx_subscriptions_status_created ON subscriptions(status, created_at)',
+                '''CREATE TABLE IF NOT EXISTS subscriptions_archive (
+                    id INTEGER PRIMARY KEY,
+                    user_id BIGINT,
+                    duration_plan_id VARCHAR(50),
+                    country_package_id VARCHAR(50),
+                    start_date TIMESTAMP,
+                    end_date TIMESTAMP,
+                    status VARCHAR(50),
+                    payment_id VARCHAR(255),
+                    created_at TIMESTAMP,
+                    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )''',
+                '''CREATE TABLE IF NOT EXISTS subscription_countries_archive (
+                    id INTEGER PRIMARY KEY,
+                    subscription_id INTEGER,
+                    country_code VARCHAR(50),
+                    outline_key_id VARCHAR(255),
+                    outline_access_url TEXT,
+                    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )''',
+                'CREATE INDEX IF NOT EXISTS idx_subscriptions_archive_user_id ON subscriptions_archive(user_id, id)',
+                'CREATE INDEX IF NOT EXISTS idx_subscription_countries_archive_subscription_id ON subscription_countries_archive(subscription_id)',
+            ],
+        ),
+        Migration(
+            # One row per expired subscription whose Outline keys are due for deletion; the row is
+            # removed once the keys are gone (pending_keys: JSON [[country, key_id]] left after a partial failure)
+            5, "key revocation queue",
+            sqlite=[
+                '''CREATE TABLE IF NOT EXISTS key_revocations (
+                    subscription_id INTEGER PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    due_at TIMESTAMP NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    pending_keys TEXT,
+                    last_error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )''',
+                'CREATE INDEX IF NOT EXISTS idx_key_revocations_due_at ON key_revocations(due_at)',
+            ],
+            postgresql=[
+                '''CREATE TABLE IF NOT EXISTS key_revocations (
+                    subscription_id INTEGER PRIMARY KEY,
+                    user_id BIGINT NOT NULL,
+                    due_at TIMESTAMP NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    pending_keys TEXT,
+                    last_error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )''',
+                'CREATE INDEX IF NOT EXISTS idx_key_revocations_due_at ON key_revocations(due_at)',
+            ],
+        ),
+        Migration(
+            # reminder_stage: how many renewal reminder stages were sent for the current end_date
+            6, "renewal reminder bookkeeping",
+            sqlite=[
+                'ALTER TABLE subscriptions ADD COLUMN reminder_stage INTEGER NOT NULL DEFAULT 0',
+                'ALTER TABLE subscriptions ADD COLUMN reminder_sent_at TIMESTAMP',
+                'CREATE INDEX IF NOT EXISTS idx_subscriptions_reminder_due ON subscriptions(status, end_date, reminder_stage)',
+            ],
+            postgresql=[
+                'ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS reminder_stage INTEGER NOT NULL DEFAULT 0',
+                'ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS reminder_sent_at TIMESTAMP',
+                'CREATE INDEX IF NOT EXISTS idx_subscriptions_reminder_due ON subscriptions(status, end_date, reminder_stage)',
+            ],
+        ),
+        Migration(
+            # Outline keys that could not be deleted after every retry; they still grant access
+            # until someone removes them by hand (source: expiry, admin or user cancellation)
+            7, "dead-lettered key deletions",
+            sqlite=[
+                '''CREATE TABLE IF NOT EXISTS key_dead_letters (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    subscription_id INTEGER,
+                    country_code TEXT NOT NULL,
+                    outline_key_id TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    last_error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE (country_code, outline_key_id)
+                )''',
+            ],
+            postgresql=[
+                '''CREATE TABLE IF NOT EXISTS key_dead_letters (
+                    id SERIAL PRIMARY KEY,
+                    subscription_id INTEGER,
+                    country_code VARCHAR(10) NOT NULL,
+                    outline_key_id VARCHAR(255) NOT NULL,
+                    source VARCHAR(20) NOT NULL,
+                    last_error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE (country_code, outline_key_id)
+                )''',
+            ],
+        ),
+        Migration(
+            # Lease that elects the one process running the periodic jobs (leader_lease.py);
+            # PostgreSQL uses a session advisory lock instead
+            8, "scheduler lease",
+            sqlite=[
+                '''CREATE TABLE IF NOT EXISTS scheduler_leases (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT NOT NULL,
+                    expires_at TIMESTAMP NOT NULL,
+                    acquired_at TIMESTAMP
+                )''',
+            ],
+        ),
+        Migration(
+            # Pre-created, unassigned Outline keys that activation claims instead of calling create_key;
+            # server_id tells keys of a replaced server apart (outline_utils.get_server_id)
+            9, "outline key pool",
+            sqlite=[
+                '''CREATE TABLE IF NOT EXISTS key_pool (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    country_code TEXT NOT NULL,
+                    server_id TEXT NOT NULL,
+                    outline_key_id TEXT NOT NULL,
+                    outline_access_url TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE (country_code, server_id, outline_key_id)
+                )''',
+                "CREATE INDEX IF NOT EXISTS idx_key_pool_claim ON key_pool (country_code, server_id, created_at)",
+            ],
+            postgresql=[
+                '''CREATE TABLE IF NOT EXISTS key_pool (
+                    id SERIAL PRIMARY KEY,
+                    country_code VARCHAR(10) NOT NULL,
+                    server_id VARCHAR(32) NOT NULL,
+                    outline_key_id VARCHAR(255) NOT NULL,
+                    outline_access_url TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE (country_code, server_id, outline_key_id)
+                )''',
+                "CREATE INDEX IF NOT EXISTS idx_key_pool_claim ON key_pool (country_code, server_id, created_at)",
+            ],
+        ),
+    ],
+    # The VLESS store runs on SQLite (vless_database.py, and database.py's vless_* helpers);
+    # PostgreSQL only gets the table as a target for migrate_to_postgresql.py
+    "vless": [
+        Migration(
+            1, "vless_subscriptions table",
+            sqlite=[
+                '''CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    first_name TEXT,
+                    join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )''',
+                '''CREATE TABLE IF NOT EXISTS vless_subscriptions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    vless_uuid TEXT,
+                    vless_uri TEXT,
+                    start_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    end_date TIMESTAMP,
+                    expiry_date TIMESTAMP,
+                    status TEXT DEFAULT 'active',
+                    FOREIGN KEY(user_id) REFERENCES users(user_id)
+                )''',
+            ],
+        ),
+        Migration(2, "vless_subscriptions.expiry_date", sqlite=[_sqlite_add_vless_expiry_date]),
+        Migration(
+            3, "vless lookup index",
+            sqlite=['CREATE INDEX IF NOT EXISTS idx_vless_subscriptions_user_status ON vless_subscriptions(user_id, status)'],
+        ),
+        Migration(
+            4, "PostgreSQL vless_subscriptions table",
+            postgresql=[
+                '''CREATE TABLE IF NOT EXISTS vless_subscriptions (
+                    id SERIAL PRIMARY KEY,
+                    user_id BIGINT,
+                    vless_uuid VARCHAR(255),
+                    vless_uri TEXT,
+                    start_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    end_date TIMESTAMP,
+                    expiry_date TIMESTAMP,
+                    status VARCHAR(50) DEFAULT 'active',
+                    FOREIGN KEY(user_id) REFERENCES users(user_id)
+                )''',
+                'CREATE INDEX IF NOT EXISTS idx_vless_subscriptions_user_status ON vless_subscriptions(user_id, status)',
+            ],
+        ),
+    ],
+}
+
+
+def _applied_versions(cursor, component, backend):
+    placeholder = "?" if backend == "sqlite" else "%s"
+    cursor.execute(f"SELECT version FROM schema_version WHERE component = {placeholder}", (component,))
+    return {row[0] for row in cursor.fetchall()}
+
+
+def current_version(conn, component, backend):
+    """Highest applied version of `component` (0 if none)."""
+    cursor = conn.cursor()
+    cursor.execute(SCHEMA_VERSION_DDL)
+    conn.commit()
+    return max(_applied_versions(cursor, component, backend), default=0)
+
+
+def apply_migrations(conn, component, backend):
+    """Apply every pending migration of `component` ("core"/"vless") on `conn`.
+
+    `backend` is "sqlite" or "postgresql". Returns the list of versions applied.
+    """
+    if backend not in ("sqlite", "postgresql"):
+        raise ValueError(f"Unknown backend: {backend}")
+    placeholder = "?" if backend == "sqlite" else "%s"
+    cursor = conn.cursor()
+    cursor.execute(SCHEMA_VERSION_DDL)
+    conn.commit()
+
+    applied = []
+    pending = [m for m in MIGRATIONS[component] if m.version not in _applied_versions(cursor, component, backend)]
+    for migration in pending:
+        if backend == "sqlite":
+            cursor.execute("BEGIN IMMEDIATE")
+        else:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (_PG_MIGRATION_LOCK_KEY,))
+        try:
+            # Another process may have applied it while we waited for the lock
+            if migration.version in _applied_versions(cursor, component, backend):
+                conn.rollback()
+                continue
+            for step in getattr(migration, backend) or ():
+                if callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+            cursor.execute(
+                f"INSERT INTO schema_version (component, version, description) VALUES ({placeholder}, {placeholder}, {placeholder})",
+                (component, migration.version, migration.description),
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.error(f"Migration {component} v{migration.version} ({migration.description}) failed")
+            raise
+        applied.append(migration.version)
+        logger.info(f"Applied migration {component} v{migration.version}: {migration.description}")
+    return applied
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Connection pooling for the SQLite and PostgreSQL backends.
+
+SQLite gets one persistent connection per thread, PostgreSQL gets a bounded,
+thread-safe pool. Both recycle connections after a maximum lifetime, ping
+connections that have been idle before handing them out, and keep usage/wait
+statistics that can be exposed on the health endpoints.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from db_metrics import record_pool_wait
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection becomes available in time."""
+
+
+class SQLiteConnectionProvider:
+    """Hands out one long-lived SQLite connection per thread."""
+
+    def __init__(self, db_path, max_lifetime=1800, health_check_interval=30, on_connect=None):
+        self.db_path = db_path
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self.on_connect = on_connect
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._open = set()
+        self._stats = {
+            "checkouts": 0,
+            "created": 0,
+            "recycled": 0,
+            "health_check_failures": 0,
+            "total_hold_ms": 0.0,
+        }
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path)
+        if self.on_connect:
+            self.on_connect(conn)
+        now = time.monotonic()
+        self._local.conn = conn
+        self._local.created_at = now
+        self._local.last_checked = now
+        self._local.depth = 0
+        with self._lock:
+            self._open.add(conn)
+            self._stats["created"] += 1
+        return conn
+
+    def _discard(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is None:
+            return
+        with self._lock:
+            self._open.discard(conn)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def _acquire(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return self._connect()
+        # Never recycle or ping a connection that is already in use further up the stack
+        if self._local.depth > 0:
+            return conn
+
+        now = time.monotonic()
+        if self.max_lifetime and now - self._local.created_at > self.max_lifetime:
+            with self._lock:
+                self._stats["recycled"] += 1
+            self._discard()
+            return self._connect()
+
+        if self.health_check_interval is not None and now - self._local.last_checked > self.health_check_interval:
+            try:
+                conn.execute("SELECT 1").fetchone()
+                self._local.last_checked = now
+            except sqlite3.Error as e:
+                logger.warning(f"SQLite health check failed, reconnecting: {e}")
+                with self._lock:
+                    self._stats["health_check_failures"] += 1
+                self._discard()
+                return self._connect()
+        return conn
+
+    @contextmanager
+    def connection(self, immediate=False):
+        """Borrow this thread's connection; commits on success, rolls back on error.
+
+        With `immediate`, the outermost borrow opens its transaction with
+        BEGIN IMMEDIATE, taking the write lock before the first read. A nested
+        borrow joins the transaction already open further up the stack.
+        """
+        conn = self._acquire()
+        started = time.monotonic()
+        self._local.depth += 1
+        try:
+            if immediate and self._local.depth == 1 and not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            yield conn
+        except BaseException:
+            if self._local.depth == 1:
+                conn.rollback()
+            raise
+        else:
+            if self._local.depth == 1:
+                conn.commit()
+        finally:
+            self._local.depth -= 1
+            with self._lock:
+                self._stats["checkouts"] += 1
+                self._stats["total_hold_ms"] += (time.monotonic() - started) * 1000
+
+    def close_all(self):
+        """Close every connection opened by this provider (all threads)."""
+        with self._lock:
+            conns = list(self._open)
+            self._open.clear()
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["open_connections"] = len(self._open)
+        stats["backend"] = "sqlite"
+        stats["wait_ms_total"] = 0.0
+        return stats
+
+
+class PostgresConnectionPool:
+    """Bounded, thread-safe pool of psycopg2 connections."""
+
+    def __init__(self, dsn, min_size=1, max_size=10, timeout=10.0, max_lifetime=1800,
+                 health_check_interval=30, connect=None):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        if connect is None:
+            import psycopg2
+            connect = psycopg2.connect
+        self.dsn = dsn
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self._connect_fn = connect
+        self._cond = threading.Condition()
+        self._idle = deque()  # (conn, created_at, returned_at), most recently returned on the right
+        self._created_at = {}
+        self._size = 0
+        self._closed = False
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "created": 0,
+            "recycled": 0,
+            "health_check_failures": 0,
+            "wait_ms_total": 0.0,
+            "wait_ms_max": 0.0,
+        }
+        for _ in range(self.min_size):
+            with self._cond:
+                self._size += 1
+            try:
+                conn = self._new_connection()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                raise
+            with self._cond:
+                self._idle.append((conn, self._created_at[conn], time.monotonic()))
+
+    def _new_connection(self):
+        conn = self._connect_fn(self.dsn)
+        with self._cond:
+            self._created_at[conn] = time.monotonic()
+            self._stats["created"] += 1
+        return conn
+
+    def _close(self, conn):
+        with self._cond:
+            self._created_at.pop(conn, None)
+            self._size -= 1
+            self._cond.notify()
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_usable(self, conn, created_at, returned_at):
+        now = time.monotonic()
+        if conn.closed:
+            return False
+        if self.max_lifetime and now - created_at > self.max_lifetime:
+            with self._cond:
+                self._stats["recycled"] += 1
+            return False
+        if self.health_check_interval is not None and now - returned_at > self.health_check_interval:
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+                conn.rollback()
+            except Exception as e:
+                logger.warning(f"PostgreSQL health check failed, discarding connection: {e}")
+                with self._cond:
+                    self._stats["health_check_failures"] += 1
+                return False
+        return True
+
+    def getconn(self):
+        """Take a connection out of the pool, waiting up to `timeout` seconds."""
+        started = time.monotonic()
+        deadline = started + self.timeout if self.timeout is not None else None
+        waited = False
+        while True:
+            create = False
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolTimeout("Connection pool is closed")
+                    if self._idle:
+                        conn, created_at, returned_at = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        create = True
+                        break
+                    waited = True
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(f"No database connection available after {self.timeout}s")
+                    self._cond.wait(remaining)
+
+            if create:
+                try:
+                    conn = self._new_connection()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_usable(conn, created_at, returned_at):
+                self._close(conn)
+                continue
+
+            wait_ms = (time.monotonic() - started) * 1000
+            with self._cond:
+                self._stats["checkouts"] += 1
+                self._stats["wait_ms_total"] += wait_ms
+                self._stats["wait_ms_max"] = max(self._stats["wait_ms_max"], wait_ms)
+                if waited:
+                    self._stats["waits"] += 1
+            record_pool_wait(wait_ms)
+            return conn
+
+    def putconn(self, conn, discard=False):
+        """Return a connection to the pool (or close it if it is broken or expired)."""
+        if discard or conn.closed or self._closed:
+            self._close(conn)
+            return
+        try:
+            # Anything left open by the borrower must not leak into the next checkout
+            if conn.get_transaction_status() != 0:  # psycopg2.extensions.TRANSACTION_STATUS_IDLE
+                conn.rollback()
+        except Exception:
+            self._close(conn)
+            return
+        with self._cond:
+            created_at = self._created_at.get(conn, time.monotonic())
+            self._idle.append((conn, created_at, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection; commits on success, rolls back on error."""
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+            raise
+        finally:
+            self.putconn(conn, discard=discard or conn.closed)
+
+    def close_all(self):
+        """Close idle connections and refuse new checkouts."""
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._cond.notify_all()
+        for conn, _, _ in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["size"] = self._size
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = self._size - len(self._idle)
+            stats["max_size"] = self.max_size
+        stats["backend"] = "postgresql"
+        return stats
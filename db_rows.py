@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Typed row shapes returned by the subscription queries.
+
+The queries return one joined row per (subscription, country). These rows are
+grouped here into one record per subscription, which carries a tuple of its
+per-country keys. This replaces GROUP_CONCAT/STRING_AGG strings that callers
+had to split and zip by position. Both backends produce exactly the same
+objects, and end dates are always datetimes.
+"""
+
+import datetime
+from itertools import groupby
+from typing import NamedTuple, Optional, Tuple
+
+
+class SubscriptionKey(NamedTuple):
+    country_code: str
+    outline_key_id: Optional[str]
+    outline_access_url: Optional[str]
+
+
+class ExpiringSubscription(NamedTuple):
+    id: int
+    user_id: int
+    status: str
+    end_date: Optional[datetime.datetime]
+    duration_plan_id: Optional[str]
+    keys: Tuple[SubscriptionKey, ...]
+
+
+class ActiveSubscription(NamedTuple):
+    id: int
+    duration_plan_id: str
+    country_package_id: Optional[str]
+    end_date: Optional[datetime.datetime]
+    status: str
+    keys: Tuple[SubscriptionKey, ...]
+
+
+class ArchivedSubscription(NamedTuple):
+    id: int
+    duration_plan_id: str
+    country_package_id: Optional[str]
+    start_date: Optional[datetime.datetime]
+    end_date: Optional[datetime.datetime]
+    status: str
+    archived_at: datetime.datetime
+    keys: Tuple[SubscriptionKey, ...]
+
+
+class SubscriptionSnapshot(NamedTuple):
+    """Every stored column of a subscription plus its keys (used to compare backends)."""
+    id: int
+    user_id: int
+    duration_plan_id: Optional[str]
+    country_package_id: Optional[str]
+    start_date: Optional[datetime.datetime]
+    end_date: Optional[datetime.datetime]
+    status: str
+    payment_id: Optional[str]
+    created_at: Optional[datetime.datetime]
+    keys: Tuple[SubscriptionKey, ...]
+
+
+class RenewalReminder(NamedTuple):
+    id: int
+    user_id: int
+    end_date: datetime.datetime
+    stage: int  # the stage claimed
+    previous_stage: int  # restored by release_renewal_reminder if the reminder could not be sent
+    previous_sent_at: Optional[datetime.datetime]
+
+
+class KeyRevocation(NamedTuple):
+    """A due entry of the key revocation queue with the keys still to delete."""
+    subscription_id: int
+    user_id: int
+    attempts: int
+    pending_keys: Optional[str]  # JSON [[country, key_id]] left after a partial failure, None = all keys
+    keys: Tuple[SubscriptionKey, ...]
+
+
+class AdminSubscription(NamedTuple):
+    id: int
+    user_id: int
+    status: str
+    keys: Tuple[SubscriptionKey, ...]
+
+
+def to_datetime(value):
+    """SQLite hands timestamps back as text, PostgreSQL as datetime; normalize to datetime."""
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.fromisoformat(value)
+
+
+def iter_cursor(cursor, batch_size):
+    """Yield a cursor's rows, fetching `batch_size` at a time."""
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield from rows
+
+
+def keyset_page(rows, limit):
+    """Split an admin-page result fetched with LIMIT limit+1 into (page, cursor of the last row or None)."""
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, (last[1], last[6], last[0])  # (user_id, end_date, id)
+
+
+def group_subscription_rows(rows, row_type, date_index=None):
+    """Collapse joined rows into one `row_type` per subscription.
+
+    Each input row is the subscription columns followed by
+    (country_code, outline_key_id, outline_access_url). Rows for one
+    subscription must be adjacent, so the query must order by s.id after any
+    other sort keys. A subscription without countries (a LEFT JOIN miss) gets
+    an empty `keys` tuple. `date_index` names the column (or a tuple of
+    columns) to normalize with to_datetime().
+    Works lazily, so it can sit on top of a streaming cursor.
+    """
+    if date_index is None:
+        date_indexes = ()
+    elif isinstance(date_index, int):
+        date_indexes = (date_index,)
+    else:
+        date_indexes = tuple(date_index)
+    for _, group in groupby(rows, key=lambda row: row[0]):
+        group = list(group)
+        head = list(group[0][:-3])
+        for index in date_indexes:
+            head[index] = to_datetime(head[index])
+        keys = tuple(SubscriptionKey(*row[-3:]) for row in group if row[-3] is not None)
+        yield row_type(*head, keys)
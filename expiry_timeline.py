@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+In-memory timeline of subscription end dates that wakes the expiry handling when one is due.
+"""
+
+import asyncio
+import datetime
+import heapq
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+# Longest single sleep: bounds the effect of wall-clock jumps on the next wakeup
+_MAX_SLEEP = 300.0
+
+
+def to_timestamp(end_date):
+    """Seconds since the epoch of a naive UTC datetime."""
+    return (end_date - _EPOCH).total_seconds()
+
+
+class ExpiryTimeline:
+    """Wakes `on_due(subscription_ids)` when subscriptions reach their end date.
+
+    `load` returns an async iterable of (subscription_id, end_date) for every
+    active subscription. update() may be called from any thread.
+    """
+
+    def __init__(self, on_due, load, retry_seconds=30):
+        self.on_due = on_due
+        self.load = load
+        self.retry_seconds = retry_seconds
+        self._lock = threading.Lock()
+        self._heap = []   # (end timestamp, subscription id), may hold stale entries
+        self._ends = {}   # subscription id -> end timestamp it is scheduled for
+        self._touched = None  # ids updated while a reload is streaming, see reconcile()
+        self._wake_at = None
+        self._wakeup = None
+        self._loop = None
+        self._task = None
+        self._wakeups = 0
+        self._due = 0
+        self._reconciles = 0
+        self._last_drift = None
+        self._last_reconciled_at = None
+
+    async def start(self):
+        """Load the timeline and start waiting for the first due subscription."""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        await self.reconcile()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def update(self, subscription_id, end_date):
+        """Data-layer hook: the subscription now ends at `end_date` (None: it is no longer active)."""
+        with self._lock:
+            if self._touched is not None:
+                self._touched.add(subscription_id)
+            if end_date is None:
+                self._ends.pop(subscription_id, None)
+                return
+            end_ts = to_timestamp(end_date)
+            if self._ends.get(subscription_id) == end_ts:
+                return
+            self._ends[subscription_id] = end_ts
+            heapq.heappush(self._heap, (end_ts, subscription_id))
+            self._compact()
+            earlier = self._wake_at is None or end_ts < self._wake_at
+        if earlier:
+            self._signal()
+
+    def defer(self, subscription_ids):
+        """Hand back due subscriptions that were not handled: they come due again in retry_seconds."""
+        retry_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.retry_seconds)
+        for subscription_id in subscription_ids:
+            self.update(subscription_id, retry_at)
+
+    async def reconcile(self):
+        """Reload every active subscription from the database and return the number of entries that differed."""
+        with self._lock:
+            self._touched = set()
+        ends = {}
+        try:
+            async for subscription_id, end_date in self.load():
+                ends[subscription_id] = to_timestamp(end_date)
+        except BaseException:
+            with self._lock:
+                self._touched = None
+            raise
+        with self._lock:
+            # Updates that arrived while the snapshot was streaming are newer than it
+            for subscription_id in self._touched:
+                if subscription_id in self._ends:
+                    ends[subscription_id] = self._ends[subscription_id]
+                else:
+                    ends.pop(subscription_id, None)
+            self._touched = None
+            drift = sum(1 for sid, end_ts in ends.items() if self._ends.get(sid) != end_ts)
+            drift += sum(1 for sid in self._ends if sid not in ends)
+            self._ends = ends
+            self._heap = [(end_ts, sid) for sid, end_ts in ends.items()]
+            heapq.heapify(self._heap)
+            self._reconciles += 1
+            if self._reconciles == 1:
+                drift = 0  # the initial load
+            self._last_drift = drift
+            self._last_reconciled_at = time.time()
+        self._signal()
+        if drift:
+            logger.warning(f"Expiry timeline was out of date for {drift} subscription(s); reloaded")
+        return drift
+
+    def _signal(self):
+        if self._loop and self._wakeup:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _compact(self):
+        """Drop stale entries once they make up more than half the heap (caller holds the lock)."""
+        if len(self._heap) > 2 * len(self._ends) + 1024:
+            self._heap = [(end_ts, sid) for sid, end_ts in self._ends.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_due(self, now):
+        """Remove and return the ids due at `now`, and the timestamp of the next live entry."""
+        due = []
+        with self._lock:
+            heap = self._heap
+            while heap and (heap[0][0] <= now or self._ends.get(heap[0][1]) != heap[0][0]):
+                end_ts, subscription_id = heapq.heappop(heap)
+                if self._ends.get(subscription_id) == end_ts:
+                    del self._ends[subscription_id]
+                    due.append(subscription_id)
+            self._wake_at = heap[0][0] if heap else None
+            return due, self._wake_at
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            due, next_at = self._pop_due(time.time())
+            if due:
+                self._wakeups += 1
+                self._due += len(due)
+                try:
+                    await self.on_due(due)
+                except Exception as e:
+                    logger.error(f"Expiry timeline: handling {len(due)} due subscription(s) failed: {e}")
+                    self.defer(due)
+                continue
+            delay = _MAX_SLEEP if next_at is None else min(_MAX_SLEEP, max(0.0, next_at - time.time()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            size = len(self._ends)
+            heap_size = len(self._heap)
+            next_at = self._heap[0][0] if self._heap else None
+        return {
+            "subscriptions": size,
+            "heap_entries": heap_size,
+            "next_due_in_s": round(max(0.0, next_at - time.time()), 1) if next_at is not None else None,
+            "wakeups": self._wakeups,
+            "due_handled": self._due,
+            "reconciles": self._reconciles,
+            "last_drift": self._last_drift,
+            "last_reconciled_at": self._last_reconciled_at,
+        }
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Concurrent deletion of batches of Outline access keys, with retries and backoff per key.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from typing import List, NamedTuple, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class RevocationResult(NamedTuple):
+    failed: List[Tuple[object, str]]  # (key, error) for every key that could not be deleted
+    stats: dict
+
+
+class KeyRevoker:
+    """Deletes batches of keys concurrently.
+
+    `delete(country_code, key_id)` is a coroutine that returns True once the
+    key is gone; it is responsible for limiting the calls per server.
+    """
+
+    def __init__(self, delete, retries=2, retry_delay=0.5):
+        self.delete = delete
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._lock = threading.Lock()
+        self._totals = {"batches": 0, "keys": 0, "deleted": 0, "failed": 0, "retries": 0}
+        self._last_batch = None
+
+    async def revoke(self, keys):
+        """Delete `keys` (records with country_code and outline_key_id) and return a RevocationResult."""
+        started = time.monotonic()
+        by_server = {}
+        for key in keys:
+            by_server.setdefault(key.country_code, []).append(key)
+
+        servers = {country: {"deleted": 0, "failed": 0, "retries": 0} for country in by_server}
+        failed = []
+
+        async def delete_key(key):
+            server = servers[key.country_code]
+            error = None
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    server["retries"] += 1
+                    await asyncio.sleep(self.retry_delay * 2 ** (attempt - 1))
+                try:
+                    if await self.delete(key.country_code, key.outline_key_id):
+                        server["deleted"] += 1
+                        return
+                    error = "delete refused by the server"
+                except ValueError as e:
+                    error = f"no Outline client: {e}"
+                    break  # the server is not configured: retrying cannot help
+                except Exception as e:
+                    error = str(e) or type(e).__name__
+            server["failed"] += 1
+            failed.append((key, error))
+
+        await asyncio.gather(*(delete_key(key) for key in keys))
+
+        stats = {
+            "keys": sum(len(server_keys) for server_keys in by_server.values()),
+            "deleted": sum(server["deleted"] for server in servers.values()),
+            "failed": len(failed),
+            "retries": sum(server["retries"] for server in servers.values()),
+            "duration_s": round(time.monotonic() - started, 3),
+            "servers": servers,
+        }
+        with self._lock:
+            self._totals["batches"] += 1
+            for field in ("keys", "deleted", "failed", "retries"):
+                self._totals[field] += stats[field]
+            self._last_batch = stats
+        if stats["keys"]:
+            logger.info(f"Key revocation: {stats['deleted']}/{stats['keys']} key(s) deleted on "
+                        f"{len(servers)} server(s) in {stats['duration_s']:.2f}s ({stats['retries']} retries)")
+        return RevocationResult(failed, stats)
+
+    def stats(self):
+        with self._lock:
+            return {**self._totals, "last_batch": self._last_batch}
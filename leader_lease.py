@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Single-leader election for the periodic jobs, on a PostgreSQL advisory lock or an expiring SQLite lease row.
+"""
+
+import asyncio
+import datetime
+import functools
+import hashlib
+import logging
+import time
+
+import stats_registry
+
+logger = logging.getLogger(__name__)
+
+_active = None
+
+
+def lock_key(name):
+    """A stable signed 64-bit advisory lock key for a lease name."""
+    return int.from_bytes(hashlib.sha256(f"lease:{name}".encode()).digest()[:8], "big", signed=True)
+
+
+class SQLiteLease:
+    """A lease row with an expiry time; `connect()` returns a connection context manager."""
+
+    backend = "sqlite"
+    # The row stays ours until expires_at even if a renewal fails
+    outlives_errors = True
+
+    def __init__(self, connect, name, holder, ttl):
+        self.connect = connect
+        self.name = name
+        self.holder = holder
+        self.ttl = ttl
+
+    def acquire(self):
+        """Take the lease if it is free or expired, or renew it if we hold it. Returns True while held."""
+        now = datetime.datetime.utcnow()
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO scheduler_leases (name, holder, expires_at, acquired_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET
+                    acquired_at = CASE WHEN holder = excluded.holder THEN acquired_at ELSE excluded.acquired_at END,
+                    holder = excluded.holder,
+                    expires_at = excluded.expires_at
+                WHERE holder = excluded.holder OR expires_at < ?
+            ''', (self.name, self.holder, now + datetime.timedelta(seconds=self.ttl), now, now))
+            return cursor.rowcount > 0
+
+    def release(self):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM scheduler_leases WHERE name = ? AND holder = ?", (self.name, self.holder))
+
+
+class AdvisoryLockLease:
+    """A PostgreSQL session-level advisory lock held on its own connection (`connect()` opens one)."""
+
+    backend = "postgresql"
+    # A failed check closes the session, and the lock goes with it
+    outlives_errors = False
+
+    def __init__(self, connect, name):
+        self.connect = connect
+        self.name = name
+        self.key = lock_key(name)
+        self._conn = None
+        self._held = False
+
+    def acquire(self):
+        """Try to take the lock, or check that the session holding it is still alive. Returns True while held."""
+        try:
+            if self._conn is None:
+                self._conn = self.connect()
+                self._conn.autocommit = True
+            cursor = self._conn.cursor()
+            if self._held:
+                cursor.execute("SELECT 1")
+            else:
+                cursor.execute("SELECT pg_try_advisory_lock(%s)", (self.key,))
+                self._held = bool(cursor.fetchone()[0])
+            return self._held
+        except Exception:
+            # The lock went away with the session
+            self._close()
+            raise
+
+    def release(self):
+        if self._conn is not None and self._held:
+            try:
+                self._conn.cursor().execute("SELECT pg_advisory_unlock(%s)", (self.key,))
+            except Exception as e:
+                logger.warning(f"Could not release scheduler lock {self.name}: {e}")
+        self._close()
+
+    def _close(self):
+        self._held = False
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+
+class LeaderElector:
+    """Keeps trying to hold `lease` every `interval` seconds.
+
+    `on_elected()` and `on_demoted()` (coroutines) run in the background when
+    leadership changes, one at a time and in order, so a slow callback never
+    delays the next renewal.
+    Leadership is only trusted for `ttl - interval` seconds after the last
+    successful renewal.
+    """
+
+    def __init__(self, lease, ttl, interval, on_elected=None, on_demoted=None):
+        if interval * 2 > ttl:
+            raise ValueError("the lease interval must be at most half the lease TTL")
+        self.lease = lease
+        self.ttl = ttl
+        self.interval = interval
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self._leader = False
+        self._valid_until = 0.0
+        self._task = None
+        self._callback_task = None
+        self._elections = 0
+        self._failures = 0
+        self._last_error = None
+        self._elected_at = None
+
+    @property
+    def is_leader(self):
+        return self._leader and time.monotonic() < self._valid_until
+
+    async def start(self):
+        global _active
+        _active = self
+        stats_registry.register("scheduler_leader", self.stats)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        global _active
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._leader:
+            await self._set_leader(False)
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.lease.release)
+            except Exception as e:
+                logger.warning(f"Could not release the scheduler lease: {e}")
+        if self._callback_task:
+            await self._callback_task
+            self._callback_task = None
+        if _active is self:
+            _active = None
+        stats_registry.unregister("scheduler_leader", self.stats)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = time.monotonic()
+            try:
+                held = await loop.run_in_executor(None, self.lease.acquire)
+                if held:
+                    self._valid_until = started + self.ttl - self.interval
+            except Exception as e:
+                # A failed renewal of a time-bound lease is not a lost lease: stay leader until it runs out
+                held = self.lease.outlives_errors and self._leader and time.monotonic() < self._valid_until
+                self._failures += 1
+                self._last_error = str(e)
+                logger.warning(f"Scheduler lease check failed: {e}")
+            if held != self._leader:
+                await self._set_leader(held)
+            await asyncio.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    async def _set_leader(self, leader):
+        self._leader = leader
+        callback = self.on_elected if leader else self.on_demoted
+        if leader:
+            self._elections += 1
+            self._elected_at = time.time()
+            logger.info(f"This process is now the scheduler leader ({self.lease.backend} lease)")
+        else:
+            self._elected_at = None
+            logger.warning("This process is no longer the scheduler leader")
+        if callback:
+            self._callback_task = asyncio.create_task(self._run_callback(callback, self._callback_task))
+
+    async def _run_callback(self, callback, previous):
+        if previous:
+            await previous
+        try:
+            await callback()
+        except Exception as e:
+            logger.error(f"Scheduler leadership callback failed: {e}")
+
+    def stats(self):
+        return {
+            "is_leader": self.is_leader,
+            "backend": self.lease.backend,
+            "elected_at": self._elected_at,
+            "elections": self._elections,
+            "failures": self._failures,
+            "last_error": self._last_error,
+            "ttl_s": self.ttl,
+            "interval_s": self.interval,
+        }
+
+
+def is_leader():
+    """True if this process may run the leader-only jobs (always, when no election is running)."""
+    return _active is None or _active.is_leader
+
+
+def leader_only(job):
+    """Wrap a JobQueue callback so that it only runs in the leader process."""
+    @functools.wraps(job)
+    async def wrapper(*args, **kwargs):
+        if not is_leader():
+            return None
+        return await job(*args, **kwargs)
+    return wrapper
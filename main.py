@@ -8,12 +8,14 @@ from datetime import datetime, timedelta
 import sqlite3
 import asyncio
 import re
+import os
+import socket
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, BotCommandScopeChat, InputFile
 from telegram.constants import ParseMode
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, ConversationHandler,
-    CallbackQueryHandler, ContextTypes, filters, JobQueue
+    CallbackQueryHandler, ContextTypes, TypeHandler, filters, JobQueue
 )
 from telegram.error import BadRequest, Conflict
 
@@ -22,31 +24,43 @@ import telegram
 
 from config import ( 
     TELEGRAM_BOT_TOKEN, DURATION_PLANS, COUNTRY_PACKAGES, ADMIN_USER_ID, OUTLINE_SERVERS,
-    COMMAND_RATE_LIMIT, CALLBACK_RATE_LIMIT, MESSAGE_RATE_LIMIT, DB_PATH, VLESS_SERVERS # Added VLESS_SERVERS
+    COMMAND_RATE_LIMIT, CALLBACK_RATE_LIMIT, MESSAGE_RATE_LIMIT, DB_PATH, VLESS_SERVERS, # Added VLESS_SERVERS
+    DB_MAINTENANCE_INTERVAL, USER_PROFILE_FLUSH_INTERVAL, SUBSCRIPTION_ARCHIVE_INTERVAL, DB_DUAL_WRITE,
+    DB_CONSISTENCY_CHECK_INTERVAL, KEY_REVOCATION_INTERVAL, EXPIRY_RECONCILE_INTERVAL, TELEGRAM_GLOBAL_RATE,
+    TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_QUEUE_MAX_PER_LANE, TELEGRAM_MAX_RETRIES,
+    RENEWAL_REMINDER_INTERVAL, SCHEDULER_LEADER_ELECTION, SCHEDULER_LEASE_TTL, SCHEDULER_LEASE_INTERVAL,
+    KEY_PROVISION_ATTEMPTS, KEY_POOL_LOW_WATER, KEY_POOL_REFILL_INTERVAL
 )
-from database import (
-    init_db, add_user_if_not_exists, create_subscription_record,
-    activate_subscription, get_active_subscriptions, add_subscription_country,
-    get_subscription_countries, update_subscription_country_package,
+# Awaitable data-layer calls (run on the bounded DB executor, never on the event loop)
+from database_async import (
+    run_db, init_db, add_user_if_not_exists, create_subscription_record,
+    provision_subscription, get_active_subscriptions, get_subscription_countries,
     # New DB functions for admin:
-    get_all_active_subscriptions_for_admin, get_subscription_by_id, cancel_subscription_by_admin,
+    get_admin_subscriptions_page, count_admin_subscriptions, get_subscription_by_id, cancel_subscription_by_admin,
     get_subscription_for_admin, mark_subscription_expired, renew_subscription,
-    init_vless_db, add_vless_subscription
-)
-from outline_utils import (
-    get_outline_client, create_outline_key, rename_outline_key, delete_outline_key, get_available_countries
+    get_user_subscription, warm_known_users, flush_user_profile_updates, shutdown_executor, add_dead_letter_keys,
+    claim_pooled_keys, add_pooled_keys
 )
+from outline_utils import get_available_countries
+from outline_async import create_outline_keys, rename_outline_key, shutdown as shutdown_outline_executor
 from payment_utils import (
     generate_yookassa_payment_link, get_crypto_payment_details,
     verify_yookassa_payment, verify_crypto_payment, get_testnet_status,
     get_payment_status, get_yookassa_payment_details, get_yookassa_payment_status
 )
-from scheduler_tasks import check_expired_subscriptions
+from scheduler_tasks import (
+    create_expiry_timeline, reconcile_expiry_timeline, send_due_renewal_reminders, db_maintenance,
+    flush_user_profiles, archive_finished_subscriptions, backend_consistency_check, process_key_revocations,
+    recover_key_revocations, key_revoker, refill_key_pools, current_pool_servers
+)
+from database import add_end_date_listener, create_scheduler_lease, set_db_session
+from leader_lease import LeaderElector, leader_only
 # from vless_utils import add_vless_user  # Not needed - using API bridge instead
 
 # Add VLESS imports at the top with other imports
-from vless_database import init_vless_db, add_vless_subscription, get_user_subscription, remove_vless_subscription
+from vless_database import init_vless_db, add_vless_subscription, remove_vless_subscription
 from vps_api_client import add_vless_user_via_api, get_vless_user_status_via_api
+from message_scheduler import MessageScheduler
 
 # Enable logging
 logging.basicConfig(
@@ -181,7 +195,7 @@ def admin_only(func):
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a welcome message with logo and Russian menu buttons."""
     user = update.effective_user
-    add_user_if_not_exists(user.id, user.username, user.first_name)
+    await add_user_if_not_exists(user.id, user.username, user.first_name)
     logger.info(f"[start_command] User {user.id} ({user.username or user.first_name}) started the bot.")
     
     # If user was in a subscription flow, notify about cancellation
@@ -283,7 +297,7 @@ async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await update.message.reply_text("Пожалуйста, выберите срок подписки:", reply_markup=reply_markup)
     return UserConversationState.CHOOSE_DURATION.value
 
-def build_my_subscriptions_message_and_keyboard(active_subs):
+async def build_my_subscriptions_message_and_keyboard(active_subs):
     message = "Ваши активные подписки на VLESS VPN:\n\n"
     keyboard = []
     
@@ -291,8 +305,7 @@ def build_my_subscriptions_message_and_keyboard(active_subs):
     user_id = active_subs[0][0] if active_subs else None  # Get user_id from first subscription
     if user_id:
         try:
-            init_vless_db()
-            vless_subscription = get_user_subscription(user_id)
+            vless_subscription = await get_user_subscription(user_id)
             if vless_subscription:
                 user_id, uuid, vless_uri, expiry_date_str = vless_subscription
                 if isinstance(expiry_date_str, str):
@@ -323,12 +336,11 @@ async def my_subscriptions_command(update: Update, context: ContextTypes.DEFAULT
     
     # Check for VLESS subscriptions first
     try:
-        init_vless_db()
-        vless_subscription = get_user_subscription(user_id)
+        vless_subscription = await get_user_subscription(user_id)
         if vless_subscription:
             # Create a dummy active_subs list with user_id for the function to work
             dummy_active_subs = [(user_id,)]
-            message, keyboard = build_my_subscriptions_message_and_keyboard(dummy_active_subs)
+            message, keyboard = await build_my_subscriptions_message_and_keyboard(dummy_active_subs)
             keyboard.append([InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_menu")])
             await update.message.reply_text(
                 message, 
@@ -520,7 +532,7 @@ async def confirm_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 
                 if renewing_sub_id:
                     # This is a renewal - get existing subscription to find current end_date
-                    existing_sub = get_subscription_by_id(renewing_sub_id)
+                    existing_sub = await get_subscription_by_id(renewing_sub_id)
                     if not existing_sub:
                         await query.edit_message_text("Ошибка: Не удалось найти подписку для продления.")
                         return ConversationHandler.END
@@ -535,7 +547,7 @@ async def confirm_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     new_end_date = current_end_date + timedelta(days=plan['duration_days'])
 
                     # Update existing subscription using abstraction
-                    renew_subscription(renewing_sub_id, user_id, new_end_date, payment_id)
+                    await renew_subscription(renewing_sub_id, user_id, new_end_date, payment_id)
 
                     success_message = (
                         f"✅ Оплата прошла успешно! Ваша подписка была продлена.\n\n"
@@ -551,7 +563,7 @@ async def confirm_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     return ConversationHandler.END
                 else:
                     # This is a new subscription - create pending subscription
-                    subscription_id = create_subscription_record(
+                    subscription_id = await create_subscription_record(
                         user_id=user_id,
                         duration_plan_id=duration_id,
                         duration_days=plan['duration_days']
@@ -601,11 +613,88 @@ async def confirm_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return UserConversationState.AWAIT_PAYMENT_CONFIRMATION.value
 
+class KeyProvisioningError(Exception):
+    """Not every country of a package got its key; the keys that were claimed or created have been released."""
+    def __init__(self, failed_countries):
+        super().__init__(f"Failed to create VPN keys for: {', '.join(failed_countries)}")
+        self.failed_countries = failed_countries
+
+async def provision_package(context, user, subscription_id, country_package_id, countries, duration_days, payment_id):
+    """Get a key for every country of a package and activate the subscription with them.
+
+    Keys are claimed from the key pool where it has one, which is database
+    work only, and created live on the remaining servers, all at once. The
+    pooled keys are renamed "{user}_{country}_{sub_id}" in the background
+    afterwards; live keys get that name on creation.
+
+    All or nothing: if a country still has no key after KEY_PROVISION_ATTEMPTS
+    rounds (KeyProvisioningError) or the activation fails, the keys are
+    released again (see release_package_keys) and the error is raised.
+    """
+    user_name = user.first_name or user.username or f"user_{user.id}"
+    def name_for(country):
+        return f"{user_name}_{country}_{subscription_id}"
+
+    started = time.monotonic()
+    pool_servers = {}
+    pooled = []
+    if KEY_POOL_LOW_WATER > 0:
+        pool_servers = {country: server_id for country, server_id in current_pool_servers().items() if country in countries}
+        try:
+            pooled = await claim_pooled_keys(list(pool_servers.items()))
+        except Exception as e:
+            logger.error(f"Could not claim pooled keys for subscription {subscription_id}: {e}")
+    claimed = {key.country_code for key in pooled}
+    created, failed = await create_outline_keys(
+        [country for country in countries if country not in claimed], name_for, attempts=KEY_PROVISION_ATTEMPTS
+    )
+    keys = sorted(pooled + created, key=lambda key: countries.index(key.country_code))
+    try:
+        if failed:
+            raise KeyProvisioningError(failed)
+        # Store the package and keys and activate the subscription in one transaction
+        await provision_subscription(
+            subscription_id=subscription_id,
+            user_id=user.id,
+            country_package_id=country_package_id,
+            keys=keys,
+            duration_days=duration_days,
+            payment_id=payment_id
+        )
+    except Exception:
+        await release_package_keys(subscription_id, pool_servers, pooled, created)
+        raise
+    for key in pooled:
+        context.application.create_task(rename_outline_key(key.country_code, key.outline_key_id, name_for(key.country_code)))
+    logger.info(f"Provisioned subscription {subscription_id} in {time.monotonic() - started:.2f}s with "
+                f"{len(pooled)} pooled and {len(created)} new key(s): "
+                f"{', '.join(f'{key.country_code}={key.outline_key_id}' for key in keys)}")
+    return keys
+
+async def release_package_keys(subscription_id, pool_servers, pooled, created):
+    """Undo the keys of a provisioning that failed: pooled keys go back to the pool, new ones are deleted."""
+    try:
+        await add_pooled_keys([(key.country_code, pool_servers[key.country_code], key.outline_key_id,
+                                key.outline_access_url) for key in pooled])
+    except Exception as e:
+        logger.error(f"Could not return {len(pooled)} key(s) of subscription {subscription_id} to the pool: {e}")
+        created = created + pooled
+    if not created:
+        return
+    result = await key_revoker.revoke(created)
+    if result.failed:
+        await add_dead_letter_keys(subscription_id, result.failed, "provision_rollback")
+    logger.warning(f"Rolled back {len(created) - len(result.failed)}/{len(created)} VPN key(s) of subscription {subscription_id}")
+
 async def countries_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle country package selection and activate subscription."""
     query = update.callback_query
     await query.answer()
-    
+    return await activate_chosen_package(update, context)
+
+async def activate_chosen_package(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Provision the package of a "countries_" callback and reply with the result; returns the next state."""
+    query = update.callback_query
     country_package_id = query.data[len("countries_"):]
     subscription_id = context.user_data.get('pending_subscription_id')
     payment_id = context.user_data.get('payment_id')
@@ -625,58 +714,15 @@ async def countries_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         package = COUNTRY_PACKAGES[country_package_id]
         duration_plan = DURATION_PLANS[duration_id]
         
-        # Update subscription with country package
-        update_subscription_country_package(subscription_id, country_package_id)
-        
-        # Create Outline keys for each country in the package
+        # Claim or create the key of every country in the package and activate the subscription
         countries = package.get('countries', [])
-        created_keys = []
-        
-        for country in countries:
-            try:
-                # Get Outline client for this country
-                outline_client = get_outline_client(country)
-                if not outline_client:
-                    logger.error(f"Failed to get Outline client for country: {country}")
-                    continue
-                
-                # Create VPN key for this country
-                outline_key_id, outline_access_url = create_outline_key(outline_client)
-                
-                if outline_key_id and outline_access_url:
-                    # Add country to subscription
-                    add_subscription_country(
-                        subscription_id=subscription_id,
-                        country_code=country,
-                        outline_key_id=outline_key_id,
-                        outline_access_url=outline_access_url
-                    )
-                    created_keys.append(country)
-                    
-                    # Rename the key for better identification
-                    user_name = update.effective_user.first_name or update.effective_user.username or f"user_{update.effective_user.id}"
-                    key_name = f"{user_name}_{country}_{subscription_id}"
-                    rename_outline_key(outline_client, outline_key_id, key_name)
-                    
-                    logger.info(f"Created VPN key for {country}: {outline_key_id}")
-                else:
-                    logger.error(f"Failed to create Outline key for country: {country}")
-                    
-            except Exception as e:
-                logger.error(f"Error creating VPN key for {country}: {e}")
-        
-        if not created_keys:
-            raise Exception("Failed to create any VPN keys")
-        
-        # Activate the subscription
-        activate_subscription(
-            subscription_db_id=subscription_id,
-            duration_days=duration_plan['duration_days'],
-            payment_id=payment_id
+        provisioned_keys = await provision_package(
+            context, update.effective_user, subscription_id, country_package_id, countries,
+            duration_plan['duration_days'], payment_id
         )
-        
-        countries_text = ", ".join([f"{OUTLINE_SERVERS[country]['flag']} {OUTLINE_SERVERS[country]['name']}" 
-                                  for country in created_keys])
+
+        countries_text = ", ".join([f"{OUTLINE_SERVERS[key.country_code]['flag']} {OUTLINE_SERVERS[key.country_code]['name']}"
+                                  for key in provisioned_keys])
         
         success_message = (
             f"🎉 Ваша VPN подписка теперь активна!\n\n"
@@ -698,6 +744,16 @@ async def countries_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         context.user_data.clear()
         return ConversationHandler.END
         
+    except KeyProvisioningError as e:
+        logger.error(f"Error activating subscription {subscription_id}: {e}")
+        failed_text = ", ".join(f"{OUTLINE_SERVERS[country]['flag']} {OUTLINE_SERVERS[country]['name']}" if country in OUTLINE_SERVERS else country
+                                for country in e.failed_countries)
+        await query.edit_message_text(
+            f"❌ Не удалось создать ключи для: {failed_text}.\n\n"
+            f"Оплата сохранена. Выберите пакет еще раз или обратитесь в поддержку.",
+            reply_markup=build_country_selection_keyboard()
+        )
+        return UserConversationState.CHOOSE_COUNTRIES.value
     except Exception as e:
         logger.error(f"Error activating subscription: {e}")
         await query.edit_message_text(
@@ -749,18 +805,27 @@ async def cancel_subscription_flow(update: Update, context: ContextTypes.DEFAULT
 @rate_limit_command("admin_del_sub")
 async def admin_delete_subscription_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Start the admin subscription deletion flow, showing a paginated list of subscriptions."""
-    subscriptions = get_all_active_subscriptions_for_admin()
-    if not subscriptions:
-        await update.message.reply_text("No subscriptions found to delete.")
+    is_page_turn = update.callback_query and update.callback_query.data.startswith("admin_del_page_")
+    if not is_page_turn:
+        # Fresh listing: start from the first page and count once for the header
+        context.user_data['admin_delete_cursors'] = [None]
+        context.user_data['admin_delete_total'] = await count_admin_subscriptions()
+
+    # Keyset cursors of the pages visited so far; the last one is the current page
+    page_cursors = context.user_data.setdefault('admin_delete_cursors', [None])
+    subs_to_display, next_cursor = await get_admin_subscriptions_page(page_cursors[-1], ADMIN_PAGE_SIZE)
+    context.user_data['admin_delete_next_cursor'] = next_cursor
+    if not subs_to_display and len(page_cursors) == 1:
+        await update.effective_message.reply_text("No subscriptions found to delete.")
         return ConversationHandler.END
 
-    text_parts = ["Select a subscription to delete by clicking its button, or type the Subscription DB ID:\n"]
-    keyboard = []
-    
-    current_page = context.user_data.get('admin_delete_page', 0)
+    current_page = len(page_cursors) - 1
     start_index = current_page * ADMIN_PAGE_SIZE
-    end_index = start_index + ADMIN_PAGE_SIZE
-    subs_to_display = subscriptions[start_index:end_index]
+    text_parts = [
+        "Select a subscription to delete by clicking its button, or type the Subscription DB ID:\n",
+        f"Showing {start_index + 1}-{start_index + len(subs_to_display)} of {context.user_data.get('admin_delete_total', '?')}\n",
+    ]
+    keyboard = []
 
     for sub_id, user_id, username, first_name, duration_plan_id, country_package_id, end_date_str, status, countries in subs_to_display:
         user_display = username or first_name or f"User {user_id}"
@@ -779,7 +844,7 @@ async def admin_delete_subscription_start(update: Update, context: ContextTypes.
     page_nav_buttons = []
     if current_page > 0:
         page_nav_buttons.append(InlineKeyboardButton("⬅️ Previous", callback_data="admin_del_page_prev"))
-    if end_index < len(subscriptions):
+    if next_cursor is not None:
         page_nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data="admin_del_page_next"))
     
     if page_nav_buttons:
@@ -789,7 +854,7 @@ async def admin_delete_subscription_start(update: Update, context: ContextTypes.
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     message_text = "".join(text_parts)
-    if update.callback_query and update.callback_query.data.startswith("admin_del_page_"):
+    if is_page_turn:
         try:
             await update.callback_query.edit_message_text(message_text, reply_markup=reply_markup) # No parse_mode
         except telegram.error.BadRequest as e: # If message is identical or other issue
@@ -804,11 +869,14 @@ async def admin_paginate_subs(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
     action = query.data
     
-    current_page = context.user_data.get('admin_delete_page', 0)
+    page_cursors = context.user_data.setdefault('admin_delete_cursors', [None])
     if action == "admin_del_page_prev":
-        context.user_data['admin_delete_page'] = max(0, current_page - 1)
+        if len(page_cursors) > 1:
+            page_cursors.pop()
     elif action == "admin_del_page_next":
-        context.user_data['admin_delete_page'] = current_page + 1
+        next_cursor = context.user_data.get('admin_delete_next_cursor')
+        if next_cursor is not None:
+            page_cursors.append(next_cursor)
         
     return await admin_delete_subscription_start(update, context)
 
@@ -830,7 +898,7 @@ async def admin_sub_chosen_for_deletion(update: Update, context: ContextTypes.DE
         return AdminConversationState.ADMIN_LIST_SUBS.value
 
     # Get subscription details using the admin-specific function
-    subscription = get_subscription_for_admin(sub_db_id_to_delete)
+    subscription = await get_subscription_for_admin(sub_db_id_to_delete)
     
     if not subscription:
         msg = f"Subscription with DB ID {sub_db_id_to_delete} not found." # No parse_mode
@@ -841,10 +909,10 @@ async def admin_sub_chosen_for_deletion(update: Update, context: ContextTypes.DE
     context.user_data['sub_to_delete_id'] = sub_db_id_to_delete
     context.user_data['sub_to_delete_details'] = subscription
 
-    s_id, s_user_id, s_status, s_key_ids, s_countries = subscription
+    s_id, s_user_id, s_status, s_keys = subscription
     
-    countries_str = s_countries or "N/A"
-    key_ids_str = s_key_ids or "N/A"
+    countries_str = ", ".join(key.country_code for key in s_keys) or "N/A"
+    key_ids_str = ", ".join(str(key.outline_key_id) for key in s_keys if key.outline_key_id) or "N/A"
 
     text = (
         f"Are you sure you want to delete this subscription?\n"
@@ -879,40 +947,27 @@ async def admin_confirm_delete_action(update: Update, context: ContextTypes.DEFA
             context.user_data.clear()
             return ConversationHandler.END
 
-        s_id, s_user_id, current_status, s_key_ids, s_countries = sub_details
+        s_id, s_user_id, current_status, s_keys = sub_details
         
         all_keys_deleted = True
+        keys_to_delete = [key for key in s_keys if key.outline_key_id]
         
-        # Check if there are keys and countries to delete
-        if s_key_ids and s_countries:
-            key_ids = s_key_ids.split(',')
-            countries = s_countries.split(',')
-            
-            if len(key_ids) != len(countries):
-                logger.error(f"Admin Delete: Mismatch between key count ({len(key_ids)}) and country count ({len(countries)}) for sub {sub_db_id}.")
+        # Check if there are keys to delete
+        if keys_to_delete:
+            result = await key_revoker.revoke(keys_to_delete)
+            for key, error in result.failed:
+                logger.error(f"Admin {update.effective_user.id} FAILED to delete Outline key {key.outline_key_id} "
+                             f"from {key.country_code}: {error}")
+            if result.failed:
                 all_keys_deleted = False
-            else:
-                for i, key_id in enumerate(key_ids):
-                    country = countries[i]
-                    try:
-                        outline_client = get_outline_client(country)
-                        if outline_client:
-                            if delete_outline_key(outline_client, str(key_id)):
-                                logger.info(f"Admin {update.effective_user.id} deleted Outline key {key_id} from {country}.")
-                            else:
-                                logger.error(f"Admin {update.effective_user.id} FAILED to delete Outline key {key_id} from {country}.")
-                                all_keys_deleted = False
-                        else:
-                            logger.error(f"Admin {update.effective_user.id}: No Outline client for {country}. Key {key_id} not deleted.")
-                            all_keys_deleted = False
-                    except Exception as e:
-                        logger.error(f"Admin {update.effective_user.id}: Exception deleting key {key_id} from {country}: {e}")
-                        all_keys_deleted = False
+                await add_dead_letter_keys(sub_db_id, result.failed, "admin")
+            logger.info(f"Admin {update.effective_user.id} deleted {result.stats['deleted']}/{len(keys_to_delete)} "
+                        f"Outline key(s) of sub {sub_db_id}.")
         else:
             logger.info(f"Admin {update.effective_user.id}: No Outline keys found for sub {sub_db_id} to delete.")
 
         # Update DB regardless of key deletion status
-        db_updated = cancel_subscription_by_admin(sub_db_id)
+        db_updated = await cancel_subscription_by_admin(sub_db_id, s_user_id)
         
         if all_keys_deleted and db_updated:
             await query.edit_message_text(f"✅ Subscription DB ID {sub_db_id} cancelled. All Outline keys deleted.", parse_mode=None)
@@ -925,7 +980,8 @@ async def admin_confirm_delete_action(update: Update, context: ContextTypes.DEFA
 
     context.user_data.pop('sub_to_delete_id', None)
     context.user_data.pop('sub_to_delete_details', None)
-    context.user_data.pop('admin_delete_page', None)
+    for key in ('admin_delete_cursors', 'admin_delete_next_cursor', 'admin_delete_total'):
+        context.user_data.pop(key, None)
     return ConversationHandler.END
 
 async def admin_cancel_delete_flow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -950,7 +1006,7 @@ async def admin_delete_subscription(update: Update, context: ContextTypes.DEFAUL
     sub_id = int(query.data.split('_')[2])  # admin_del_123 -> 123
     
     # Get subscription details
-    subscription = get_subscription_for_admin(sub_id)
+    subscription = await get_subscription_for_admin(sub_id)
     if not subscription:
         await query.edit_message_text(
             "❌ Error: Subscription not found.",
@@ -960,32 +1016,21 @@ async def admin_delete_subscription(update: Update, context: ContextTypes.DEFAUL
         )
         return ConversationHandler.END
     
-    user_id = subscription[1]
-    key_ids = subscription[3].split(',') if subscription[3] else []
-    countries = subscription[4].split(',') if subscription[4] else []
+    user_id = subscription.user_id
     
-    # Delete Outline keys for each country
-    deleted_keys = []
-    failed_keys = []
-    
-    for i, country in enumerate(countries):
-        if i < len(key_ids) and key_ids[i]:
-            try:
-                outline_client = get_outline_client(country)
-                if outline_client:
-                    deleted = delete_outline_key(outline_client, key_ids[i])
-                    if deleted:
-                        deleted_keys.append(f"{country} ({key_ids[i]})")
-                    else:
-                        failed_keys.append(f"{country} ({key_ids[i]})")
-                else:
-                    failed_keys.append(f"{country} (no client)")
-            except Exception as e:
-                logger.error(f"Error deleting key {key_ids[i]} for {country}: {e}")
-                failed_keys.append(f"{country} (error)")
+    # Delete the Outline keys of every country at once
+    keys = [key for key in subscription.keys if key.outline_key_id]
+    result = await key_revoker.revoke(keys)
+    failed = {key: error for key, error in result.failed}
+    deleted_keys = [f"{key.country_code} ({key.outline_key_id})" for key in keys if key not in failed]
+    failed_keys = [f"{key.country_code} ({key.outline_key_id})" for key in keys if key in failed]
+    for key, error in result.failed:
+        logger.error(f"Error deleting key {key.outline_key_id} for {key.country_code}: {error}")
+    if result.failed:
+        await add_dead_letter_keys(sub_id, result.failed, "admin")
     
     # Cancel the subscription in database
-    db_updated = cancel_subscription_by_admin(sub_id)
+    db_updated = await cancel_subscription_by_admin(sub_id, user_id)
     
     # Prepare result message
     if deleted_keys and db_updated:
@@ -1074,12 +1119,11 @@ async def menu_my_subscriptions_handler(update: Update, context: ContextTypes.DE
     
     # Check for VLESS subscriptions first
     try:
-        init_vless_db()
-        vless_subscription = get_user_subscription(user_id)
+        vless_subscription = await get_user_subscription(user_id)
         if vless_subscription:
             # Create a dummy active_subs list with user_id for the function to work
             dummy_active_subs = [(user_id,)]
-            message, keyboard = build_my_subscriptions_message_and_keyboard(dummy_active_subs)
+            message, keyboard = await build_my_subscriptions_message_and_keyboard(dummy_active_subs)
             keyboard.append([InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_menu")])
             await context.bot.send_message(
                 chat_id=chat_id,
@@ -1197,20 +1241,83 @@ async def post_init(application: Application) -> None:
     except Exception as e:
         logger.error(f"Could not set instruction commands for admin {ADMIN_USER_ID}: {e}")
 
+async def bind_db_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Key this update's database session on its user, so replica reads see the user's own writes."""
+    set_db_session(update.effective_user.id if update.effective_user else None)
+
 async def log_all_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"Received message: {update.message.text if update.message else 'No text'} from user {update.effective_user.id if update.effective_user else 'Unknown'}")
 
 # --- Main Function ---
 async def main() -> None:
     """Entry point for the bot: initializes the database, sets up handlers, and starts polling."""
-    init_db()
+    await init_db()
+    await run_db(init_vless_db)
     logger.info("Database initialized.")
+    await warm_known_users()
+
+    # Every outbound message goes through one scheduler: global and per-chat token buckets, priority lanes
+    message_scheduler = MessageScheduler(
+        global_rate=TELEGRAM_GLOBAL_RATE,
+        chat_rate=TELEGRAM_CHAT_RATE,
+        chat_burst=TELEGRAM_CHAT_BURST,
+        max_queued_per_lane=TELEGRAM_QUEUE_MAX_PER_LANE,
+        max_retries=TELEGRAM_MAX_RETRIES,
+    )
+    application = (
+        Application.builder().token(TELEGRAM_BOT_TOKEN).job_queue(JobQueue()).rate_limiter(message_scheduler)
+        .post_init(post_init).build()
+    )
 
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).job_queue(JobQueue()).post_init(post_init).build()
+    # Expiry sweeps are woken by the in-memory expiry timeline when a subscription is due; the
+    # reconcile job reloads it from the database to catch writes made by other processes
+    expiry_timeline = create_expiry_timeline(application.bot)
+    add_end_date_listener(expiry_timeline.update)
 
     job_queue = application.job_queue
-    job_queue.run_repeating(check_expired_subscriptions, interval=60, first=10, name="expiry_check_short_interval")
-    logger.info("Scheduled job for checking expired subscriptions.")
+
+    async def on_elected():
+        await expiry_timeline.start()
+        logger.info("Expiry timeline loaded.")
+        # Revocations queued before a restart (or by the previous leader) are picked up here
+        job_queue.run_once(recover_key_revocations, 5, name="recover_key_revocations")
+
+    async def on_demoted():
+        await expiry_timeline.stop()
+
+    # With several processes (gunicorn workers, overlapping deploys) only the lease holder runs
+    # the jobs below that touch shared state; every process still serves its own updates
+    leader_elector = None
+    if SCHEDULER_LEADER_ELECTION:
+        holder = f"{socket.gethostname()}:{os.getpid()}"
+        leader_elector = LeaderElector(
+            create_scheduler_lease("scheduler", holder, SCHEDULER_LEASE_TTL),
+            ttl=SCHEDULER_LEASE_TTL,
+            interval=SCHEDULER_LEASE_INTERVAL,
+            on_elected=on_elected,
+            on_demoted=on_demoted,
+        )
+
+    job_queue.run_repeating(leader_only(reconcile_expiry_timeline), interval=EXPIRY_RECONCILE_INTERVAL,
+                            first=EXPIRY_RECONCILE_INTERVAL, name="reconcile_expiry_timeline")
+    job_queue.run_repeating(leader_only(send_due_renewal_reminders), interval=RENEWAL_REMINDER_INTERVAL, first=20,
+                            name="send_due_renewal_reminders")
+    logger.info("Scheduled jobs for expiry reconciliation and renewal reminders.")
+    job_queue.run_repeating(leader_only(process_key_revocations), interval=KEY_REVOCATION_INTERVAL, first=15,
+                            name="process_key_revocations")
+    job_queue.run_repeating(leader_only(db_maintenance), interval=DB_MAINTENANCE_INTERVAL, first=300,
+                            name="db_maintenance")
+    # Profile updates are queued in this process's memory, so every process flushes its own
+    job_queue.run_repeating(flush_user_profiles, interval=USER_PROFILE_FLUSH_INTERVAL, first=USER_PROFILE_FLUSH_INTERVAL,
+                            name="flush_user_profiles")
+    job_queue.run_repeating(leader_only(archive_finished_subscriptions), interval=SUBSCRIPTION_ARCHIVE_INTERVAL,
+                            first=900, name="archive_finished_subscriptions")
+    if KEY_POOL_LOW_WATER > 0:
+        job_queue.run_repeating(leader_only(refill_key_pools), interval=KEY_POOL_REFILL_INTERVAL, first=30,
+                                name="refill_key_pools")
+    if DB_DUAL_WRITE:
+        job_queue.run_repeating(leader_only(backend_consistency_check), interval=DB_CONSISTENCY_CHECK_INTERVAL,
+                                first=60, name="backend_consistency_check")
 
     # Add conversation handler for user subscription flow
     user_conv_handler = ConversationHandler(
@@ -1303,6 +1410,7 @@ async def main() -> None:
         name="admin_delete_conversation",
     )
 
+    application.add_handler(TypeHandler(Update, bind_db_session), group=-1)
     application.add_handler(user_conv_handler)
     application.add_handler(vless_conv_handler)
     application.add_handler(admin_del_conv_handler)
@@ -1351,11 +1459,15 @@ async def main() -> None:
     try:
         # Use a more explicit polling approach with better error handling
         await application.initialize()
+        if leader_elector:
+            await leader_elector.start()
         await application.start()
         await application.updater.start_polling(
             drop_pending_updates=True,
             allowed_updates=Update.ALL_TYPES
         )
+        if not leader_elector:
+            await on_elected()
         
         # Keep the bot running
         try:
@@ -1369,10 +1481,19 @@ async def main() -> None:
         raise
     finally:
         try:
+            if leader_elector:
+                await leader_elector.stop()
+            await expiry_timeline.stop()
             await application.stop()
             await application.shutdown()
         except Exception as e:
             logger.error(f"Error during shutdown: {e}")
+        try:
+            await flush_user_profile_updates()
+        except Exception as e:
+            logger.error(f"Could not flush queued user profile updates: {e}")
+        shutdown_outline_executor(wait=False)
+        shutdown_executor(wait=False)
 
     application.add_handler(CallbackQueryHandler(menu_support_handler, pattern="^menu_support$"))
 
@@ -1385,7 +1506,7 @@ async def handle_renewal(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_id = update.effective_user.id
     
     # Get subscription details
-    subscription = get_subscription_by_id(sub_id)
+    subscription = await get_subscription_by_id(sub_id)
     
     if not subscription or subscription[1] != user_id:
         await query.edit_message_text(
@@ -1413,8 +1534,8 @@ async def handle_cancel_expired(update: Update, context: ContextTypes.DEFAULT_TY
     user_id = update.effective_user.id
     
     # Get subscription details
-    subscription = get_subscription_for_admin(sub_id)
-    if not subscription or subscription[1] != user_id:  # user_id is the 2nd column
+    subscription = await get_subscription_for_admin(sub_id)
+    if not subscription or subscription.user_id != user_id:
         await query.edit_message_text(
             "❌ Error: Subscription not found or you don't have permission to cancel it.",
             reply_markup=InlineKeyboardMarkup([[
@@ -1423,31 +1544,20 @@ async def handle_cancel_expired(update: Update, context: ContextTypes.DEFAULT_TY
         )
         return ConversationHandler.END
     
-    # Get key IDs and countries
-    key_ids = subscription[3].split(',') if subscription[3] else []
-    countries = subscription[4].split(',') if subscription[4] else []
-    
-    # Delete Outline keys for each country
-    deleted_count = 0
-    total_keys = len(key_ids)
+    # Keys that still exist on the Outline servers
+    keys = [key for key in subscription.keys if key.outline_key_id]
     
-    for i, country in enumerate(countries):
-        if i < len(key_ids) and key_ids[i]:
-            try:
-                outline_client = get_outline_client(country)
-                if outline_client:
-                    deleted = delete_outline_key(outline_client, key_ids[i])
-                    if deleted:
-                        deleted_count += 1
-                    else:
-                        print(f"Failed to delete key {key_ids[i]} for {country}")
-                else:
-                    print(f"Could not connect to Outline server for {country}")
-            except Exception as e:
-                print(f"Error deleting key {key_ids[i]} for {country}: {e}")
+    # Delete the Outline keys of every country at once
+    result = await key_revoker.revoke(keys)
+    deleted_count = result.stats["deleted"]
+    total_keys = len(keys)
+    for key, error in result.failed:
+        print(f"Failed to delete key {key.outline_key_id} for {key.country_code}: {error}")
+    if result.failed:
+        await add_dead_letter_keys(sub_id, result.failed, "user_cancel")
     
     # Mark subscription as expired
-    mark_subscription_expired(sub_id)
+    await mark_subscription_expired(sub_id, user_id)
     
     # Send result message
     if deleted_count == total_keys:
@@ -1614,107 +1724,7 @@ async def handle_global_subscription_callbacks(update: Update, context: ContextT
         return ConversationHandler.END
 
     elif query.data.startswith("countries_"):
-        country_package_id = query.data[len("countries_"):]
-        subscription_id = context.user_data.get('pending_subscription_id')
-        payment_id = context.user_data.get('payment_id')
-        duration_id = context.user_data.get('selected_duration')
-        
-        if not subscription_id or not payment_id or not duration_id:
-            await query.edit_message_text(
-                "❌ Ошибка: Отсутствует информация о подписке. Пожалуйста, начните сначала с /subscribe",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("⬅️ Назад в меню", callback_data="back_to_menu")
-                ]])
-            )
-            return ConversationHandler.END
-        
-        try:
-            # Get package details
-            package = COUNTRY_PACKAGES[country_package_id]
-            duration_plan = DURATION_PLANS[duration_id]
-            
-            # Update subscription with country package
-            update_subscription_country_package(subscription_id, country_package_id)
-            
-            # Create Outline keys for each country in the package
-            countries = package.get('countries', [])
-            created_keys = []
-            
-            for country in countries:
-                try:
-                    # Get Outline client for this country
-                    outline_client = get_outline_client(country)
-                    if not outline_client:
-                        logger.error(f"Failed to get Outline client for country: {country}")
-                        continue
-                    
-                    # Create VPN key for this country
-                    outline_key_id, outline_access_url = create_outline_key(outline_client)
-                    
-                    if outline_key_id and outline_access_url:
-                        # Add country to subscription
-                        add_subscription_country(
-                            subscription_id=subscription_id,
-                            country_code=country,
-                            outline_key_id=outline_key_id,
-                            outline_access_url=outline_access_url
-                        )
-                        created_keys.append(country)
-                        
-                        # Rename the key for better identification
-                        user_name = update.effective_user.first_name or update.effective_user.username or f"user_{update.effective_user.id}"
-                        key_name = f"{user_name}_{country}_{subscription_id}"
-                        rename_outline_key(outline_client, outline_key_id, key_name)
-                        
-                        logger.info(f"Created VPN key for {country}: {outline_key_id}")
-                    else:
-                        logger.error(f"Failed to create Outline key for country: {country}")
-                        
-                except Exception as e:
-                    logger.error(f"Error creating VPN key for {country}: {e}")
-            
-            if not created_keys:
-                raise Exception("Failed to create any VPN keys")
-            
-            # Activate the subscription
-            activate_subscription(
-                subscription_db_id=subscription_id,
-                duration_days=duration_plan['duration_days'],
-                payment_id=payment_id
-            )
-            
-            countries_text = ", ".join([f"{OUTLINE_SERVERS[country]['flag']} {OUTLINE_SERVERS[country]['name']}" 
-                                      for country in created_keys])
-            
-            success_message = (
-                f"🎉 Ваша VPN подписка теперь активна!\n\n"
-                f"Срок: {duration_plan['name']}\n"
-                f"Пакет: {package['name']}\n"
-                f"Страны: {countries_text}\n"
-                f"Истекает: {(datetime.now() + timedelta(days=duration_plan['duration_days'])).strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-                f"Используйте /my_subscriptions, чтобы получить ваши ключи доступа к VPN."
-            )
-            
-            await query.edit_message_text(
-                success_message,
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("⬅️ Назад в меню", callback_data="back_to_menu")
-                ]])
-            )
-            
-            # Clear user data
-            context.user_data.clear()
-            return ConversationHandler.END
-            
-        except Exception as e:
-            logger.error(f"Error activating subscription: {e}")
-            await query.edit_message_text(
-                "❌ Произошла ошибка при активации вашей подписки. Пожалуйста, обратитесь в поддержку.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("⬅️ Назад в меню", callback_data="back_to_menu")
-                ]])
-            )
-            return ConversationHandler.END
+        return await activate_chosen_package(update, context)
 
     elif query.data == "confirm_payment":
         payment_id = context.user_data.get('payment_id')
@@ -1758,7 +1768,7 @@ async def handle_global_subscription_callbacks(update: Update, context: ContextT
                     
                     if renewing_sub_id:
                         # This is a renewal - get existing subscription to find current end_date
-                        existing_sub = get_subscription_by_id(renewing_sub_id)
+                        existing_sub = await get_subscription_by_id(renewing_sub_id)
                         if not existing_sub:
                             await query.edit_message_text("Ошибка: Не удалось найти подписку для продления.")
                             return ConversationHandler.END
@@ -1773,7 +1783,7 @@ async def handle_global_subscription_callbacks(update: Update, context: ContextT
                         new_end_date = current_end_date + timedelta(days=plan['duration_days'])
 
                         # Update existing subscription using abstraction
-                        renew_subscription(renewing_sub_id, user_id, new_end_date, payment_id)
+                        await renew_subscription(renewing_sub_id, user_id, new_end_date, payment_id)
 
                         success_message = (
                             f"✅ Оплата прошла успешно! Ваша подписка была продлена.\n\n"
@@ -1789,7 +1799,7 @@ async def handle_global_subscription_callbacks(update: Update, context: ContextT
                         return ConversationHandler.END
                     else:
                         # This is a new subscription - create pending subscription
-                        subscription_id = create_subscription_record(
+                        subscription_id = await create_subscription_record(
                             user_id=user_id,
                             duration_plan_id=duration_id,
                             duration_days=plan['duration_days']
@@ -1989,10 +1999,7 @@ async def vless_subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"Processing VLESS subscription for user {user_id}")
     
     try:
-        # 1. Ensure VLESS DB table exists
-        logger.info("Initializing VLESS database...")
-        init_vless_db()
-        logger.info("VLESS database initialized")
+        # 1. The VLESS schema is migrated once at startup (see main())
         
         # 2. Add VLESS user (dummy for now)
         logger.info("Getting server config...")
@@ -2012,7 +2019,7 @@ async def vless_subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
         from datetime import datetime, timedelta
         end_date = (datetime.now() + timedelta(days=7)).strftime("%Y-%m-%d %H:%M:%S")
         logger.info(f"Storing subscription with end date: {end_date}")
-        add_vless_subscription(user_id, vless_uuid, vless_uri, end_date)
+        await run_db(add_vless_subscription, user_id, vless_uuid, vless_uri, end_date)
         logger.info("Subscription stored in database")
         
         # 4. Send VLESS URI to user
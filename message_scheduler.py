@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Outbound Telegram rate limiting: token buckets, priority lanes and RetryAfter backoff,
+installed as the Application's rate_limiter.
+"""
+
+import asyncio
+import enum
+import logging
+import time
+from collections import deque
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import stats_registry
+
+logger = logging.getLogger(__name__)
+
+# Tickets looked at per lane when the head of the lane is waiting on its chat's bucket
+_SCAN_LIMIT = 64
+# Latency samples kept per lane
+_SAMPLES = 1000
+
+
+class Priority(enum.IntEnum):
+    """Send priority, most urgent first."""
+    PAYMENT = 0    # payment/activation confirmations and direct replies to the user
+    EXPIRY = 1     # expiry notices and key deactivation messages
+    REMINDER = 2   # renewal reminders
+    BROADCAST = 3  # announcements to many users
+
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `burst`."""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now):
+        """Seconds until a token is available."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class _Ticket:
+    __slots__ = ("chat_id", "future", "enqueued_at")
+
+    def __init__(self, chat_id, future, enqueued_at):
+        self.chat_id = chat_id
+        self.future = future
+        self.enqueued_at = enqueued_at
+
+
+def _snapshot(samples):
+    """Copy a deque that the event loop may append to while another thread (/status) reads it."""
+    while True:
+        try:
+            return tuple(samples)
+        except RuntimeError:  # deque mutated during iteration
+            continue
+
+
+class _LaneStats:
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.queue_wait_ms = deque(maxlen=_SAMPLES)
+        self.latency_ms = deque(maxlen=_SAMPLES)
+
+    def as_dict(self, depth):
+        def summary(samples):
+            ordered = sorted(_snapshot(samples))
+            if not ordered:
+                return {"avg": 0.0, "p95": 0.0, "max": 0.0}
+            return {
+                "avg": round(sum(ordered) / len(ordered), 1),
+                "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 1),
+                "max": round(ordered[-1], 1),
+            }
+        return {
+            "depth": depth,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "queue_wait_ms": summary(self.queue_wait_ms),
+            "latency_ms": summary(self.latency_ms),
+        }
+
+
+class MessageScheduler(BaseRateLimiter):
+    """Token-bucket, priority-lane rate limiter for all chat-bound Bot API calls."""
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, max_queued_per_lane=10000, max_retries=3,
+                 max_chat_buckets=10000):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_queued_per_lane = max_queued_per_lane
+        self.max_retries = max_retries
+        self.max_chat_buckets = max_chat_buckets
+        self._lanes = [deque() for _ in Priority]
+        self._lane_stats = [_LaneStats() for _ in Priority]
+        self._room = None
+        self._global = None
+        self._chats = {}
+        self._paused_until = 0.0
+        self._retry_after_count = 0
+        self._wakeup = None
+        self._dispatcher = None
+
+    async def initialize(self):
+        now = time.monotonic()
+        self._global = TokenBucket(self.global_rate, self.global_rate, now)
+        self._room = [asyncio.Semaphore(self.max_queued_per_lane) for _ in Priority]
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+        stats_registry.register("telegram_outbound", self.stats)
+
+    async def shutdown(self):
+        stats_registry.unregister("telegram_outbound", self.stats)
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for lane in self._lanes:
+            for ticket in lane:
+                if not ticket.future.done():
+                    ticket.future.cancel()
+            lane.clear()
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.max_chat_buckets:
+                # Forget chats whose bucket has refilled: a fresh bucket is identical
+                self._chats = {cid: b for cid, b in self._chats.items() if not b.full(now)}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        return bucket
+
+    def _pick(self, now):
+        """Pop the most urgent ticket whose chat can send now; else return the shortest wait."""
+        shortest = None
+        for lane in self._lanes:
+            for index, ticket in enumerate(lane):
+                if index >= _SCAN_LIMIT:
+                    break
+                if ticket.future.done():  # caller gave up
+                    del lane[index]
+                    return None, 0.0
+                delay = self._chat_bucket(ticket.chat_id, now).delay(now)
+                if delay <= 0:
+                    del lane[index]
+                    return ticket, None
+                shortest = delay if shortest is None else min(shortest, delay)
+        return None, shortest
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            wait = self._global.delay(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            self._wakeup.clear()
+            ticket, wait = self._pick(now)
+            if ticket is None:
+                if wait == 0.0:
+                    continue
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._global.take(now)
+            self._chat_bucket(ticket.chat_id, now).take(now)
+            ticket.future.set_result(None)
+
+    async def _acquire(self, priority, chat_id, front=False):
+        """Wait until this call may be sent."""
+        loop = asyncio.get_running_loop()
+        room = self._room[priority]
+        await room.acquire()
+        try:
+            ticket = _Ticket(chat_id, loop.create_future(), time.monotonic())
+            if front:
+                self._lanes[priority].appendleft(ticket)
+            else:
+                self._lanes[priority].append(ticket)
+            self._wakeup.set()
+            await ticket.future
+            return ticket.enqueued_at
+        finally:
+            room.release()
+
+    def _pause(self, retry_after):
+        seconds = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._retry_after_count += 1
+        logger.warning(f"Telegram flood limit hit: pausing outbound messages for {seconds:.1f}s")
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+
+        priority = Priority(rate_limit_args) if rate_limit_args is not None else Priority.PAYMENT
+        stats = self._lane_stats[priority]
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            enqueued_at = await self._acquire(priority, chat_id, front=attempt > 0)
+            granted = time.monotonic()
+            stats.queue_wait_ms.append((granted - enqueued_at) * 1000)
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self._pause(e.retry_after)
+                attempt += 1
+                stats.retried += 1
+                if attempt > self.max_retries:
+                    stats.failed += 1
+                    raise
+                continue
+            except Exception:
+                stats.failed += 1
+                raise
+            stats.sent += 1
+            stats.latency_ms.append((time.monotonic() - started) * 1000)
+            return result
+
+    def stats(self):
+        paused_for = max(0.0, self._paused_until - time.monotonic())
+        return {
+            "lanes": {priority.name.lower(): self._lane_stats[priority].as_dict(len(self._lanes[priority]))
+                      for priority in Priority},
+            "queued": sum(len(lane) for lane in self._lanes),
+            "retry_after": self._retry_after_count,
+            "paused_for_s": round(paused_for, 1),
+            "chat_buckets": len(self._chats),
+            "global_rate": self.global_rate,
+            "chat_rate": self.chat_rate,
+        }
@@ -1,14 +1,117 @@
 #!/usr/bin/env python3
 """
 Migration script to transfer data from SQLite to PostgreSQL
+
+Each table is read from SQLite in primary-key order, --chunk-size rows at a
+time. Each chunk is loaded with COPY FROM STDIN into a staging table, merged
+with INSERT ... ON CONFLICT DO UPDATE and committed. The last copied key is
+then saved to a checkpoint file, so an interrupted run resumes where it
+stopped. At most one chunk is re-sent, and a re-sent or re-migrated row
+overwrites the copy already in PostgreSQL with the current SQLite values.
+
+After loading, the SERIAL sequences are moved past the copied ids. Every
+table is then verified by comparing row checksums on both sides, not just
+row counts. With POSTGRES_REPLICA_URL set, the verification scans run on
+the read replica (once it has replayed the load), so they stay off the
+primary.
+
+In dual-write mode the shadow inserts subscriptions under the ids SQLite
+assigned, which does not advance their sequence. Run --reset-sequences once
+at cutover, before making PostgreSQL the primary (DB_PRIMARY=postgresql).
+
+Usage:
+    python migrate_to_postgresql.py [--chunk-size N] [--checkpoint FILE] [--restart] [--verify-only]
+                                    [--reset-sequences]
 """
 
-import sqlite3
-import psycopg2
+import argparse
+import hashlib
+import io
+import json
 import os
-import sys
+import sqlite3
+import time
 from datetime import datetime
-from config import DB_PATH, POSTGRES_URL, USE_POSTGRESQL
+from typing import FrozenSet, NamedTuple, Optional, Tuple
+
+import psycopg2
+from config import DB_PATH, POSTGRES_URL, POSTGRES_REPLICA_URL, USE_POSTGRESQL
+from db_migrations import apply_migrations
+from db_rows import iter_cursor, to_datetime
+
+DEFAULT_CHUNK_SIZE = 5000
+DEFAULT_CHECKPOINT = "migrate_to_postgresql.checkpoint.json"
+REPLICA_CATCH_UP_TIMEOUT = 120  # seconds to wait for the replica before verifying on the primary
+
+
+class TableSpec(NamedTuple):
+    name: str
+    key: str
+    columns: Tuple[str, ...]
+    timestamp_columns: FrozenSet[str]
+    # Rows that would violate a PostgreSQL foreign key (SQLite never enforced them) are skipped
+    source_filter: Optional[str] = None
+    serial: bool = True
+
+
+# In dependency order: parents before children
+TABLES = (
+    TableSpec(
+        "users", "user_id",
+        ("user_id", "username", "first_name", "join_date"),
+        frozenset({"join_date"}),
+        serial=False,
+    ),
+    TableSpec(
+        "subscriptions", "id",
+        ("id", "user_id", "duration_plan_id", "country_package_id", "start_date", "end_date", "status", "payment_id",
+         "created_at", "reminder_stage", "reminder_sent_at"),
+        frozenset({"start_date", "end_date", "created_at", "reminder_sent_at"}),
+        source_filter="user_id IS NULL OR user_id IN (SELECT user_id FROM users)",
+    ),
+    TableSpec(
+        "subscription_countries", "id",
+        ("id", "subscription_id", "country_code", "outline_key_id", "outline_access_url"),
+        frozenset(),
+        source_filter="subscription_id IS NULL OR subscription_id IN (SELECT id FROM subscriptions)",
+    ),
+    TableSpec(
+        "vless_subscriptions", "id",
+        ("id", "user_id", "vless_uuid", "vless_uri", "start_date", "end_date", "expiry_date", "status"),
+        frozenset({"start_date", "end_date", "expiry_date"}),
+        source_filter="user_id IS NULL OR user_id IN (SELECT user_id FROM users)",
+    ),
+    # Archive tables keep the ids of the live rows they came from, so they have no sequences
+    TableSpec(
+        "subscriptions_archive", "id",
+        ("id", "user_id", "duration_plan_id", "country_package_id", "start_date", "end_date", "status", "payment_id",
+         "created_at", "archived_at"),
+        frozenset({"start_date", "end_date", "created_at", "archived_at"}),
+        serial=False,
+    ),
+    TableSpec(
+        "subscription_countries_archive", "id",
+        ("id", "subscription_id", "country_code", "outline_key_id", "outline_access_url", "archived_at"),
+        frozenset({"archived_at"}),
+        serial=False,
+    ),
+    TableSpec(
+        "key_revocations", "subscription_id",
+        ("subscription_id", "user_id", "due_at", "attempts", "pending_keys", "last_error", "created_at"),
+        frozenset({"due_at", "created_at"}),
+        serial=False,
+    ),
+    TableSpec(
+        "key_dead_letters", "id",
+        ("id", "subscription_id", "country_code", "outline_key_id", "source", "last_error", "created_at"),
+        frozenset({"created_at"}),
+    ),
+    TableSpec(
+        "key_pool", "id",
+        ("id", "country_code", "server_id", "outline_key_id", "outline_access_url", "created_at"),
+        frozenset({"created_at"}),
+    ),
+)
 
 def get_sqlite_connection():
     """Get SQLite connection."""
@@ -25,144 +128,243 @@ def get_postgresql_connection():
         print(f"Failed to connect to PostgreSQL: {e}")
         return None
 
-def migrate_users(sqlite_conn, postgres_conn):
-    """Migrate users table."""
-    print("Migrating users...")
-    
+def load_checkpoint(path):
+    """Load the progress saved by an earlier run (an empty checkpoint if there is none)."""
+    if not os.path.exists(path):
+        return {"source": DB_PATH, "tables": {}}
+    with open(path) as f:
+        return json.load(f)
+
+def save_checkpoint(path, checkpoint):
+    """Write the checkpoint atomically, so a crash never leaves a truncated file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def _source_where(table, after_key=None):
+    conditions = []
+    if table.source_filter:
+        conditions.append(f"({table.source_filter})")
+    if after_key is not None:
+        conditions.append(f"{table.key} > ?")
+    return f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+def _copy_value(value):
+    if value is None:
+        return "\\N"
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+def _copy_buffer(rows):
+    """Encode rows in COPY's text format."""
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_value(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    return buffer
+
+def _merge_sql(table, stage):
+    """INSERT the staged rows, updating rows whose key is already in PostgreSQL."""
+    columns = ", ".join(table.columns)
+    updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in table.columns if column != table.key)
+    return (f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {stage} "
+            f"ON CONFLICT ({table.key}) DO UPDATE SET {updates}")
+
+def migrate_table(sqlite_conn, postgres_conn, table, chunk_size, checkpoint, checkpoint_path):
+    """Copy one table chunk by chunk, committing and checkpointing after each chunk."""
+    state = checkpoint["tables"].setdefault(table.name, {"last_key": None, "rows": 0, "done": False})
+    if state["done"]:
+        print(f"{table.name}: already migrated ({state['rows']} rows), skipping.")
+        return state["rows"]
+    if state["last_key"] is not None:
+        print(f"Resuming {table.name} after {table.key}={state['last_key']} ({state['rows']} rows already copied)...")
+    else:
+        print(f"Migrating {table.name}...")
+
     sqlite_cursor = sqlite_conn.cursor()
     postgres_cursor = postgres_conn.cursor()
-    
-    # Get all users from SQLite
-    sqlite_cursor.execute("SELECT user_id, username, first_name, join_date FROM users")
-    users = sqlite_cursor.fetchall()
-    
-    if not users:
-        print("No users to migrate.")
-        return
-    
-    # Insert users into PostgreSQL
-    for user in users:
-        try:
-            postgres_cursor.execute(
-                "INSERT INTO users (user_id, username, first_name, join_date) VALUES (%s, %s, %s, %s) ON CONFLICT (user_id) DO NOTHING",
-                user
-            )
-        except Exception as e:
-            print(f"Error inserting user {user[0]}: {e}")
-    
+
+    if table.source_filter:
+        sqlite_cursor.execute(f"SELECT COUNT(*) FROM {table.name} WHERE NOT ({table.source_filter})")
+        orphans = sqlite_cursor.fetchone()[0]
+        if orphans:
+            print(f"⚠️ Skipping {orphans} {table.name} rows that reference missing parent rows.")
+
+    columns = ", ".join(table.columns)
+    key_index = table.columns.index(table.key)
+    stage = f"_migrate_{table.name}"
+    postgres_cursor.execute(
+        f"CREATE TEMP TABLE IF NOT EXISTS {stage} (LIKE {table.name} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+    )
     postgres_conn.commit()
-    print(f"Migrated {len(users)} users.")
 
-def migrate_subscriptions(sqlite_conn, postgres_conn):
-    """Migrate subscriptions table."""
-    print("Migrating subscriptions...")
-    
-    sqlite_cursor = sqlite_conn.cursor()
-    postgres_cursor = postgres_conn.cursor()
-    
-    # Get all subscriptions from SQLite
-    sqlite_cursor.execute("""
-        SELECT id, user_id, duration_plan_id, country_package_id, 
-               start_date, end_date, status, payment_id 
-        FROM subscriptions
-    """)
-    subscriptions = sqlite_cursor.fetchall()
-    
-    if not subscriptions:
-        print("No subscriptions to migrate.")
-        return
-    
-    # Insert subscriptions into PostgreSQL
-    for sub in subscriptions:
+    started = time.monotonic()
+    copied = 0
+    while True:
+        after_key = state["last_key"]
+        params = (after_key, chunk_size) if after_key is not None else (chunk_size,)
+        sqlite_cursor.execute(
+            f"SELECT {columns} FROM {table.name} {_source_where(table, after_key)} ORDER BY {table.key} LIMIT ?",
+            params,
+        )
+        rows = sqlite_cursor.fetchall()
+        if not rows:
+            break
+
         try:
-            postgres_cursor.execute("""
-                INSERT INTO subscriptions (id, user_id, duration_plan_id, country_package_id, 
-                                         start_date, end_date, status, payment_id) 
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s) 
-                ON CONFLICT (id) DO NOTHING
-            """, sub)
-        except Exception as e:
-            print(f"Error inserting subscription {sub[0]}: {e}")
-    
-    postgres_conn.commit()
-    print(f"Migrated {len(subscriptions)} subscriptions.")
+            postgres_cursor.copy_expert(f"COPY {stage} ({columns}) FROM STDIN", _copy_buffer(rows))
+            postgres_cursor.execute(_merge_sql(table, stage))
+            postgres_conn.commit()
+        except Exception:
+            postgres_conn.rollback()
+            print(f"Error loading {table.name} rows {rows[0][key_index]}..{rows[-1][key_index]}")
+            raise
 
-def migrate_subscription_countries(sqlite_conn, postgres_conn):
-    """Migrate subscription_countries table."""
-    print("Migrating subscription countries...")
-    
-    sqlite_cursor = sqlite_conn.cursor()
+        copied += len(rows)
+        state["last_key"] = rows[-1][key_index]
+        state["rows"] += len(rows)
+        save_checkpoint(checkpoint_path, checkpoint)
+        elapsed = time.monotonic() - started
+        print(f"  {table.name}: {state['rows']} rows ({copied / elapsed if elapsed else 0:.0f} rows/s)")
+
+    state["done"] = True
+    save_checkpoint(checkpoint_path, checkpoint)
+    elapsed = time.monotonic() - started
+    rate = copied / elapsed if elapsed else 0
+    print(f"Migrated {copied} {table.name} rows in {elapsed:.1f}s ({rate:.0f} rows/s).")
+    return state["rows"]
+
+def reset_sequences(postgres_conn):
+    """Move every SERIAL sequence past the ids copied from SQLite."""
     postgres_cursor = postgres_conn.cursor()
-    
-    # Get all subscription countries from SQLite
-    sqlite_cursor.execute("""
-        SELECT id, subscription_id, country_code, outline_key_id, outline_access_url 
-        FROM subscription_countries
-    """)
-    subscription_countries = sqlite_cursor.fetchall()
-    
-    if not subscription_countries:
-        print("No subscription countries to migrate.")
-        return
-    
-    # Insert subscription countries into PostgreSQL
-    for sc in subscription_countries:
-        try:
-            postgres_cursor.execute("""
-                INSERT INTO subscription_countries (id, subscription_id, country_code, 
-                                                   outline_key_id, outline_access_url) 
-                VALUES (%s, %s, %s, %s, %s) 
-                ON CONFLICT (id) DO NOTHING
-            """, sc)
-        except Exception as e:
-            print(f"Error inserting subscription country {sc[0]}: {e}")
-    
+    for table in TABLES:
+        if not table.serial:
+            continue
+        postgres_cursor.execute(f'''
+            SELECT setval(pg_get_serial_sequence(%s, %s),
+                          COALESCE((SELECT MAX({table.key}) FROM {table.name}), 0) + 1, false)
+        ''', (table.name, table.key))
+        print(f"{table.name}.{table.key} sequence now starts at {postgres_cursor.fetchone()[0]}")
     postgres_conn.commit()
-    print(f"Migrated {len(subscription_countries)} subscription countries.")
 
-def verify_migration(sqlite_conn, postgres_conn):
-    """Verify that migration was successful."""
-    print("\nVerifying migration...")
-    
-    sqlite_cursor = sqlite_conn.cursor()
+def _canonical(value, is_timestamp):
+    """Render a value the same way whichever backend it came from."""
+    if value is None:
+        return "\\N"
+    if is_timestamp:
+        try:
+            return to_datetime(value).isoformat(sep=" ")
+        except (TypeError, ValueError):
+            pass
+    return str(value)
+
+def _checksum(rows, table, block_size):
+    """Return (row count, overall sha256, [(first_key, last_key, block sha256)]) over ordered rows."""
+    flags = [column in table.timestamp_columns for column in table.columns]
+    key_index = table.columns.index(table.key)
+    total = hashlib.sha256()
+    blocks = []
+    block, first_key, count = None, None, 0
+    for row in rows:
+        if block is None:
+            block, first_key = hashlib.sha256(), row[key_index]
+        line = "\x1f".join(_canonical(value, flag) for value, flag in zip(row, flags)).encode() + b"\x1e"
+        total.update(line)
+        block.update(line)
+        count += 1
+        if count % block_size == 0:
+            blocks.append((first_key, row[key_index], block.hexdigest()))
+            block = None
+    if block is not None:
+        blocks.append((first_key, row[key_index], block.hexdigest()))
+    return count, total.hexdigest(), blocks
+
+def get_verification_connection(postgres_conn, timeout=REPLICA_CATCH_UP_TIMEOUT):
+    """Return (connection, is_replica) for the checksum scans: the replica once it has caught up, else the primary."""
+    if not POSTGRES_REPLICA_URL:
+        return postgres_conn, False
+    try:
+        replica_conn = psycopg2.connect(POSTGRES_REPLICA_URL, options="-c default_transaction_read_only=on")
+    except Exception as e:
+        print(f"Read replica unavailable ({e}); verifying on the primary.")
+        return postgres_conn, False
+
     postgres_cursor = postgres_conn.cursor()
-    
-    # Check users count
-    sqlite_cursor.execute("SELECT COUNT(*) FROM users")
-    sqlite_users_count = sqlite_cursor.fetchone()[0]
-    
-    postgres_cursor.execute("SELECT COUNT(*) FROM users")
-    postgres_users_count = postgres_cursor.fetchone()[0]
-    
-    print(f"Users: SQLite={sqlite_users_count}, PostgreSQL={postgres_users_count}")
-    
-    # Check subscriptions count
-    sqlite_cursor.execute("SELECT COUNT(*) FROM subscriptions")
-    sqlite_subs_count = sqlite_cursor.fetchone()[0]
-    
-    postgres_cursor.execute("SELECT COUNT(*) FROM subscriptions")
-    postgres_subs_count = postgres_cursor.fetchone()[0]
-    
-    print(f"Subscriptions: SQLite={sqlite_subs_count}, PostgreSQL={postgres_subs_count}")
-    
-    # Check subscription countries count
-    sqlite_cursor.execute("SELECT COUNT(*) FROM subscription_countries")
-    sqlite_sc_count = sqlite_cursor.fetchone()[0]
-    
-    postgres_cursor.execute("SELECT COUNT(*) FROM subscription_countries")
-    postgres_sc_count = postgres_cursor.fetchone()[0]
-    
-    print(f"Subscription Countries: SQLite={sqlite_sc_count}, PostgreSQL={postgres_sc_count}")
-    
-    # Check if counts match
-    if (sqlite_users_count == postgres_users_count and 
-        sqlite_subs_count == postgres_subs_count and 
-        sqlite_sc_count == postgres_sc_count):
+    postgres_cursor.execute("SELECT pg_current_wal_lsn()")
+    target_lsn = postgres_cursor.fetchone()[0]
+    postgres_conn.rollback()
+
+    deadline = time.monotonic() + timeout
+    replica_cursor = replica_conn.cursor()
+    while True:
+        replica_cursor.execute(
+            "SELECT pg_is_in_recovery(), COALESCE(pg_wal_lsn_diff(%s, pg_last_wal_replay_lsn()), 0)",
+            (target_lsn,),
+        )
+        in_recovery, behind_bytes = replica_cursor.fetchone()
+        replica_conn.rollback()
+        if not in_recovery or behind_bytes <= 0:
+            print("Verifying on the read replica.")
+            return replica_conn, True
+        if time.monotonic() > deadline:
+            print(f"Read replica is still {behind_bytes} bytes behind; verifying on the primary.")
+            replica_conn.close()
+            return postgres_conn, False
+        time.sleep(1)
+
+def verify_migration(sqlite_conn, postgres_conn, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Verify every table by comparing row counts and content checksums on both sides."""
+    print("\nVerifying migration...")
+
+    read_conn, is_replica = get_verification_connection(postgres_conn)
+    try:
+        return _verify_tables(sqlite_conn, read_conn, chunk_size)
+    finally:
+        if is_replica:
+            read_conn.close()
+
+def _verify_tables(sqlite_conn, postgres_conn, chunk_size):
+    success = True
+    for table in TABLES:
+        columns = ", ".join(table.columns)
+
+        sqlite_cursor = sqlite_conn.cursor()
+        sqlite_cursor.execute(f"SELECT {columns} FROM {table.name} {_source_where(table)} ORDER BY {table.key}")
+        sqlite_count, sqlite_sum, sqlite_blocks = _checksum(
+            iter_cursor(sqlite_cursor, chunk_size), table, chunk_size)
+
+        postgres_cursor = postgres_conn.cursor(name=f"verify_{table.name}")
+        postgres_cursor.itersize = chunk_size
+        postgres_cursor.execute(f"SELECT {columns} FROM {table.name} ORDER BY {table.key}")
+        try:
+            postgres_count, postgres_sum, postgres_blocks = _checksum(
+                iter_cursor(postgres_cursor, chunk_size), table, chunk_size)
+        finally:
+            postgres_cursor.close()
+            postgres_conn.rollback()
+
+        if sqlite_count == postgres_count and sqlite_sum == postgres_sum:
+            print(f"✅ {table.name}: {sqlite_count} rows, sha256 {sqlite_sum[:16]}")
+            continue
+
+        success = False
+        print(f"❌ {table.name}: SQLite={sqlite_count} rows (sha256 {sqlite_sum[:16]}), "
+              f"PostgreSQL={postgres_count} rows (sha256 {postgres_sum[:16]})")
+        for sqlite_block, postgres_block in zip(sqlite_blocks, postgres_blocks):
+            if sqlite_block != postgres_block:
+                print(f"   first difference in {table.key} range {sqlite_block[0]}..{sqlite_block[1]} "
+                      f"(PostgreSQL {postgres_block[0]}..{postgres_block[1]})")
+                break
+
+    if success:
         print("✅ Migration verification successful!")
-        return True
     else:
         print("❌ Migration verification failed!")
-        return False
+    return success
 
 def backup_sqlite():
     """Create a backup of the SQLite database."""
@@ -176,43 +378,77 @@ def backup_sqlite():
 
 def main():
     """Main migration function."""
+    parser = argparse.ArgumentParser(description="Copy the bot's SQLite database into PostgreSQL")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="rows per COPY batch")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT, help="progress file used to resume")
+    parser.add_argument("--restart", action="store_true", help="ignore saved progress and start over")
+    parser.add_argument("--verify-only", action="store_true", help="only compare checksums")
+    parser.add_argument("--reset-sequences", action="store_true",
+                        help="only move the SERIAL sequences past the current ids (dual-write cutover)")
+    args = parser.parse_args()
+
     print("=== SQLite to PostgreSQL Migration Tool ===")
-    
+
     # Check if PostgreSQL is enabled
     if not USE_POSTGRESQL:
         print("PostgreSQL is not enabled in configuration. Please set USE_POSTGRESQL=true")
         return
-    
+
     # Get connections
     sqlite_conn = get_sqlite_connection()
     if not sqlite_conn:
         print("Failed to connect to SQLite database.")
         return
-    
+
     postgres_conn = get_postgresql_connection()
     if not postgres_conn:
         print("Failed to connect to PostgreSQL database.")
         sqlite_conn.close()
         return
-    
+
     try:
-        # Create backup
-        backup_file = backup_sqlite()
-        
-        # Initialize PostgreSQL database
-        print("Initializing PostgreSQL database...")
-        from database_postgresql import init_db
-        init_db()
-        
+        if args.verify_only:
+            verify_migration(sqlite_conn, postgres_conn, args.chunk_size)
+            return
+        if args.reset_sequences:
+            reset_sequences(postgres_conn)
+            return
+
+        if args.restart and os.path.exists(args.checkpoint):
+            os.remove(args.checkpoint)
+        checkpoint = load_checkpoint(args.checkpoint)
+        if checkpoint.get("source") != DB_PATH:
+            print(f"Checkpoint {args.checkpoint} belongs to {checkpoint.get('source')}, not {DB_PATH}. "
+                  "Use --restart to start over.")
+            return
+
+        # Create backup (only once: a resumed run keeps the first backup)
+        if not checkpoint.get("backup"):
+            checkpoint["backup"] = backup_sqlite()
+            save_checkpoint(args.checkpoint, checkpoint)
+        backup_file = checkpoint["backup"]
+
+        # Bring both schemas up to date (this also upgrades a legacy single-country SQLite file)
+        print("Initializing database schemas...")
+        for component in ("core", "vless"):
+            apply_migrations(sqlite_conn, component, "sqlite")
+            apply_migrations(postgres_conn, component, "postgresql")
+
         # Perform migration
-        migrate_users(sqlite_conn, postgres_conn)
-        migrate_subscriptions(sqlite_conn, postgres_conn)
-        migrate_subscription_countries(sqlite_conn, postgres_conn)
-        
+        started = time.monotonic()
+        total_rows = sum(
+            migrate_table(sqlite_conn, postgres_conn, table, args.chunk_size, checkpoint, args.checkpoint)
+            for table in TABLES
+        )
+        elapsed = time.monotonic() - started
+        print(f"\nCopied {total_rows} rows in {elapsed:.1f}s ({total_rows / elapsed if elapsed else 0:.0f} rows/s).")
+        reset_sequences(postgres_conn)
+
         # Verify migration
-        success = verify_migration(sqlite_conn, postgres_conn)
-        
+        success = verify_migration(sqlite_conn, postgres_conn, args.chunk_size)
+
         if success:
+            os.remove(args.checkpoint)
             print("\n🎉 Migration completed successfully!")
             print(f"SQLite backup saved as: {backup_file}")
             print("\nTo complete the migration:")
@@ -221,12 +457,13 @@ def main():
             print("3. Once confirmed working, you can remove the SQLite backup")
         else:
             print("\n❌ Migration failed! Please check the errors above.")
-            
+
     except Exception as e:
         print(f"Migration failed with error: {e}")
+        print(f"Progress is saved in {args.checkpoint}; run the script again to resume.")
     finally:
         sqlite_conn.close()
         postgres_conn.close()
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
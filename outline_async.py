@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Awaitable versions of the outline_utils key calls for async handlers.
+
+Every call runs on a bounded thread pool (OUTLINE_EXECUTOR_WORKERS threads)
+with the server's cached client (outline_utils.get_outline_client), and at
+most OUTLINE_MAX_CONCURRENCY_PER_SERVER calls are in flight per server, so
+a slow server neither stalls the PTB event loop nor takes every worker.
+Provisioning and key revocation share the same limits.
+"""
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import outline_utils
+import stats_registry
+from db_rows import SubscriptionKey
+from config import OUTLINE_EXECUTOR_WORKERS, OUTLINE_MAX_CONCURRENCY_PER_SERVER
+
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(max_workers=OUTLINE_EXECUTOR_WORKERS, thread_name_prefix="outline")
+_server_slots = {}  # country_code -> asyncio.Semaphore
+_server_stats = {}  # country_code -> call counters, for /status
+
+def _slots(country_code):
+    semaphore = _server_slots.get(country_code)
+    if semaphore is None:
+        semaphore = _server_slots[country_code] = asyncio.Semaphore(OUTLINE_MAX_CONCURRENCY_PER_SERVER)
+        _server_stats[country_code] = {"calls": 0, "errors": 0, "in_flight": 0, "max_wait_ms": 0.0}
+    return semaphore
+
+async def run_outline(country_code, func, *args):
+    """Run `func(client, *args)` with the country's Outline client on the Outline executor.
+
+    Raises ValueError if the country has no usable server (see get_outline_client).
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = _slots(country_code)
+    stats = _server_stats[country_code]
+    queued = time.perf_counter()
+
+    def call():
+        client = outline_utils.get_outline_client(country_code)
+        if client is None:
+            raise ValueError(f"No Outline client for {country_code}")
+        return func(client, *args)
+
+    async with semaphore:
+        stats["max_wait_ms"] = max(stats["max_wait_ms"], round((time.perf_counter() - queued) * 1000, 1))
+        stats["calls"] += 1
+        stats["in_flight"] += 1
+        try:
+            return await loop.run_in_executor(_executor, call)
+        except Exception:
+            stats["errors"] += 1
+            raise
+        finally:
+            stats["in_flight"] -= 1
+
+async def create_outline_key(country_code, key_name_prefix="user", name=None):
+    return await run_outline(country_code, outline_utils.create_outline_key, key_name_prefix, name)
+
+async def create_outline_keys(countries, name_for, attempts=2):
+    """Create one key per country, all servers at once, each named `name_for(country)`.
+
+    Countries whose key could not be created are tried again, up to
+    `attempts` rounds in total. Returns the SubscriptionKeys created (in
+    the order of `countries`) and the countries that still failed.
+    """
+    created = {}
+    pending = list(dict.fromkeys(countries))
+    for attempt in range(attempts):
+        if not pending:
+            break
+        results = await asyncio.gather(
+            *(create_outline_key(country, name=name_for(country)) for country in pending), return_exceptions=True
+        )
+        failed = []
+        for country, result in zip(pending, results):
+            if isinstance(result, Exception) or not result[0] or not result[1]:
+                logger.error(f"Creating an Outline key for {country} failed (attempt {attempt + 1}/{attempts}): "
+                             f"{result if isinstance(result, Exception) else 'no key returned'}")
+                failed.append(country)
+            else:
+                created[country] = SubscriptionKey(country, *result)
+        pending = failed
+    return [created[country] for country in dict.fromkeys(countries) if country in created], pending
+
+async def rename_outline_key(country_code, key_id, new_name):
+    return await run_outline(country_code, outline_utils.rename_outline_key, key_id, new_name)
+
+async def delete_outline_key(country_code, key_id):
+    return await run_outline(country_code, outline_utils.delete_outline_key, key_id)
+
+async def get_key_access_urls(country_code):
+    return await run_outline(country_code, outline_utils.get_key_access_urls)
+
+def shutdown(wait=True):
+    _executor.shutdown(wait=wait)
+
+def get_outline_call_stats():
+    """Call counters per Outline server, and the concurrency limits."""
+    return {
+        "workers": OUTLINE_EXECUTOR_WORKERS,
+        "per_server": OUTLINE_MAX_CONCURRENCY_PER_SERVER,
+        "clients": outline_utils.get_cached_client_count(),
+        "servers": {country: dict(stats) for country, stats in list(_server_stats.items())},
+    }
+
+stats_registry.register("outline_calls", get_outline_call_stats)
@@ -1,9 +1,16 @@
 from outline_vpn.outline_vpn import OutlineVPN
 from config import OUTLINE_SERVERS
+import hashlib
+import threading
 import uuid
 
+# One client per country, so its HTTP session (and pinned-certificate adapter) keeps connections alive.
+# Each entry remembers the settings it was built with and is rebuilt when they change.
+_clients = {}  # country_code -> ((api_url, cert_sha256), OutlineVPN)
+_clients_lock = threading.Lock()
+
 def get_outline_client(country_code):
-    """Initializes and returns an OutlineVPN client for a specific country."""
+    """Returns the OutlineVPN client for a specific country, built on first use and then reused."""
     if country_code not in OUTLINE_SERVERS:
         raise ValueError(f"Country {country_code} not found in OUTLINE_SERVERS configuration")
     
@@ -13,32 +20,79 @@ def get_outline_client(country_code):
     if not api_url or "YOUR_OUTLINE_API_URL" in api_url:
         raise ValueError(f"OUTLINE_API_URL for {country_code} is not configured properly in config.py")
     
+    settings = (api_url, server_config["cert_sha256"])
+    with _clients_lock:
+        cached = _clients.get(country_code)
+    if cached and cached[0] == settings:
+        return cached[1]
+
     client_params = {"api_url": api_url}
     if server_config["cert_sha256"]:
         client_params["cert_sha256"] = server_config["cert_sha256"]
     
     try:
         client = OutlineVPN(**client_params)
-        return client
     except Exception as e:
         print(f"Error initializing Outline client for {country_code}: {e}")
         return None
+    with _clients_lock:
+        previous = _clients.get(country_code)
+        if previous and previous[0] == settings:
+            return previous[1]  # another thread built it first
+        _clients[country_code] = (settings, client)
+    if previous:
+        _close_client(previous[1])
+    return client
+
+def invalidate_outline_clients(country_code=None):
+    """Drop the cached client of one country (or of all) so the next call builds a new one."""
+    with _clients_lock:
+        countries = [country_code] if country_code else list(_clients)
+        dropped = [_clients.pop(country, None) for country in countries]
+    for entry in dropped:
+        if entry:
+            _close_client(entry[1])
+
+def get_server_id(country_code):
+    """A short, stable id of the server a country is currently configured with (None if it has none)."""
+    api_url = OUTLINE_SERVERS.get(country_code, {}).get("api_url")
+    if not api_url:
+        return None
+    return hashlib.sha256(api_url.encode()).hexdigest()[:16]
 
-def create_outline_key(client, key_name_prefix="user"):
-    """Creates a new key on the Outline server."""
+def get_cached_client_count():
+    with _clients_lock:
+        return len(_clients)
+
+def _close_client(client):
+    session = getattr(client, "session", None)
+    if session is not None:
+        try:
+            session.close()
+        except Exception:
+            pass
+
+def create_outline_key(client, key_name_prefix="user", name=None):
+    """Creates a new key on the Outline server, named `name` if given."""
     if not client:
         print("Outline client is not available.")
         return None, None
     try:
         # The key_name_prefix argument to this function is now effectively unused
         # for the create_key call itself, but could be logged or used for other purposes if needed.
-        # The actual desired name will be set by the rename_outline_key call in main.py.
 
-        new_key = client.create_key() # Call create_key without any arguments
+        if name:
+            # The name goes into the create call itself, saving a rename round trip
+            new_key = client.create_key(name=name)
+            if new_key and new_key.name != name:
+                # Older Outline servers ignore the name on create
+                rename_outline_key(client, new_key.key_id, name)
+        else:
+            new_key = client.create_key() # Call create_key without any arguments
         
         if new_key:
-            # The new_key.name will be the default name assigned by Outline (e.g., "Key 1", "Key 2")
-            print(f"Successfully created Outline key. ID: {new_key.key_id}, Default Name from Server: {new_key.name}")
+            # Without a name, new_key.name is the default assigned by Outline (e.g., "Key 1", "Key 2")
+            print(f"Successfully created Outline key. ID: {new_key.key_id}, Name from Server: {new_key.name}")
             return new_key.key_id, new_key.access_url
         else:
             print("Failed to create key, new_key object is None from client.create_key().")
@@ -71,6 +125,10 @@ def rename_outline_key(client, key_id, new_name):
         print(f"Error renaming Outline key {key_id}: {e}")
         return False
 
+def get_key_access_urls(client):
+    """Returns {key_id: access_url} for every key on the server."""
+    return {str(key.key_id): key.access_url for key in client.get_keys()}
+
 def get_available_countries():
     """Returns a list of available country codes that have configured servers."""
     return [country for country, config in OUTLINE_SERVERS.items() if config["api_url"]]
@@ -1,144 +1,492 @@
+import asyncio
 import datetime
+import time
 from telegram.ext import ContextTypes
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from database import get_expired_soon_or_active_subscriptions, mark_subscription_expired, get_subscription_by_id
-from outline_utils import get_outline_client, delete_outline_key, rename_outline_key
-from config import DURATION_PLANS, DB_PATH
+from telegram.error import BadRequest, Forbidden
+from database_async import (
+    stream_subscriptions_in_expiry_window, stream_active_subscription_end_dates, run_db_maintenance, claim_renewal_reminders,
+    release_renewal_reminder,
+    flush_user_profile_updates, archive_subscriptions, check_backend_consistency, enqueue_key_revocation,
+    enqueue_overdue_key_revocations, get_due_key_revocations, reschedule_key_revocation, complete_key_revocations,
+    count_key_revocations, add_dead_letter_keys, add_pooled_keys, count_pooled_keys, discard_stale_pooled_keys
+)
+from outline_async import create_outline_key, delete_outline_key, get_key_access_urls
+from db_rows import SubscriptionKey
+from outline_utils import get_available_countries, get_server_id
+from key_revocation import KeyRevoker
+from leader_lease import is_leader
+from message_scheduler import Priority
+from expiry_timeline import ExpiryTimeline
+import database
+import stats_registry
+from config import (
+    DURATION_PLANS, DB_PATH, EXPIRY_LOOKBACK_HOURS, RENEWAL_REMINDER_STAGES_HOURS, EXPIRY_FETCH_BATCH_SIZE,
+    EXPIRY_NOTIFY_CONCURRENCY, KEY_REVOCATION_GRACE_MINUTES,
+    KEY_REVOCATION_BATCH_SIZE, KEY_REVOCATION_MAX_BATCHES, KEY_REVOCATION_MAX_ATTEMPTS, KEY_REVOCATION_RETRY_SECONDS,
+    KEY_DELETE_RETRIES, KEY_DELETE_RETRY_DELAY, KEY_POOL_LOW_WATER, KEY_POOL_TARGET, KEY_POOL_REFILL_BATCH
+)
 
-async def check_expired_subscriptions(context: ContextTypes.DEFAULT_TYPE):
+# Timings of the expiry sweep, for /status (see get_expiry_sweep_stats)
+_sweep_stats = {
+    "runs": 0,
+    "last_trigger": None,  # "timeline" (a subscription reached its end date) or "reconcile"
+    "last_started_at": None,
+    "last_duration_s": None,
+    "max_duration_s": 0.0,
+    "last_expired": 0,
+    "last_reminders": 0,
+    "last_notify_delay_s": None,  # how long after its end_date the oldest newly expired subscription was handled
+}
+
+# Refills of the Outline key pool, for /status (see get_key_pool_stats)
+_pool_stats = {
+    "runs": 0,
+    "created": 0,
+    "failed": 0,
+    "discarded": 0,  # pooled keys removed because their country moved to another server
+    "last_run_at": None,
+    "last_duration_s": None,
+    "countries": {},  # country_code -> {"created", "failed", "duration_s", "avg_create_ms", "max_create_ms"} of its last refill
+}
+
+# Timeline wakeups and the reconcile job must not sweep at the same time
+_sweep_lock = asyncio.Lock()
+_timeline = None  # see create_expiry_timeline
+
+# Deletes Outline keys for the revocation queue and for admin/user cancellations
+key_revoker = KeyRevoker(
+    delete_outline_key,
+    retries=KEY_DELETE_RETRIES,
+    retry_delay=KEY_DELETE_RETRY_DELAY,
+)
+
+def get_expiry_sweep_stats():
+    """Counters and timings of the expiry sweep, and the state of the expiry timeline."""
+    return {**_sweep_stats, "timeline": _timeline.stats() if _timeline else None}
+
+def get_key_revocation_stats():
+    """Key deletion batches of this process, and the keys that could not be deleted at all."""
+    return {"revoker": key_revoker.stats(), "dead_letters": database.count_dead_letter_keys()}
+
+async def _fan_out(items, handle, semaphore):
+    """Run `handle(item)` for every item of an async iterable, at most `semaphore` at a time.
+
+    Items are only pulled from the source while a slot is free, so a
+    streaming source is never read ahead of the workers. Returns the number
+    of items handled. If the source fails, the handlers already started are
+    awaited before the error is raised (cancelled, if this call is).
+    """
+    tasks = set()
+    count = 0
+
+    async def run(item):
+        try:
+            await handle(item)
+        finally:
+            semaphore.release()
+
+    try:
+        async for item in items:
+            await semaphore.acquire()
+            task = asyncio.create_task(run(item))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            count += 1
+    except BaseException as e:
+        # Never leave handlers running behind the caller (run_expiry_sweep releases its lock next)
+        if isinstance(e, asyncio.CancelledError):
+            for task in tasks:
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    if tasks:
+        await asyncio.gather(*tasks)
+    return count
+
+def create_expiry_timeline(bot):
+    """The expiry timeline of this bot: it sweeps as soon as a subscription reaches its end date."""
+    global _timeline
+
+    async def on_due(subscription_ids):
+        # Leadership can be lost between elections; the new leader's timeline takes over, but keep
+        # the ids in case this process is still (or again) the leader when they come due next
+        if not is_leader():
+            timeline.defer(subscription_ids)
+            return
+        await run_expiry_sweep(bot, "timeline")
+
+    _timeline = timeline = ExpiryTimeline(on_due, stream_active_subscription_end_dates)
+    return timeline
+
+async def reconcile_expiry_timeline(context: ContextTypes.DEFAULT_TYPE):
+    """Reload the expiry timeline from the database, then sweep once in case anything was missed."""
+    try:
+        if _timeline:
+            await _timeline.reconcile()
+    except Exception as e:
+        print(f"Scheduler: Expiry timeline reload failed: {e}")
+    await run_expiry_sweep(context.bot, "reconcile")
+
+async def run_expiry_sweep(bot, trigger):
     """
-    Checks for subscriptions that have expired and deactivates their Outline keys.
-    Also sends renewal reminders for subscriptions expiring soon.
+    Queue the keys of newly expired subscriptions for deactivation and notify their users.
+
+    The expired subscriptions are streamed with their plan already joined in,
+    and their notices are sent concurrently, at most EXPIRY_NOTIFY_CONCURRENCY
+    at a time.
     """
-    print(f"Scheduler: Running check_expired_subscriptions at {datetime.datetime.now()}")
-    bot = context.bot
+    async with _sweep_lock:
+        await _sweep_expired(bot, trigger)
 
-    subscriptions_to_check = get_expired_soon_or_active_subscriptions()
+async def _sweep_expired(bot, trigger):
+    started = time.monotonic()
     now = datetime.datetime.utcnow()
+    _sweep_stats["last_trigger"] = trigger
+    _sweep_stats["last_started_at"] = now.isoformat(sep=" ")
+    semaphore = asyncio.Semaphore(EXPIRY_NOTIFY_CONCURRENCY)
+    oldest_end_date = None
 
-    for sub in subscriptions_to_check:
-        sub_id, user_id, status, end_date_str, key_ids, countries = sub
-        # Handle both string and datetime objects from different databases
-        if isinstance(end_date_str, str):
-            end_date = datetime.datetime.fromisoformat(end_date_str)
-        else:
-            end_date = end_date_str
-
-        if status == 'active':
-            # Check for expiration
-            if end_date <= now:
-                print(f"Scheduler: Subscription ID {sub_id} for user {user_id} has expired.")
-                
-                # Get subscription details for the renewal message
-                subscription = get_subscription_by_id(sub_id)
-                if not subscription:
-                    print(f"Scheduler: Could not find subscription {sub_id} for renewal message")
-                    continue
-                
-                duration_plan_id = subscription[2]  # duration_plan_id is the 3rd column
-                plan = DURATION_PLANS.get(duration_plan_id, {})
-                plan_name = plan.get('name', 'Unknown Plan')
-                
+    # Only load the slice of subscriptions this run can act on: the recently expired ones that
+    # are not queued for key revocation yet (reminders are sent by send_due_renewal_reminders)
+    window_start = now - datetime.timedelta(hours=EXPIRY_LOOKBACK_HOURS)
+    window_end = now
+
+    async def expire(sub):
+        nonlocal oldest_end_date
+        # ExpiringSubscription: end_date is already a datetime on both backends
+        if sub.status != 'active' or sub.end_date > now:
+            return
+        # Queue the key deletion first: the queue entry survives restarts, and an entry that
+        # already exists means the user got this notice on an earlier run
+        try:
+            due_at = now + datetime.timedelta(minutes=KEY_REVOCATION_GRACE_MINUTES)
+            if not await enqueue_key_revocation(sub.id, sub.user_id, due_at):
+                return
+        except Exception as e:
+            print(f"Scheduler: Could not queue key revocation for sub {sub.id}: {e}")
+            return
+        print(f"Scheduler: Subscription ID {sub.id} for user {sub.user_id} has expired.")
+        if oldest_end_date is None or sub.end_date < oldest_end_date:
+            oldest_end_date = sub.end_date
+        await _send_expiry_notice(bot, sub)
+
+    try:
+        expired = await _fan_out(stream_subscriptions_in_expiry_window(window_start, window_end), expire, semaphore)
+    finally:
+        duration = time.monotonic() - started
+        _sweep_stats["runs"] += 1
+        _sweep_stats["last_duration_s"] = round(duration, 3)
+        _sweep_stats["max_duration_s"] = round(max(_sweep_stats["max_duration_s"], duration), 3)
+    _sweep_stats["last_expired"] = expired
+    _sweep_stats["last_notify_delay_s"] = (round((now - oldest_end_date).total_seconds(), 1)
+                                           if oldest_end_date else None)
+    if expired:
+        print(f"Scheduler: Expiry sweep ({trigger}) handled {expired} expired subscription(s) in {duration:.2f}s")
+
+async def _send_expiry_notice(bot, sub):
+    """Tell the user their subscription expired and offer renewal during the grace period."""
+    plan = DURATION_PLANS.get(sub.duration_plan_id, {})
+    plan_name = plan.get('name', 'Unknown Plan')
+    try:
+        # Send expiration message with renewal options
+        keyboard = [
+            [
+                InlineKeyboardButton("🔄 Продлить сейчас", callback_data=f"renew_{sub.id}"),
+                InlineKeyboardButton("❌ Отмена", callback_data=f"cancel_expired_{sub.id}")
+            ]
+        ]
+
+        await bot.send_message(
+            chat_id=sub.user_id,
+            text=(
+                f"😔 Ваша подписка на VPN ({plan_name}) истекла.\n\n"
+                f"У вас есть {KEY_REVOCATION_GRACE_MINUTES} мин., чтобы продлить подписку, прежде чем ваши ключи доступа будут деактивированы.\n\n"
+                "Чтобы продолжить использование VPN, пожалуйста, выберите один из следующих вариантов:"
+            ),
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            rate_limit_args=Priority.EXPIRY
+        )
+        print(f"Scheduler: Sent expiration notice with renewal options to user {sub.user_id} for sub {sub.id}")
+    except Exception as e:
+        print(f"Scheduler: Error sending expiration message to user {sub.user_id}: {e}")
+
+async def send_due_renewal_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """Send the renewal reminders that are due (every RENEWAL_REMINDER_INTERVAL)."""
+    now = datetime.datetime.utcnow()
+    reminders = await send_renewal_reminders(context.bot, now, asyncio.Semaphore(EXPIRY_NOTIFY_CONCURRENCY))
+    _sweep_stats["last_reminders"] = reminders
+    if reminders:
+        print(f"Scheduler: Processed {reminders} renewal reminder(s)")
+
+async def send_renewal_reminders(bot, now, semaphore):
+    """Send every active subscription the reminder stage it is due for (RENEWAL_REMINDER_STAGES_HOURS).
+
+    The most urgent stage is claimed first, so a subscription that enters the
+    window late (e.g. bought for less than three days) only gets the latest
+    stage. The claim records the stage in the database, so a reminder is never repeated;
+    one that failed to send for a transient reason is released and retried by a later run.
+    Returns the number of reminders claimed.
+    """
+    async def claimed_reminders():
+        for stage, hours in reversed(list(enumerate(RENEWAL_REMINDER_STAGES_HOURS, start=1))):
+            while True:
                 try:
-                    # Send expiration message with renewal options
-                    keyboard = [
-                        [
-                            InlineKeyboardButton("🔄 Продлить сейчас", callback_data=f"renew_{sub_id}"),
-                            InlineKeyboardButton("❌ Отмена", callback_data=f"cancel_expired_{sub_id}")
-                        ]
-                    ]
-                    
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=(
-                            f"😔 Ваша подписка на VPN ({plan_name}) истекла.\n\n"
-                            "У вас есть 5 минут, чтобы продлить подписку, прежде чем ваши ключи доступа будут деактивированы.\n\n"
-                            "Чтобы продолжить использование VPN, пожалуйста, выберите один из следующих вариантов:"
-                        ),
-                        reply_markup=InlineKeyboardMarkup(keyboard)
-                    )
-                    print(f"Scheduler: Sent expiration notice with renewal options to user {user_id} for sub {sub_id}")
-                    
-                    # Schedule key deletion after 5 minutes
-                    context.job_queue.run_once(
-                        delete_expired_keys,
-                        datetime.timedelta(minutes=5),
-                        data={'sub_id': sub_id, 'user_id': user_id, 'key_ids': key_ids, 'countries': countries}
-                    )
-                    
+                    reminders = await claim_renewal_reminders(stage, now, datetime.timedelta(hours=hours),
+                                                              EXPIRY_FETCH_BATCH_SIZE)
                 except Exception as e:
-                    print(f"Scheduler: Error sending expiration message to user {user_id}: {e}")
-            
-            # Check for renewal reminder (e.g., 3 days before expiry)
-            elif (end_date - now).days <= 3 and (end_date - now).days >= 0:
-                # Basic check to avoid sending multiple reminders if job runs frequently
-                # A more robust way would be to store a "reminder_sent" flag in DB
-                print(f"Scheduler: Subscription ID {sub_id} for user {user_id} expiring soon ({end_date.strftime('%Y-%m-%d %H:%M')}).")
-                try:
-                    # Check if we already sent a reminder (very basic, improve with a DB flag)
-                    if not context.job.context or sub_id not in context.job.context.get('reminded_subs', []):
-                        await bot.send_message(
-                            chat_id=user_id,
-                            text=(
-                                f"🔔 Ваша подписка на VPN истекает {end_date.strftime('%Y-%m-%d %H:%M UTC')}.\n"
-                                "Не пропустите! Продлите сейчас, чтобы сохранить непрерывный доступ.\n"
-                                "Используйте /my_subscriptions для продления подписки."
-                            )
-                        )
-                        print(f"Scheduler: Sent renewal reminder to user {user_id} for sub {sub_id}")
-                        if 'reminded_subs' not in context.job.context:
-                            context.job.context['reminded_subs'] = []
-                        context.job.context['reminded_subs'].append(sub_id)
+                    print(f"Scheduler: Could not load renewal reminders (stage {stage}): {e}")
+                    return
+                for reminder in reminders:
+                    yield reminder
+                if len(reminders) < EXPIRY_FETCH_BATCH_SIZE:
+                    break
 
-                except Exception as e:
-                    print(f"Scheduler: Error sending renewal reminder to user {user_id}: {e}")
-
-async def delete_expired_keys(context: ContextTypes.DEFAULT_TYPE):
-    """Delete the Outline keys after the grace period if not renewed."""
-    job = context.job
-    sub_id = job.data['sub_id']
-    user_id = job.data['user_id']
-    key_ids = job.data['key_ids'].split(',') if job.data['key_ids'] else []
-    countries = job.data['countries'].split(',') if job.data['countries'] else []
-    
-    # Check if subscription was renewed
-    subscription = get_subscription_by_id(sub_id)
-    if subscription and subscription[5] == 'active':  # status is the 6th column
-        print(f"Scheduler: Subscription {sub_id} was renewed, skipping key deletion")
-        return
-    
-    # Delete keys for each country
-    deleted_count = 0
-    total_keys = len(key_ids)
-    
-    for i, country in enumerate(countries):
-        if i < len(key_ids) and key_ids[i]:
-            try:
-                outline_client = get_outline_client(country)
-                if outline_client:
-                    deleted = delete_outline_key(outline_client, key_ids[i])
-                    if deleted:
-                        deleted_count += 1
-                        print(f"Scheduler: Deleted key {key_ids[i]} for {country}")
-                    else:
-                        print(f"Scheduler: Failed to delete key {key_ids[i]} for {country}")
+    return await _fan_out(claimed_reminders(), lambda reminder: _send_renewal_reminder(bot, reminder), semaphore)
+
+async def _send_renewal_reminder(bot, reminder):
+    sub_id, user_id, end_date = reminder.id, reminder.user_id, reminder.end_date
+    print(f"Scheduler: Subscription ID {sub_id} for user {user_id} expiring soon ({end_date.strftime('%Y-%m-%d %H:%M')}).")
+    try:
+        await bot.send_message(
+            chat_id=user_id,
+            text=(
+                f"🔔 Ваша подписка на VPN истекает {end_date.strftime('%Y-%m-%d %H:%M UTC')}.\n"
+                "Не пропустите! Продлите сейчас, чтобы сохранить непрерывный доступ.\n"
+                "Используйте /my_subscriptions для продления подписки."
+            ),
+            rate_limit_args=Priority.REMINDER
+        )
+        print(f"Scheduler: Sent renewal reminder to user {user_id} for sub {sub_id}")
+    except (Forbidden, BadRequest) as e:
+        # The user blocked the bot or the chat is gone: retrying will not help
+        print(f"Scheduler: Error sending renewal reminder to user {user_id}: {e}")
+    except Exception as e:
+        print(f"Scheduler: Error sending renewal reminder to user {user_id}, will retry: {e}")
+        try:
+            await release_renewal_reminder(reminder)
+        except Exception as release_error:
+            print(f"Scheduler: Could not release renewal reminder for sub {sub_id}: {release_error}")
+
+async def process_key_revocations(context: ContextTypes.DEFAULT_TYPE):
+    """Delete the Outline keys of expired subscriptions whose grace period is over (the key_revocations queue).
+
+    The keys of a whole batch are deleted at once by key_revoker. Renewed
+    subscriptions are dropped from the queue by the fetch itself. A revocation
+    with failed deletes is retried with backoff for the failed keys only; after
+    KEY_REVOCATION_MAX_ATTEMPTS the subscription is expired anyway and the
+    keys left are dead-lettered.
+    """
+    now = datetime.datetime.utcnow()
+    try:
+        for _ in range(KEY_REVOCATION_MAX_BATCHES):
+            batch = await get_due_key_revocations(now, KEY_REVOCATION_BATCH_SIZE)
+            if not batch:
+                break
+            result = await key_revoker.revoke([key for revocation in batch for key in revocation.keys])
+            errors = {(key.country_code, str(key.outline_key_id)): error for key, error in result.failed}
+
+            finished = []
+            for revocation in batch:
+                failed = [(key, errors[(key.country_code, str(key.outline_key_id))]) for key in revocation.keys
+                          if (key.country_code, str(key.outline_key_id)) in errors]
+                if failed and revocation.attempts + 1 < KEY_REVOCATION_MAX_ATTEMPTS:
+                    retry_at = now + datetime.timedelta(seconds=KEY_REVOCATION_RETRY_SECONDS * 2 ** revocation.attempts)
+                    error = "; ".join(f"{key.country_code}:{key.outline_key_id}: {reason}" for key, reason in failed)
+                    await reschedule_key_revocation(revocation.subscription_id, retry_at, [key for key, _ in failed],
+                                                    error)
+                    print(f"Scheduler: Key revocation for sub {revocation.subscription_id} failed ({error}), "
+                          f"retrying at {retry_at.strftime('%H:%M:%S')}")
                 else:
-                    print(f"Scheduler: Could not connect to Outline server for {country}")
-            except Exception as e:
-                print(f"Scheduler: Error deleting key {key_ids[i]} for {country}: {e}")
-    
-    # Mark subscription as expired
-    mark_subscription_expired(sub_id)
-    
-    # Send final message to user
+                    finished.append((revocation, failed))
+
+            # Expire the finished subscriptions and dequeue them in one transaction, then notify
+            await complete_key_revocations([revocation for revocation, _ in finished], now)
+            for revocation, failed in finished:
+                if failed:
+                    await add_dead_letter_keys(revocation.subscription_id, failed, "expiry")
+            await asyncio.gather(*(_send_revocation_notice(context.bot, revocation, failed)
+                                   for revocation, failed in finished))
+
+            if len(batch) < KEY_REVOCATION_BATCH_SIZE:
+                break
+    except Exception as e:
+        print(f"Scheduler: Key revocation run failed: {e}")
+
+async def _send_revocation_notice(bot, revocation, failed):
+    total_keys = len(revocation.keys)
+    deleted_count = total_keys - len(failed)
     try:
-        if deleted_count == total_keys:
+        if not failed:
             message = "❌ Ваши ключи доступа к VPN были деактивированы, так как подписка не была продлена.\nЧтобы получить новую подписку, используйте /subscribe"
         elif deleted_count > 0:
             message = f"❌ {deleted_count}/{total_keys} ключей доступа к VPN были деактивированы, так как подписка не была продлена.\nЧтобы получить новую подписку, используйте /subscribe"
         else:
             message = "❌ Ваша подписка на VPN истекла. Чтобы получить новую подписку, используйте /subscribe"
-        
-        await context.bot.send_message(chat_id=user_id, text=message)
+
+        await bot.send_message(chat_id=revocation.user_id, text=message, rate_limit_args=Priority.EXPIRY)
+    except Exception as e:
+        print(f"Scheduler: Error sending final expiration message to user {revocation.user_id}: {e}")
+
+async def recover_key_revocations(context: ContextTypes.DEFAULT_TYPE):
+    """Startup: queue expirations too old for the expiry sweep to see, and report the queue."""
+    now = datetime.datetime.utcnow()
+    try:
+        # Subscriptions inside the expiry window are picked up (with a notice) by the expiry sweep
+        recovered = await enqueue_overdue_key_revocations(now - datetime.timedelta(hours=EXPIRY_LOOKBACK_HOURS), now)
+        queued, due = await count_key_revocations(now)
+        print(f"Scheduler: Key revocation queue: {queued} queued ({due} due), "
+              f"{recovered} long-expired subscription(s) recovered")
+    except Exception as e:
+        print(f"Scheduler: Key revocation recovery failed: {e}")
+
+async def db_maintenance(context: ContextTypes.DEFAULT_TYPE):
+    """Periodically refresh planner statistics so the hot queries keep using their indexes."""
+    try:
+        await run_db_maintenance()
     except Exception as e:
-        print(f"Scheduler: Error sending final expiration message to user {user_id}: {e}")
\ No newline at end of file
+        print(f"Scheduler: Database maintenance failed: {e}")
+
+async def flush_user_profiles(context: ContextTypes.DEFAULT_TYPE):
+    """Write queued username/first_name changes in one batched upsert."""
+    try:
+        flushed = await flush_user_profile_updates()
+        if flushed:
+            print(f"Scheduler: Flushed {flushed} user profile update(s)")
+    except Exception as e:
+        print(f"Scheduler: User profile flush failed: {e}")
+
+async def archive_finished_subscriptions(context: ContextTypes.DEFAULT_TYPE):
+    """Move abandoned checkouts and long-finished subscriptions out of the live tables."""
+    try:
+        moved = await archive_subscriptions()
+        if moved["subscriptions"]:
+            print(f"Scheduler: Archived {moved['subscriptions']} subscription(s) and "
+                  f"{moved['subscription_countries']} key record(s) in {moved['batches']} batch(es)")
+    except Exception as e:
+        print(f"Scheduler: Subscription archival failed: {e}")
+
+async def backend_consistency_check(context: ContextTypes.DEFAULT_TYPE):
+    """Dual-write mode: compare the next id range of every table between the primary and shadow backends."""
+    try:
+        results = await check_backend_consistency()
+        for table, result in (results or {}).items():
+            divergent = len(result["missing_in_shadow"]) + len(result["missing_in_primary"]) + len(result["mismatched"])
+            if divergent:
+                print(f"Scheduler: {divergent} divergent {table} row(s) after {result['after']} (see log)")
+    except Exception as e:
+        print(f"Scheduler: Backend consistency check failed: {e}")
+
+def current_pool_servers():
+    """{country_code: server_id} of every configured Outline server, as used to key the key pool."""
+    servers = {}
+    for country in get_available_countries():
+        server_id = get_server_id(country)
+        if server_id:
+            servers[country] = server_id
+    return servers
+
+def get_key_pool_stats():
+    """Unassigned keys per country on its current server, stale ones, and the refills run by this process."""
+    servers = current_pool_servers()
+    depth = database.count_pooled_keys()
+    return {
+        "depth": {country: depth.get((country, server_id), 0) for country, server_id in servers.items()},
+        "stale": sum(count for (country, server_id), count in depth.items() if servers.get(country) != server_id),
+        "refill": {**_pool_stats, "countries": dict(_pool_stats["countries"])},
+    }
+
+async def _refill_pool(country, server_id, have):
+    wanted = min(KEY_POOL_TARGET - have, KEY_POOL_REFILL_BATCH)
+    if wanted <= 0:
+        return
+    latencies_ms = []
+
+    async def create():
+        call_started = time.monotonic()
+        try:
+            return await create_outline_key(country, name=f"pool_{country}")
+        finally:
+            latencies_ms.append((time.monotonic() - call_started) * 1000)
+
+    started = time.monotonic()
+    results = await asyncio.gather(*(create() for _ in range(wanted)), return_exceptions=True)
+    duration = time.monotonic() - started
+    keys = [(country, server_id, result[0], result[1]) for result in results
+            if not isinstance(result, Exception) and result[0] and result[1]]
+    try:
+        await add_pooled_keys(keys)
+    except Exception:
+        # Do not leave keys on the server that nobody can ever be given
+        result = await key_revoker.revoke([SubscriptionKey(country, key_id, url) for _, _, key_id, url in keys])
+        if result.failed:
+            await add_dead_letter_keys(None, result.failed, "pool")
+        raise
+    _pool_stats["countries"][country] = {
+        "created": len(keys),
+        "failed": wanted - len(keys),
+        "duration_s": round(duration, 3),
+        "avg_create_ms": round(sum(latencies_ms) / len(latencies_ms), 1) if latencies_ms else None,
+        "max_create_ms": round(max(latencies_ms), 1) if latencies_ms else None,
+    }
+    _pool_stats["created"] += len(keys)
+    _pool_stats["failed"] += wanted - len(keys)
+    if len(keys) < wanted:
+        print(f"Scheduler: Key pool {country}: created {len(keys)}/{wanted} key(s)")
+
+async def _revoke_stale_pooled_keys(stale):
+    """Delete pooled keys removed from the pool because their country's server config changed.
+
+    A key is deleted through the country's current server only if that server
+    holds it (same id and access URL), e.g. after the API path was rotated;
+    otherwise the id may belong to someone else's key there. Keys that are
+    left on a replaced server, or fail to delete, are dead-lettered.
+    """
+    owned, failed = [], []
+    for country in dict.fromkeys(key.country_code for key in stale):
+        keys = [key for key in stale if key.country_code == country]
+        try:
+            access_urls = await get_key_access_urls(country)
+        except Exception as e:
+            failed.extend((key, f"could not list the keys of the {country} server: {e}") for key in keys)
+            continue
+        for key in keys:
+            if access_urls.get(str(key.outline_key_id)) == key.outline_access_url:
+                owned.append(key)
+            else:
+                failed.append((key, f"not on the current {country} server"))
+    if owned:
+        result = await key_revoker.revoke(owned)
+        failed.extend(result.failed)
+    if failed:
+        await add_dead_letter_keys(None, failed, "pool")
+    print(f"Scheduler: Key pool: removed {len(stale)} key(s) of replaced servers, "
+          f"{len(stale) - len(failed)} deleted, {len(failed)} dead-lettered")
+
+async def refill_key_pools(context: ContextTypes.DEFAULT_TYPE):
+    """Top up every country's key pool to KEY_POOL_TARGET once it falls below KEY_POOL_LOW_WATER."""
+    started = time.monotonic()
+    try:
+        servers = current_pool_servers()
+        stale = await discard_stale_pooled_keys(servers)
+        if stale:
+            _pool_stats["discarded"] += len(stale)
+            await _revoke_stale_pooled_keys(stale)
+        depth = await count_pooled_keys()
+        low = {country: depth.get((country, server_id), 0) for country, server_id in servers.items()
+               if depth.get((country, server_id), 0) < KEY_POOL_LOW_WATER}
+        results = await asyncio.gather(
+            *(_refill_pool(country, servers[country], have) for country, have in low.items()), return_exceptions=True
+        )
+        for country, result in zip(low, results):
+            if isinstance(result, Exception):
+                print(f"Scheduler: Key pool refill for {country} failed: {result}")
+    except Exception as e:
+        print(f"Scheduler: Key pool refill failed: {e}")
+    _pool_stats["runs"] += 1
+    _pool_stats["last_run_at"] = time.time()
+    _pool_stats["last_duration_s"] = round(time.monotonic() - started, 3)
+
+stats_registry.register("expiry_sweep", get_expiry_sweep_stats)
+stats_registry.register("key_revocation", get_key_revocation_stats)
+stats_registry.register("key_pool", get_key_pool_stats)
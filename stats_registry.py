@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+Named runtime statistics providers, registered by the components that own them and served by /status.
+"""
+
+import threading
+
+_providers = {}  # name -> callable returning a JSON-serializable value, in registration order
+_lock = threading.Lock()
+
+
+def register(name, provider):
+    """Serve `provider()` under `name` (replacing an earlier provider of that name)."""
+    with _lock:
+        _providers[name] = provider
+
+
+def unregister(name, provider=None):
+    """Stop serving `name`; with `provider` given, only if it is still the registered one."""
+    with _lock:
+        if provider is None or _providers.get(name) == provider:
+            _providers.pop(name, None)
+
+
+def collect():
+    """The stats of every registered provider, keyed by name; a provider that raises reports its error."""
+    with _lock:
+        providers = list(_providers.items())
+    stats = {}
+    for name, provider in providers:
+        try:
+            stats[name] = provider()
+        except Exception as e:
+            stats[name] = {"error": str(e)}
+    return stats
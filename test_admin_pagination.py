@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Tests for keyset pagination of the admin subscription list.
+"""
+
+import datetime
+
+NOW = datetime.datetime(2024, 1, 1, 12, 0, 0)
+
+
+def add_subscription(db, user_id, end_date, status="active"):
+    with db.get_sqlite_connection() as conn:
+        conn.execute("INSERT OR IGNORE INTO users (user_id, username, first_name) VALUES (?, ?, ?)",
+                     (user_id, f"user{user_id}", "Test"))
+        cursor = conn.execute('''
+            INSERT INTO subscriptions (user_id, duration_plan_id, status, end_date)
+            VALUES (?, '1_month', ?, ?)
+        ''', (user_id, status, end_date))
+        return cursor.lastrowid
+
+
+def all_pages(db, limit):
+    pages, after = [], None
+    while True:
+        rows, after = db.get_admin_subscriptions_page(after, limit)
+        pages.append([row[0] for row in rows])
+        if after is None:
+            return pages
+
+
+def test_pages_cover_every_listed_subscription_once_in_order(db):
+    day = datetime.timedelta(days=1)
+    user1_new = add_subscription(db, 1, NOW + day)
+    user1_old = add_subscription(db, 1, NOW - day, status="expired")
+    user1_pending = add_subscription(db, 1, None, status="pending_payment")
+    user2_tie_a = add_subscription(db, 2, NOW)
+    user2_tie_b = add_subscription(db, 2, NOW)
+    add_subscription(db, 2, NOW, status="cancelled_by_admin")  # not listed
+    user3 = add_subscription(db, 3, NOW)
+
+    expected = [user1_new, user1_old, user1_pending, user2_tie_b, user2_tie_a, user3]
+    assert db.count_admin_subscriptions() == len(expected)
+    for limit in (1, 2, 4, 6, 10):
+        pages = all_pages(db, limit)
+        assert sum(pages, []) == expected
+        assert all(len(page) == limit for page in pages[:-1])
+
+
+def test_last_page_has_no_cursor(db):
+    add_subscription(db, 1, NOW)
+    add_subscription(db, 2, NOW)
+
+    rows, after = db.get_admin_subscriptions_page(None, 2)
+
+    assert len(rows) == 2
+    assert after is None
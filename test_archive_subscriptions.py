@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Tests for archiving abandoned and long-finished subscriptions (database.archive_subscriptions).
+"""
+
+import datetime
+
+
+def add_subscription(db, status, age_days, countries=()):
+    """A subscription of user 1 created, and ended, `age_days` ago."""
+    db.add_user_if_not_exists(1, "alice", "Alice")
+    then = datetime.datetime.utcnow() - datetime.timedelta(days=age_days)
+    with db.get_sqlite_connection() as conn:
+        cursor = conn.execute(
+            "INSERT INTO subscriptions (user_id, duration_plan_id, status, start_date, end_date, created_at) "
+            "VALUES (1, '1_month', ?, ?, ?, ?)", (status, then, then, then))
+        subscription_id = cursor.lastrowid
+        conn.executemany(
+            "INSERT INTO subscription_countries (subscription_id, country_code, outline_key_id, outline_access_url) "
+            "VALUES (?, ?, ?, ?)", [(subscription_id, country, "1", "ss://1") for country in countries])
+    return subscription_id
+
+
+def live_ids(db):
+    with db.get_sqlite_connection() as conn:
+        return [row[0] for row in conn.execute("SELECT id FROM subscriptions ORDER BY id")]
+
+
+def test_only_stale_checkouts_and_long_finished_subscriptions_are_moved(db):
+    abandoned = add_subscription(db, "pending_payment", 10)
+    recent_checkout = add_subscription(db, "pending_payment", 0)
+    old_expired = add_subscription(db, "expired", 100, countries=("germany", "france"))
+    recent_expired = add_subscription(db, "expired", 5)
+    active = add_subscription(db, "active", 100)
+
+    totals = db.archive_subscriptions(pending_days=1, retention_days=30)
+
+    assert totals == {"subscriptions": 2, "subscription_countries": 2, "batches": 1}
+    assert live_ids(db) == [recent_checkout, recent_expired, active]
+    archived = db.get_archived_subscriptions(1)
+    assert [row.id for row in archived] == [old_expired, abandoned]
+    assert [key.country_code for key in archived[0].keys] == ["germany", "france"]
+    assert isinstance(archived[0].archived_at, datetime.datetime)
+    with db.get_sqlite_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM subscription_countries").fetchone()[0] == 0
+
+
+def test_work_is_split_into_bounded_batches(db):
+    for _ in range(5):
+        add_subscription(db, "cancelled", 100)
+
+    totals = db.archive_subscriptions(retention_days=30, batch_size=2, max_batches=2)
+
+    assert (totals["subscriptions"], totals["batches"]) == (4, 2)
+    assert len(live_ids(db)) == 1
+
+
+def test_batches_are_chosen_in_id_order(db):
+    # Dual-write replays the batch on the shadow, which must pick the same rows: by id, not by age
+    ids = [add_subscription(db, "expired", age) for age in (40, 300, 100, 200)]
+
+    db.archive_subscriptions(retention_days=30, batch_size=2, max_batches=1)
+
+    assert live_ids(db) == ids[2:]
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Tests for the awaitable data-layer wrappers (database_async.py).
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+import database_async
+from database_async import run_db
+
+
+def test_run_db_runs_the_call_on_a_database_worker_thread():
+    def call(a, b=0):
+        return threading.current_thread().name, a + b
+
+    thread_name, result = asyncio.run(run_db(call, 1, b=2))
+
+    assert thread_name.startswith("db")
+    assert result == 3
+
+
+def test_run_db_raises_the_call_s_exception():
+    def call():
+        raise ValueError("bad row")
+
+    with pytest.raises(ValueError, match="bad row"):
+        asyncio.run(run_db(call))
+
+
+def test_event_loop_keeps_running_while_a_query_blocks():
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.01)
+
+    async def run():
+        ticker = asyncio.create_task(tick())
+        await run_db(time.sleep, 0.2)
+        ticker.cancel()
+
+    asyncio.run(run())
+    assert len(ticks) >= 5
+
+
+def test_wrappers_keep_the_data_layer_names():
+    assert database_async.get_active_subscriptions.__name__ == "get_active_subscriptions"
+    assert database_async.get_user_subscription.__wrapped__.__module__ == "vless_database"
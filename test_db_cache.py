@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Tests for the read-through caches (db_cache.py) and their invalidation by the data layer.
+"""
+
+import datetime
+import time
+
+from db_cache import TTLCache
+
+
+def test_value_is_loaded_once_then_served_until_it_expires():
+    cache = TTLCache("test", ttl=0.05, max_entries=10)
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return len(loads)
+
+    assert cache.get_or_load("a", loader) == 1
+    assert cache.get_or_load("a", loader) == 1
+    time.sleep(0.06)
+    assert cache.get_or_load("a", loader) == 2
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["expirations"] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache("test", ttl=60, max_entries=2)
+    cache.get_or_load("a", lambda: "a")
+    cache.get_or_load("b", lambda: "b")
+    cache.get_or_load("a", lambda: "unused")  # "a" is now the most recently used
+    cache.get_or_load("c", lambda: "c")
+
+    assert cache.get_or_load("a", lambda: "reloaded") == "a"
+    assert cache.get_or_load("b", lambda: "reloaded") == "reloaded"
+    assert cache.stats()["evictions"] >= 1
+
+
+def test_load_that_raced_a_write_is_not_stored_for_that_key_only():
+    cache = TTLCache("test", ttl=60, max_entries=10)
+
+    def stale_loader():
+        cache.invalidate("a")  # the row behind "a" is written while it is being read
+        cache.invalidate("other")
+        return "stale"
+
+    assert cache.get_or_load("a", stale_loader) == "stale"
+    assert cache.get_or_load("a", lambda: "fresh") == "fresh"
+
+    def loader_racing_another_key():
+        cache.invalidate("a")
+        return "b"
+
+    cache.get_or_load("b", loader_racing_another_key)
+    assert cache.get_or_load("b", lambda: "reloaded") == "b"  # a write to "a" does not drop "b"
+    assert cache._loading == {}
+
+
+def test_failed_load_is_not_cached():
+    cache = TTLCache("test", ttl=60, max_entries=10)
+
+    def failing():
+        raise RuntimeError("database unavailable")
+
+    try:
+        cache.get_or_load("a", failing)
+    except RuntimeError:
+        pass
+    assert cache.get_or_load("a", lambda: "loaded") == "loaded"
+    assert cache._loading == {}
+
+
+def expire_behind_the_cache(db, subscription_id):
+    with db.get_sqlite_connection() as conn:
+        conn.execute("UPDATE subscriptions SET status = 'expired' WHERE id = ?", (subscription_id,))
+
+
+def test_writes_invalidate_the_owner_s_cached_subscriptions(db):
+    db.add_user_if_not_exists(1, "user1", "One")
+    subscription_id = db.create_subscription_record(1, "1_month", 30)
+    assert db.get_active_subscriptions(1) == []
+
+    db.activate_subscription(subscription_id, 1, 30)
+    assert [row[0] for row in db.get_active_subscriptions(1)] == [subscription_id]
+
+    # A write that bypasses the data layer is only seen once the entry is invalidated
+    expire_behind_the_cache(db, subscription_id)
+    assert [row[0] for row in db.get_active_subscriptions(1)] == [subscription_id]
+
+    db.mark_subscription_expired(subscription_id, 1)
+    assert db.get_active_subscriptions(1) == []
+
+
+def test_cached_subscriptions_past_their_end_date_are_not_served(db):
+    db.add_user_if_not_exists(1, "user1", "One")
+    subscription_id = db.create_subscription_record(1, "1_month", 30)
+    db.activate_subscription(subscription_id, 1, 30)
+    [active] = db.get_active_subscriptions(1)
+
+    # The entry was cached while the subscription still had time left
+    ended = active._replace(end_date=datetime.datetime.utcnow() - datetime.timedelta(seconds=1))
+    db.active_subscriptions_cache.invalidate(1)
+    db.active_subscriptions_cache.get_or_load(1, lambda: [ended])
+
+    assert db.get_active_subscriptions(1) == []
+
+
+def test_adding_a_country_invalidates_the_subscription_s_countries(db):
+    db.add_user_if_not_exists(1, "user1", "One")
+    subscription_id = db.create_subscription_record(1, "1_month", 30)
+    assert db.get_subscription_countries(subscription_id) == []
+
+    db.add_subscription_country(subscription_id, 1, "germany", "7", "ss://7")
+
+    assert [row[0] for row in db.get_subscription_countries(subscription_id)] == ["germany"]
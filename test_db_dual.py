@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Tests for dual-write mode (db_dual.py and the database.py dispatchers).
+"""
+
+import datetime
+
+import pytest
+
+from db_dual import ConsistencyChecker, DualWriteMonitor
+
+
+class FakeShadow:
+    """Stands in for the other backend: records every call made to it."""
+
+    def __init__(self):
+        self.calls = []
+
+    def function(self, name, result=None, error=None):
+        def call(*args):
+            self.calls.append((name, args))
+            if error:
+                raise error
+            return result
+        return call
+
+
+@pytest.fixture
+def dual(db, monkeypatch):
+    """database.py in dual-write mode: SQLite is the primary, a FakeShadow plays PostgreSQL."""
+    shadow = FakeShadow()
+    monitor = DualWriteMonitor("sqlite", "postgresql", shadow_read_rate=1.0)
+    monkeypatch.setattr(db, "SHADOW_BACKEND", "postgresql")
+    monkeypatch.setattr(db, "dual_write", monitor)
+    monkeypatch.setattr(db, "postgresql_functions", {
+        "upsert_users": shadow.function("upsert_users"),
+        "create_subscription_record": shadow.function("create_subscription_record"),
+        "mark_subscription_expired": shadow.function("mark_subscription_expired", error=RuntimeError("down")),
+        "get_subscription_by_id": shadow.function("get_subscription_by_id", result=None),
+        "add_pooled_keys": shadow.function("add_pooled_keys"),
+        "remove_pooled_keys": shadow.function("remove_pooled_keys"),
+        "drop_renewed_key_revocations": shadow.function("drop_renewed_key_revocations"),
+        "provision_subscription": shadow.function("provision_subscription"),
+        "mark_renewal_reminders": shadow.function("mark_renewal_reminders"),
+    })
+    return db, shadow, monitor
+
+
+def test_writes_are_replayed_on_the_shadow_with_the_primary_s_id_and_timestamps(dual):
+    db, shadow, monitor = dual
+    db.add_user_if_not_exists(1, "alice", "Alice")
+
+    subscription_id = db.create_subscription_record(1, "1_month", 30)
+
+    assert [name for name, _ in shadow.calls] == ["upsert_users", "create_subscription_record"]
+    args = shadow.calls[1][1]
+    assert args[:3] == (1, "1_month", 30)
+    assert isinstance(args[3], datetime.datetime)
+    assert args[4] == subscription_id
+    assert monitor.stats()["shadow_writes"] == 2
+
+
+def test_shadow_failures_are_counted_but_never_raised(dual):
+    db, shadow, monitor = dual
+    db.add_user_if_not_exists(1, "alice", "Alice")
+    subscription_id = db.create_subscription_record(1, "1_month", 30)
+
+    db.mark_subscription_expired(subscription_id, 1)
+
+    assert db.get_subscription_by_id(subscription_id)[6] == "expired"
+    assert monitor.stats()["shadow_write_failures"] == 1
+
+
+def test_claims_remove_the_keys_the_primary_chose_on_the_shadow(dual):
+    db, shadow, monitor = dual
+    db.add_pooled_keys([("de", "de-1", 7, "ss://seven"), ("de", "de-1", 8, "ss://eight")])
+
+    claimed = db.claim_pooled_keys([("de", "de-1"), ("nl", "nl-1")])
+
+    assert [key.outline_key_id for key in claimed] == ["7"]
+    assert shadow.calls[-1] == ("remove_pooled_keys", ([("de", "7")],))
+
+
+def test_reminder_claims_mark_the_rows_the_primary_chose_on_the_shadow(dual):
+    db, shadow, monitor = dual
+    now = datetime.datetime.utcnow()
+    db.add_user_if_not_exists(1, "alice", "Alice")
+    ids = [db.create_subscription_record(1, "1_month", 30) for _ in range(3)]
+    for subscription_id in ids:
+        db.provision_subscription(subscription_id, 1, "europe", [("germany", str(subscription_id), "ss://k")], 1)
+    shadow.calls.clear()
+
+    claimed = db.claim_renewal_reminders(1, now, datetime.timedelta(days=2), 2)
+
+    assert len(claimed) == 2
+    assert shadow.calls == [("mark_renewal_reminders", ([reminder.id for reminder in claimed], 1, now))]
+
+
+def test_due_revocations_replay_only_the_cleanup_on_the_shadow(dual):
+    db, shadow, monitor = dual
+    now = datetime.datetime.utcnow()
+
+    db.get_due_key_revocations(now, 10)
+
+    assert shadow.calls == [("drop_renewed_key_revocations", (now,))]
+
+
+def test_sampled_reads_report_divergence(dual):
+    db, shadow, monitor = dual
+    db.add_user_if_not_exists(1, "alice", "Alice")
+    subscription_id = db.create_subscription_record(1, "1_month", 30)
+
+    db.get_subscription_by_id(subscription_id)  # the shadow returns None
+
+    assert monitor.stats()["read_divergences"] == 1
+
+
+def test_timestamps_compare_equal_across_backends():
+    monitor = DualWriteMonitor("sqlite", "postgresql", shadow_read_rate=1.0)
+
+    monitor.shadow_read("read", [(1, "2030-01-01 10:00:00")], lambda: [(1, datetime.datetime(2030, 1, 1, 10))])
+
+    assert monitor.stats()["read_divergences"] == 0
+
+
+def fetcher(rows):
+    def fetch(after, limit):
+        return [row for row in rows if after is None or row[0] > after][:limit]
+    return fetch
+
+
+def test_consistency_checker_walks_both_stores_by_key_range():
+    primary = [(1, "a"), (2, "b"), (3, "c"), (5, "e")]
+    shadow = [(1, "a"), (2, "B"), (4, "d"), (5, "e")]
+    checker = ConsistencyChecker("users")
+
+    first = checker.check_next(fetcher(primary), fetcher(shadow), 2)
+    second = checker.check_next(fetcher(primary), fetcher(shadow), 2)
+    third = checker.check_next(fetcher(primary), fetcher(shadow), 2)
+
+    assert (first["upto"], first["mismatched"]) == (2, [2])
+    assert (second["missing_in_shadow"], second["missing_in_primary"]) == ([3], [4])
+    assert third["upto"] is None
+    stats = checker.stats()
+    assert (stats["passes"], stats["last_pass_clean"], stats["cursor"]) == (1, False, None)
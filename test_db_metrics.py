@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Tests for the data-layer query metrics (db_metrics.py).
+"""
+
+import datetime
+import time
+
+import pytest
+
+import db_metrics
+from db_metrics import instrument
+
+
+def metrics_of(name, backend="test"):
+    return db_metrics.get_query_metrics()["queries"][name][backend]
+
+
+def test_calls_are_counted_with_their_rows_and_errors():
+    def query(fail=False):
+        if fail:
+            raise ValueError("bad")
+        return [1, 2, 3]
+    timed = instrument("test_counted", "test", query)
+
+    timed()
+    with pytest.raises(ValueError):
+        timed(fail=True)
+
+    stats = metrics_of("test_counted")
+    assert (stats["count"], stats["rows"], stats["errors"]) == (2, 3, 1)
+    assert sum(stats["buckets"].values()) == 2
+
+
+def test_generators_are_timed_until_exhausted():
+    timed = instrument("test_streamed", "test", lambda: (row for row in range(5)))
+
+    rows = timed()
+    assert "test_streamed" not in db_metrics.get_query_metrics()["queries"]
+    assert list(rows) == [0, 1, 2, 3, 4]
+
+    assert metrics_of("test_streamed")["rows"] == 5
+
+
+def test_pool_waits_are_charged_to_the_running_query():
+    def query():
+        db_metrics.record_pool_wait(7.5)
+
+    instrument("test_pool_wait", "test", query)()
+
+    assert metrics_of("test_pool_wait")["pool_wait_ms"] == 7.5
+
+
+def test_slow_queries_are_logged_with_redacted_parameters(monkeypatch):
+    monkeypatch.setitem(db_metrics._settings, "slow_query_ms", 1.0)
+    timed = instrument("test_slow", "test", lambda user_id, url, end_date, active: time.sleep(0.005))
+
+    timed(42, "ss://secret", datetime.datetime(2030, 1, 1), True)
+
+    slow = [entry for entry in db_metrics.get_query_metrics()["slow_queries"] if entry["query"] == "test_slow"]
+    assert slow[-1]["params"] == "<int>, <str len=11>, <datetime>, True"
+
+
+def test_data_layer_calls_are_recorded_per_backend(db):
+    db.get_subscription_by_id(1)
+    db.get_subscription_by_id(2)
+
+    assert metrics_of("get_subscription_by_id", "sqlite")["count"] >= 2
+    assert 'db_query_duration_seconds_count{query="get_subscription_by_id",backend="sqlite"}' in \
+        db_metrics.render_prometheus()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Tests for the versioned schema migrations (db_migrations.py).
+"""
+
+import sqlite3
+
+import pytest
+
+from db_migrations import MIGRATIONS, apply_migrations, current_version
+
+
+def connect(tmp_path):
+    return sqlite3.connect(str(tmp_path / "migrations.db"), isolation_level=None)
+
+
+def test_fresh_database_gets_every_migration_once(tmp_path):
+    conn = connect(tmp_path)
+    latest = [m.version for m in MIGRATIONS["core"]]
+
+    assert apply_migrations(conn, "core", "sqlite") == latest
+    assert apply_migrations(conn, "core", "sqlite") == []
+    assert current_version(conn, "core", "sqlite") == latest[-1]
+    assert current_version(conn, "vless", "sqlite") == 0
+
+
+def test_legacy_single_country_subscriptions_are_upgraded(tmp_path):
+    conn = connect(tmp_path)
+    conn.executescript('''
+        CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT);
+        CREATE TABLE subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, plan_id TEXT,
+            start_date TIMESTAMP, end_date TIMESTAMP, status TEXT, payment_id TEXT,
+            outline_key_id TEXT, outline_access_url TEXT
+        );
+        INSERT INTO users VALUES (1, 'alice', 'Alice');
+        INSERT INTO subscriptions (user_id, plan_id, end_date, status, outline_key_id, outline_access_url)
+        VALUES (1, '1_month', '2030-01-01 00:00:00', 'active', '42', 'ss://42');
+    ''')
+
+    apply_migrations(conn, "core", "sqlite")
+
+    assert conn.execute("SELECT duration_plan_id, country_package_id FROM subscriptions").fetchall() == [
+        ("1_month", "5_countries")]
+    assert conn.execute(
+        "SELECT subscription_id, country_code, outline_key_id, outline_access_url FROM subscription_countries"
+    ).fetchall() == [(1, "germany", "42", "ss://42")]
+
+
+def test_failed_migration_is_rolled_back_and_not_recorded(tmp_path, monkeypatch):
+    conn = connect(tmp_path)
+    apply_migrations(conn, "core", "sqlite")
+    version = current_version(conn, "core", "sqlite")
+    broken = MIGRATIONS["core"][0]._replace(
+        version=version + 1, description="broken", sqlite=["CREATE TABLE extra (id INTEGER)", "NOT SQL"])
+    monkeypatch.setitem(MIGRATIONS, "core", MIGRATIONS["core"] + [broken])
+
+    with pytest.raises(sqlite3.OperationalError):
+        apply_migrations(conn, "core", "sqlite")
+
+    assert current_version(conn, "core", "sqlite") == version
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'extra'").fetchall() == []
+
+
+def test_init_db_runs_the_migrations_only_once(db, monkeypatch):
+    calls = []
+    monkeypatch.setattr(db, "apply_migrations", lambda *args: calls.append(args))
+
+    db.init_db()
+
+    assert calls == []
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Tests for the SQLite connection provider and the PostgreSQL pool (db_pool.py).
+"""
+
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from db_pool import PoolTimeout, PostgresConnectionPool, SQLiteConnectionProvider
+
+
+@pytest.fixture
+def provider(tmp_path):
+    provider = SQLiteConnectionProvider(str(tmp_path / "pool.db"))
+    with provider.connection() as conn:
+        conn.execute("CREATE TABLE items (name TEXT)")
+    yield provider
+    provider.close_all()
+
+
+def committed_names(provider):
+    """Rows visible to a separate connection, i.e. committed ones."""
+    conn = sqlite3.connect(provider.db_path)
+    try:
+        return [name for (name,) in conn.execute("SELECT name FROM items ORDER BY name")]
+    finally:
+        conn.close()
+
+
+def test_nested_connections_commit_once_at_the_outermost_level(provider):
+    with provider.connection() as outer:
+        outer.execute("INSERT INTO items VALUES ('a')")
+        with provider.connection() as inner:
+            assert inner is outer
+            inner.execute("INSERT INTO items VALUES ('b')")
+        assert committed_names(provider) == []  # the inner block did not commit
+
+    assert committed_names(provider) == ["a", "b"]
+
+
+def test_error_reaching_the_outermost_level_rolls_back_the_nested_writes(provider):
+    with pytest.raises(RuntimeError):
+        with provider.connection() as outer:
+            outer.execute("INSERT INTO items VALUES ('a')")
+            with provider.connection() as inner:
+                inner.execute("INSERT INTO items VALUES ('b')")
+                raise RuntimeError("boom")
+
+    assert committed_names(provider) == []
+    with provider.connection() as conn:  # the connection is still usable
+        conn.execute("INSERT INTO items VALUES ('c')")
+    assert committed_names(provider) == ["c"]
+
+
+def test_immediate_takes_the_write_lock_before_the_first_read(provider):
+    other = sqlite3.connect(provider.db_path, timeout=0)
+    try:
+        with provider.connection(immediate=True) as conn:
+            conn.execute("SELECT COUNT(*) FROM items").fetchone()
+            with pytest.raises(sqlite3.OperationalError, match="locked"):
+                other.execute("BEGIN IMMEDIATE")
+        other.execute("BEGIN IMMEDIATE")
+        other.rollback()
+    finally:
+        other.close()
+
+
+def test_nested_immediate_borrow_joins_the_open_transaction(provider):
+    with provider.connection() as outer:
+        outer.execute("INSERT INTO items VALUES ('a')")
+        with provider.connection(immediate=True) as inner:
+            inner.execute("INSERT INTO items VALUES ('b')")
+        assert committed_names(provider) == []
+
+    assert committed_names(provider) == ["a", "b"]
+
+
+def test_each_thread_gets_its_own_connection(provider):
+    seen = []
+
+    def borrow():
+        with provider.connection() as conn:
+            seen.append(conn)
+
+    borrow()
+    thread = threading.Thread(target=borrow)
+    thread.start()
+    thread.join()
+    borrow()
+
+    assert seen[0] is seen[2]
+    assert seen[0] is not seen[1]
+    assert provider.stats()["open_connections"] == 2
+
+
+def test_connection_is_recycled_after_max_lifetime_but_not_while_in_use(provider):
+    provider.max_lifetime = 0.01
+    with provider.connection() as first:
+        time.sleep(0.02)
+        with provider.connection() as nested:
+            assert nested is first
+
+    with provider.connection() as recycled:
+        assert recycled is not first
+    assert provider.stats()["recycled"] == 1
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+        self.commits = 0
+        self.rollbacks = 0
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def get_transaction_status(self):
+        return 0
+
+    def close(self):
+        self.closed = True
+
+
+def fake_pool(**kwargs):
+    connections = []
+
+    def connect(dsn):
+        connections.append(FakeConnection())
+        return connections[-1]
+
+    return PostgresConnectionPool("postgresql://test", connect=connect, **kwargs), connections
+
+
+def test_postgres_pool_reuses_returned_connections_and_commits_or_rolls_back():
+    pool, connections = fake_pool(min_size=1, max_size=2)
+
+    with pool.connection() as conn:
+        pass
+    with pytest.raises(RuntimeError):
+        with pool.connection() as again:
+            raise RuntimeError("boom")
+
+    assert again is conn
+    assert len(connections) == 1
+    assert (conn.commits, conn.rollbacks) == (1, 1)
+
+
+def test_postgres_pool_times_out_when_every_connection_is_in_use():
+    pool, connections = fake_pool(min_size=0, max_size=1, timeout=0.05)
+    conn = pool.getconn()
+
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+    assert pool.stats()["timeouts"] == 1
+
+    pool.putconn(conn)
+    assert pool.getconn() is conn
+
+
+def test_postgres_pool_recycles_expired_connections():
+    pool, connections = fake_pool(min_size=1, max_size=1, max_lifetime=0.01)
+    time.sleep(0.02)
+
+    with pool.connection() as conn:
+        assert conn is connections[1]
+    assert connections[0].closed
+    assert pool.stats()["recycled"] == 1
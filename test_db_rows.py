@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Tests for the grouped, typed subscription rows (db_rows.py).
+"""
+
+import datetime
+
+from db_rows import (
+    ActiveSubscription, AdminSubscription, ExpiringSubscription, SubscriptionKey, group_subscription_rows,
+    keyset_page
+)
+
+
+def test_rows_are_grouped_per_subscription_without_splitting_strings():
+    rows = iter([
+        (1, 10, "active", "2030-01-01 00:00:00", "1_month", "germany", "7", "ss://a,b"),
+        (1, 10, "active", "2030-01-01 00:00:00", "1_month", "france", None, "ss://c"),
+        (2, 11, "active", "2030-02-01 00:00:00", "1_month", None, None, None),
+    ])
+
+    first, second = group_subscription_rows(rows, ExpiringSubscription)
+
+    assert first.keys == (SubscriptionKey("germany", "7", "ss://a,b"), SubscriptionKey("france", None, "ss://c"))
+    assert (second.id, second.keys) == (2, ())
+
+
+def test_text_end_dates_are_parsed_to_datetime():
+    rows = [(1, "1_month", "europe", "2030-01-01 12:30:00", "active", "germany", "7", "ss://a")]
+
+    (subscription,) = group_subscription_rows(rows, ActiveSubscription, date_index=3)
+
+    assert subscription.end_date == datetime.datetime(2030, 1, 1, 12, 30)
+
+
+def test_keyset_page_returns_a_cursor_only_when_a_row_was_left_over():
+    end_date = datetime.datetime(2030, 1, 1)
+    rows = [(3, 10, "alice", "Alice", "1_month", "europe", end_date, "active", "de"),
+            (2, 10, "alice", "Alice", "1_month", "europe", None, "pending_payment", None)]
+
+    assert keyset_page(rows, 2) == (rows, None)
+    assert keyset_page(rows, 1) == (rows[:1], (10, end_date, 3))
+
+
+def test_queries_return_typed_rows(db):
+    db.add_user_if_not_exists(1, "alice", "Alice")
+    subscription_id = db.create_subscription_record(1, "1_month", 30)
+    db.provision_subscription(subscription_id, 1, "europe", [("germany", "1", "ss://1"), ("france", None, "ss://2")], 30)
+
+    (active,) = db.get_active_subscriptions(1)
+    admin = db.get_subscription_for_admin(subscription_id)
+
+    assert isinstance(active.end_date, datetime.datetime)
+    assert [key.country_code for key in active.keys] == ["germany", "france"]
+    assert admin == AdminSubscription(subscription_id, 1, "active", active.keys)
+    assert db.get_subscription_for_admin(subscription_id + 1) is None
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Tests for the bounded-concurrency expiry sweep (scheduler_tasks.run_expiry_sweep).
+"""
+
+import asyncio
+import datetime
+from unittest.mock import AsyncMock, Mock
+
+import pytest
+
+# scheduler_tasks needs python-telegram-bot
+scheduler_tasks = pytest.importorskip("scheduler_tasks")
+
+
+def test_fan_out_bounds_concurrency_and_never_reads_ahead():
+    pulled = []
+    running = []
+    peak = 0
+
+    async def source():
+        for item in range(10):
+            pulled.append(item)
+            yield item
+
+    async def handle(item):
+        nonlocal peak
+        running.append(item)
+        peak = max(peak, len(running))
+        assert len(pulled) <= item + 1 + 3
+        await asyncio.sleep(0.01)
+        running.remove(item)
+
+    async def run():
+        return await scheduler_tasks._fan_out(source(), handle, asyncio.Semaphore(3))
+
+    assert asyncio.run(run()) == 10
+    assert peak == 3
+    assert running == []
+
+
+def test_sweep_notifies_each_expired_subscription_once_and_records_timings(db, monkeypatch):
+    db.add_user_if_not_exists(1, "alice", "Alice")
+    subscription_id = db.create_subscription_record(1, "1_month", 30)
+    db.provision_subscription(subscription_id, 1, "pkg", [("germany", "1", "ss://1")], 30)
+    with db.get_sqlite_connection() as conn:
+        conn.execute("UPDATE subscriptions SET end_date = ? WHERE id = ?",
+                     (datetime.datetime.utcnow() - datetime.timedelta(minutes=5), subscription_id))
+    bot = Mock()
+    bot.send_message = AsyncMock()
+
+    asyncio.run(scheduler_tasks.run_expiry_sweep(bot, "timeline"))
+    asyncio.run(scheduler_tasks.run_expiry_sweep(bot, "reconcile"))
+
+    bot.send_message.assert_awaited_once()
+    assert bot.send_message.await_args.kwargs["chat_id"] == 1
+    assert db.count_key_revocations(datetime.datetime.utcnow())[0] == 1
+    stats = scheduler_tasks.get_expiry_sweep_stats()
+    assert stats["runs"] >= 2
+    assert stats["last_trigger"] == "reconcile"
+    assert stats["last_expired"] == 0  # the second run skipped the queued subscription
+    assert stats["last_duration_s"] is not None
+
+
+def test_fan_out_waits_for_started_handlers_when_the_source_fails():
+    finished = []
+
+    async def source():
+        yield 1
+        yield 2
+        raise RuntimeError("connection lost")
+
+    async def handle(item):
+        await asyncio.sleep(0.02)
+        finished.append(item)
+
+    async def run():
+        await scheduler_tasks._fan_out(source(), handle, asyncio.Semaphore(5))
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(run())
+    assert finished == [1, 2]
+
+
+def test_timeline_hands_due_ids_back_when_this_process_is_not_the_leader(monkeypatch):
+    sweeps = []
+
+    async def run_expiry_sweep(bot, trigger):
+        sweeps.append(trigger)
+
+    monkeypatch.setattr(scheduler_tasks, "_timeline", None)
+    monkeypatch.setattr(scheduler_tasks, "run_expiry_sweep", run_expiry_sweep)
+    monkeypatch.setattr(scheduler_tasks, "is_leader", lambda: False)
+    timeline = scheduler_tasks.create_expiry_timeline(Mock())
+
+    asyncio.run(timeline.on_due([1, 2]))
+
+    assert sweeps == []
+    assert sorted(timeline._ends) == [1, 2]
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Tests for the in-memory expiry timeline (expiry_timeline.py).
+"""
+
+import asyncio
+import datetime
+
+import pytest
+
+from expiry_timeline import ExpiryTimeline, to_timestamp
+
+NOW = datetime.datetime(2024, 1, 1, 12, 0, 0)
+
+
+def at(minutes):
+    return NOW + datetime.timedelta(minutes=minutes)
+
+
+async def no_due(subscription_ids):
+    pass
+
+
+def rows_loader(rows, during=None):
+    """A `load` streaming `rows`; `during(index)` runs before each row is yielded."""
+    async def load():
+        for index, row in enumerate(rows):
+            if during:
+                during(index)
+            yield row
+    return load
+
+
+def test_reconcile_keeps_updates_that_arrive_while_streaming():
+    timeline = ExpiryTimeline(no_due, None)
+
+    def during(index):
+        if index == 1:
+            timeline.update(1, at(90))    # renewed after its row was streamed
+            timeline.update(3, None)      # cancelled before its row is streamed
+            timeline.update(4, at(30))    # activated after the snapshot was taken
+
+    timeline.load = rows_loader([(1, at(10)), (2, at(20)), (3, at(30))], during)
+    asyncio.run(timeline.reconcile())
+
+    assert timeline._ends == {1: to_timestamp(at(90)), 2: to_timestamp(at(20)), 4: to_timestamp(at(30))}
+    assert sorted(timeline._heap) == sorted((end_ts, sid) for sid, end_ts in timeline._ends.items())
+    assert timeline._touched is None
+
+
+def test_reconcile_reports_drift():
+    timeline = ExpiryTimeline(no_due, rows_loader([(1, at(10)), (2, at(20))]))
+    assert asyncio.run(timeline.reconcile()) == 0  # the initial load
+
+    timeline.load = rows_loader([(1, at(10)), (2, at(50)), (3, at(60))])
+    assert asyncio.run(timeline.reconcile()) == 2
+    assert timeline.stats()["last_drift"] == 2
+
+
+def test_failed_reconcile_stops_tracking_updates():
+    async def load():
+        yield 1, at(10)
+        raise RuntimeError("connection lost")
+
+    timeline = ExpiryTimeline(no_due, load)
+    with pytest.raises(RuntimeError):
+        asyncio.run(timeline.reconcile())
+    assert timeline._touched is None
+
+
+def test_pop_due_skips_stale_entries():
+    timeline = ExpiryTimeline(no_due, None)
+    timeline.update(1, at(10))
+    timeline.update(1, at(60))  # renewed: the entry at 10 is stale
+    timeline.update(2, at(20))
+    timeline.update(3, at(30))
+    timeline.update(3, None)    # cancelled
+    timeline.update(4, at(40))
+
+    due, next_at = timeline._pop_due(to_timestamp(at(35)))
+
+    assert due == [2]
+    assert next_at == to_timestamp(at(40))
+    assert set(timeline._ends) == {1, 4}
+
+    due, next_at = timeline._pop_due(to_timestamp(at(60)))
+    assert due == [4, 1]
+    assert next_at is None
+
+
+def test_pop_due_drops_stale_entries_ahead_of_the_next_live_one():
+    timeline = ExpiryTimeline(no_due, None)
+    timeline.update(1, at(10))
+    timeline.update(1, None)
+    timeline.update(2, at(50))
+
+    due, next_at = timeline._pop_due(to_timestamp(NOW))
+
+    assert due == []
+    assert next_at == to_timestamp(at(50))
+    assert timeline._heap == [(to_timestamp(at(50)), 2)]
+
+
+def test_compact_rebuilds_the_heap_once_stale_entries_pile_up():
+    timeline = ExpiryTimeline(no_due, None)
+    timeline.update(1, at(0))
+    timeline.update(2, at(0))
+    for minute in range(1, 2000):
+        timeline.update(1, at(minute))  # every renewal leaves a stale entry behind
+
+    assert len(timeline._heap) <= 2 * len(timeline._ends) + 1024
+    assert len(timeline._heap) < 2000
+    live = {(end_ts, sid) for sid, end_ts in timeline._ends.items()}
+    assert live <= set(timeline._heap)
+
+    due, _ = timeline._pop_due(to_timestamp(at(5000)))
+    assert sorted(due) == [1, 2]
+
+
+def test_failed_on_due_is_retried_after_retry_seconds():
+    calls = []
+
+    async def on_due(subscription_ids):
+        calls.append((sorted(subscription_ids), asyncio.get_running_loop().time()))
+        if len(calls) == 1:
+            raise RuntimeError("database unavailable")
+
+    past = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+    timeline = ExpiryTimeline(on_due, rows_loader([(1, past), (2, past)]), retry_seconds=0.2)
+
+    async def run():
+        await timeline.start()
+        for _ in range(100):
+            if len(calls) >= 2:
+                break
+            await asyncio.sleep(0.02)
+        await timeline.stop()
+
+    asyncio.run(run())
+
+    assert [ids for ids, _ in calls] == [[1, 2], [1, 2]]
+    assert calls[1][1] - calls[0][1] >= 0.15
+    assert timeline._ends == {}
+    assert timeline.stats()["due_handled"] == 4
+
+
+def test_data_layer_reports_end_date_changes_and_loads_the_active_set(db, monkeypatch):
+    changes = []
+    monkeypatch.setattr(db, "_end_date_listeners", [])
+    db.add_end_date_listener(lambda subscription_id, end_date: changes.append((subscription_id, end_date)))
+    db.add_user_if_not_exists(1, "alice", "Alice")
+    first = db.create_subscription_record(1, "1_month", 30)
+    second = db.create_subscription_record(1, "1_month", 30)
+
+    end_date = db.provision_subscription(first, 1, "pkg", [("germany", "1", "ss://1")], 30)
+    db.activate_subscription(second, 1, 30)
+    db.renew_subscription(first, 1, at(90), "renewal")
+    db.cancel_subscription_by_admin(second, 1)
+
+    assert [subscription_id for subscription_id, _ in changes] == [first, second, first, second]
+    assert changes[0][1] == end_date
+    assert changes[2][1] == at(90)
+    assert changes[3][1] is None
+    assert list(db.iter_active_subscription_end_dates(10)) == [(first, at(90))]
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Tests for streaming the expiry window (iter_subscriptions_in_expiry_window and database_async.stream_db).
+"""
+
+import asyncio
+import datetime
+import time
+
+import pytest
+
+from database_async import stream_db
+
+NOW = datetime.datetime(2024, 1, 1, 12, 0, 0)
+
+
+def add_subscription(db, user_id, end_date, status="active"):
+    with db.get_sqlite_connection() as conn:
+        cursor = conn.execute('''
+            INSERT INTO subscriptions (user_id, duration_plan_id, status, start_date, end_date)
+            VALUES (?, '1_month', ?, ?, ?)
+        ''', (user_id, status, end_date - datetime.timedelta(days=30), end_date))
+        return cursor.lastrowid
+
+
+def test_only_active_subscriptions_inside_the_window_are_streamed(db):
+    late = add_subscription(db, 1, NOW + datetime.timedelta(days=2))
+    early = add_subscription(db, 2, NOW - datetime.timedelta(hours=1))
+    add_subscription(db, 3, NOW - datetime.timedelta(days=30))  # expired long ago
+    add_subscription(db, 4, NOW + datetime.timedelta(days=30))  # far from expiring
+    add_subscription(db, 5, NOW, status="cancelled_by_admin")
+
+    rows = list(db.iter_subscriptions_in_expiry_window(
+        NOW - datetime.timedelta(days=1), NOW + datetime.timedelta(days=3), batch_size=1))
+
+    assert [row[0] for row in rows] == [early, late]
+
+
+def collect(source, **kwargs):
+    async def run():
+        return [row async for row in stream_db(source, **kwargs)]
+    return asyncio.run(run())
+
+
+def test_stream_db_yields_every_row_across_chunks():
+    assert collect(lambda: iter(range(7)), chunk_size=3) == list(range(7))
+    assert collect(lambda: iter([]), chunk_size=3) == []
+
+
+def test_leaving_the_stream_early_closes_the_source():
+    closed = []
+
+    def source():
+        try:
+            yield from range(1000)
+        finally:
+            closed.append(True)
+
+    async def run():
+        rows = []
+        async for row in stream_db(source, chunk_size=10, max_chunks=1):
+            rows.append(row)
+            if len(rows) == 15:
+                break
+        return rows
+
+    assert asyncio.run(run()) == list(range(15))
+    assert closed == [True]
+
+
+def test_stream_db_raises_the_source_s_error():
+    def source():
+        yield 1
+        raise RuntimeError("connection lost")
+
+    with pytest.raises(RuntimeError, match="connection lost"):
+        collect(source, chunk_size=10)
+
+
+def test_stream_db_raises_when_the_source_call_fails():
+    def source():
+        raise RuntimeError("no connection")
+
+    async def run():
+        return await asyncio.wait_for(stream_rows(), 3)
+
+    async def stream_rows():
+        return [row async for row in stream_db(source)]
+
+    started = time.perf_counter()
+    with pytest.raises(RuntimeError, match="no connection"):
+        asyncio.run(run())
+    assert time.perf_counter() - started < 1
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Tests for the pre-provisioned Outline key pool (key_pool) and its refill job.
+"""
+
+import asyncio
+
+import pytest
+
+from key_revocation import KeyRevoker
+
+
+def test_each_pooled_key_is_claimed_only_once(db):
+    db.add_pooled_keys([("germany", "de1", "1", "ss://1"), ("germany", "de1", "2", "ss://2"),
+                        ("netherlands", "nl1", "3", "ss://3")])
+    db.add_pooled_keys([("germany", "de1", "1", "ss://1")])  # already pooled: ignored
+
+    first = db.claim_pooled_keys([("germany", "de1"), ("netherlands", "nl1")])
+    second = db.claim_pooled_keys([("germany", "de1"), ("netherlands", "nl1")])
+    third = db.claim_pooled_keys([("germany", "de1")])
+
+    assert [(key.country_code, key.outline_key_id) for key in first] == [("germany", "1"), ("netherlands", "3")]
+    assert [(key.country_code, key.outline_key_id) for key in second] == [("germany", "2")]
+    assert third == []
+    assert db.count_pooled_keys() == {}
+
+
+def test_claim_only_takes_keys_of_the_current_server(db):
+    db.add_pooled_keys([("germany", "old", "1", "ss://1"), ("germany", "new", "2", "ss://2"),
+                        ("germany", "new", "3", "ss://3")])
+
+    assert [key.outline_key_id for key in db.claim_pooled_keys([("germany", "new")])] == ["2"]
+    assert db.count_pooled_keys() == {("germany", "old"): 1, ("germany", "new"): 1}
+    stale = db.discard_stale_pooled_keys({"germany": "new"})
+    assert [(key.country_code, key.outline_key_id, key.outline_access_url) for key in stale] == [("germany", "1", "ss://1")]
+    assert db.count_pooled_keys() == {("germany", "new"): 1}
+
+
+def test_refill_tops_a_low_pool_up_and_releases_stale_keys(db, monkeypatch):
+    # scheduler_tasks needs python-telegram-bot
+    scheduler_tasks = pytest.importorskip("scheduler_tasks")
+    created = []
+
+    async def create_outline_key(country_code, key_name_prefix="user", name=None):
+        created.append(name)
+        if len(created) == 2:
+            raise RuntimeError("server unreachable")
+        return str(len(created)), f"ss://{len(created)}"
+
+    async def get_key_access_urls(country_code):
+        return {"8": "ss://8", "9": "ss://someone-else"}  # "8" is still ours: only the API path changed
+
+    deleted = []
+
+    async def delete(country_code, key_id):
+        deleted.append(key_id)
+        return True
+
+    monkeypatch.setattr(scheduler_tasks, "create_outline_key", create_outline_key)
+    monkeypatch.setattr(scheduler_tasks, "get_key_access_urls", get_key_access_urls)
+    monkeypatch.setattr(scheduler_tasks, "key_revoker", KeyRevoker(delete))
+    monkeypatch.setattr(scheduler_tasks, "current_pool_servers", lambda: {"germany": "de1"})
+    monkeypatch.setattr(scheduler_tasks, "KEY_POOL_LOW_WATER", 2)
+    monkeypatch.setattr(scheduler_tasks, "KEY_POOL_TARGET", 4)
+    monkeypatch.setattr(scheduler_tasks, "KEY_POOL_REFILL_BATCH", 10)
+    db.add_pooled_keys([("germany", "de1", "0", "ss://0"), ("germany", "old", "8", "ss://8"),
+                        ("germany", "old", "9", "ss://9")])
+
+    asyncio.run(scheduler_tasks.refill_key_pools(None))
+
+    assert created == ["pool_germany"] * 3
+    assert db.count_pooled_keys() == {("germany", "de1"): 3}
+    # A stale key is only deleted if the current server still holds it; the other one is dead-lettered
+    assert deleted == ["8"]
+    assert db.count_dead_letter_keys() == 1
+    stats = scheduler_tasks.get_key_pool_stats()
+    assert stats["depth"] == {"germany": 3}
+    assert stats["stale"] == 0
+    assert stats["refill"]["countries"]["germany"]["created"] == 2
+    assert stats["refill"]["countries"]["germany"]["failed"] == 1
+
+
+def test_refill_of_a_full_pool_creates_nothing(monkeypatch):
+    # scheduler_tasks needs python-telegram-bot
+    scheduler_tasks = pytest.importorskip("scheduler_tasks")
+    created = []
+
+    async def create_outline_key(country_code, key_name_prefix="user", name=None):
+        created.append(name)
+
+    monkeypatch.setattr(scheduler_tasks, "create_outline_key", create_outline_key)
+    monkeypatch.setattr(scheduler_tasks, "KEY_POOL_TARGET", 4)
+
+    asyncio.run(scheduler_tasks._refill_pool("germany", "de1", 4))
+
+    assert created == []
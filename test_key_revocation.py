@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Tests for the concurrent Outline key revoker (key_revocation.py).
+"""
+
+import asyncio
+
+from db_rows import SubscriptionKey
+from key_revocation import KeyRevoker
+
+
+def keys(country_code, count):
+    return [SubscriptionKey(country_code, str(key_id), f"ss://{key_id}") for key_id in range(count)]
+
+
+def test_revoke_deletes_the_whole_batch_at_once():
+    in_flight = 0
+    peak = 0
+
+    async def delete(country_code, key_id):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return True
+
+    revoker = KeyRevoker(delete)
+    result = asyncio.run(revoker.revoke(keys("de", 6) + keys("nl", 6)))
+
+    assert result.failed == []
+    assert result.stats["deleted"] == 12
+    assert peak == 12
+
+
+def test_revoke_retries_then_reports_the_keys_that_still_fail():
+    calls = []
+
+    async def delete(country_code, key_id):
+        calls.append(key_id)
+        if key_id == "0" and calls.count("0") == 1:
+            raise RuntimeError("timeout")
+        return key_id != "1"
+
+    revoker = KeyRevoker(delete, retries=2, retry_delay=0)
+    result = asyncio.run(revoker.revoke(keys("de", 3)))
+
+    assert [(key.outline_key_id, error) for key, error in result.failed] == [("1", "delete refused by the server")]
+    assert calls.count("0") == 2
+    assert calls.count("1") == 3
+    assert revoker.stats()["retries"] == 3
+
+
+def test_revoke_does_not_retry_a_server_without_client():
+    calls = []
+
+    async def delete(country_code, key_id):
+        calls.append((country_code, key_id))
+        if country_code == "nl":
+            raise ValueError("Country nl not found in OUTLINE_SERVERS configuration")
+        return True
+
+    revoker = KeyRevoker(delete, retries=2, retry_delay=0)
+    result = asyncio.run(revoker.revoke(keys("de", 1) + keys("nl", 2)))
+
+    assert sorted(calls) == [("de", "0"), ("nl", "0"), ("nl", "1")]
+    assert sorted((key.country_code, key.outline_key_id) for key, _ in result.failed) == [("nl", "0"), ("nl", "1")]
+    assert result.stats["servers"]["nl"]["failed"] == 2
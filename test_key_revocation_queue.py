@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Tests for the key revocation queue (key_revocations) on a temporary SQLite database.
+"""
+
+import asyncio
+import datetime
+from unittest.mock import AsyncMock, Mock
+
+import database
+from db_rows import SubscriptionKey
+from key_revocation import KeyRevoker
+
+
+def create_expired_subscription(user_id, keys, expired_minutes_ago=10):
+    """An active subscription with `keys` [(country, key_id)] whose end date has passed."""
+    database.upsert_users([(user_id, f"user{user_id}", "Test")])
+    subscription_id = database.create_subscription_record(user_id, "1_month", 30)
+    database.provision_subscription(
+        subscription_id, user_id, "pkg", [(country, key_id, f"ss://{key_id}") for country, key_id in keys], 30
+    )
+    end_date = datetime.datetime.utcnow() - datetime.timedelta(minutes=expired_minutes_ago)
+    with database.get_sqlite_connection() as conn:
+        conn.execute("UPDATE subscriptions SET end_date = ? WHERE id = ?", (end_date, subscription_id))
+    return subscription_id
+
+
+def subscription_status(subscription_id):
+    with database.get_sqlite_connection() as conn:
+        return conn.execute("SELECT status FROM subscriptions WHERE id = ?", (subscription_id,)).fetchone()[0]
+
+
+def set_due(subscription_id, due_at):
+    with database.get_sqlite_connection() as conn:
+        conn.execute("UPDATE key_revocations SET due_at = ? WHERE subscription_id = ?", (due_at, subscription_id))
+
+
+def test_enqueue_is_idempotent_per_subscription(db):
+    now = datetime.datetime.utcnow()
+    subscription_id = create_expired_subscription(1, [("de", "1")])
+
+    assert db.enqueue_key_revocation(subscription_id, 1, now) is True
+    assert db.enqueue_key_revocation(subscription_id, 1, now + datetime.timedelta(hours=1)) is False
+    assert db.enqueue_overdue_key_revocations(now, now) == 0
+    assert db.count_key_revocations(now) == (1, 1)
+
+
+def test_due_revocations_drop_renewed_subscriptions(db):
+    now = datetime.datetime.utcnow()
+    expired = create_expired_subscription(1, [("de", "1"), ("nl", "2")])
+    renewed = create_expired_subscription(2, [("de", "3")])
+    db.enqueue_key_revocation(expired, 1, now)
+    db.enqueue_key_revocation(renewed, 2, now)
+    db.activate_subscription(renewed, 2, 30)
+
+    due = db.get_due_key_revocations(datetime.datetime.utcnow(), 10)
+
+    assert [revocation.subscription_id for revocation in due] == [expired]
+    assert [(key.country_code, key.outline_key_id) for key in due[0].keys] == [("de", "1"), ("nl", "2")]
+    assert db.count_key_revocations(datetime.datetime.utcnow()) == (1, 1)
+
+
+def test_due_revocations_are_narrowed_to_pending_keys(db):
+    now = datetime.datetime.utcnow()
+    subscription_id = create_expired_subscription(1, [("de", "1"), ("nl", "2"), ("us", "3")])
+    db.enqueue_key_revocation(subscription_id, 1, now)
+
+    db.reschedule_key_revocation(subscription_id, now, [SubscriptionKey("nl", "2", None)], "nl:2: timeout")
+    due = db.get_due_key_revocations(datetime.datetime.utcnow(), 10)
+
+    assert len(due) == 1
+    assert due[0].attempts == 1
+    assert [(key.country_code, key.outline_key_id) for key in due[0].keys] == [("nl", "2")]
+
+
+def test_complete_leaves_a_just_renewed_subscription_active(db):
+    now = datetime.datetime.utcnow()
+    expired = create_expired_subscription(1, [("de", "1")])
+    renewed = create_expired_subscription(2, [("de", "2")])
+    db.enqueue_key_revocation(expired, 1, now)
+    db.enqueue_key_revocation(renewed, 2, now)
+    due = db.get_due_key_revocations(datetime.datetime.utcnow(), 10)
+    assert len(due) == 2
+
+    # Renewed between the fetch and the completion
+    db.activate_subscription(renewed, 2, 30)
+    db.complete_key_revocations(due, datetime.datetime.utcnow())
+
+    assert subscription_status(expired) == "expired"
+    assert subscription_status(renewed) == "active"
+    assert db.count_key_revocations(datetime.datetime.utcnow()) == (0, 0)
+
+
+def test_process_retries_partial_failures_then_dead_letters_them(db, monkeypatch):
+    # scheduler_tasks needs python-telegram-bot
+    import scheduler_tasks
+
+    deleted = []
+
+    async def delete(country_code, key_id):
+        if country_code == "nl":
+            raise RuntimeError("server unreachable")
+        deleted.append((country_code, key_id))
+        return True
+
+    monkeypatch.setattr(scheduler_tasks, "key_revoker", KeyRevoker(delete, retries=0, retry_delay=0))
+    monkeypatch.setattr(scheduler_tasks, "KEY_REVOCATION_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(scheduler_tasks, "KEY_REVOCATION_RETRY_SECONDS", 60)
+    context = Mock()
+    context.bot.send_message = AsyncMock()
+
+    subscription_id = create_expired_subscription(1, [("de", "1"), ("nl", "2")])
+    db.enqueue_key_revocation(subscription_id, 1, datetime.datetime.utcnow())
+
+    # First run: "de" is deleted, "nl" is rescheduled with backoff
+    asyncio.run(scheduler_tasks.process_key_revocations(context))
+    assert deleted == [("de", "1")]
+    assert subscription_status(subscription_id) == "active"
+    assert db.count_key_revocations(datetime.datetime.utcnow()) == (1, 0)
+    assert db.count_dead_letter_keys() == 0
+    context.bot.send_message.assert_not_awaited()
+
+    # Second run once the backoff is over: only "nl" is retried, fails for the last time and is dead-lettered
+    set_due(subscription_id, datetime.datetime.utcnow() - datetime.timedelta(seconds=1))
+    asyncio.run(scheduler_tasks.process_key_revocations(context))
+    assert deleted == [("de", "1")]
+    assert subscription_status(subscription_id) == "expired"
+    assert db.count_key_revocations(datetime.datetime.utcnow()) == (0, 0)
+    assert db.count_dead_letter_keys() == 1
+    context.bot.send_message.assert_awaited_once()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Tests for the known-user set and batched profile upserts (db_cache.KnownUserSet, database.py).
+"""
+
+import asyncio
+
+import database_async
+from db_cache import BloomFilter
+
+
+def user_rows(db):
+    with db.get_sqlite_connection() as conn:
+        return conn.execute("SELECT user_id, username, first_name FROM users ORDER BY user_id").fetchall()
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000, 0.01)
+    for key in range(0, 50000, 50):
+        bloom.add(key)
+
+    assert all(key in bloom for key in range(0, 50000, 50))
+
+
+def test_new_user_is_written_and_a_repeat_user_is_not(db):
+    db.add_user_if_not_exists(1, "alice", "Alice")
+    with db.get_sqlite_connection() as conn:
+        conn.execute("DELETE FROM users")
+
+    db.add_user_if_not_exists(1, "alice", "Alice")
+
+    assert user_rows(db) == []  # answered from memory
+    assert db.known_users.stats()["known"] == 1
+
+
+def test_profile_changes_are_queued_and_flushed_in_one_batch(db):
+    db.add_user_if_not_exists(1, "alice", "Alice")
+    db.add_user_if_not_exists(2, "bob", "Bob")
+
+    db.add_user_if_not_exists(1, "alice2", "Alice")
+    db.add_user_if_not_exists(2, "bob", "Robert")
+    assert [tuple(row) for row in user_rows(db)] == [(1, "alice", "Alice"), (2, "bob", "Bob")]
+
+    assert db.flush_user_profile_updates() == 2
+    assert [tuple(row) for row in user_rows(db)] == [(1, "alice2", "Alice"), (2, "bob", "Robert")]
+    assert db.flush_user_profile_updates() == 0
+
+
+def test_warmed_users_are_known_without_a_write(db):
+    db.upsert_users([(1, "alice", "Alice"), (2, "bob", "Bob")])
+
+    assert db.warm_known_users() == 2
+    db.add_user_if_not_exists(2, "bob", "Bob")
+    assert db.known_users.stats()["known"] == 1
+
+
+def test_subscription_writes_the_owner_s_queued_row_first(db):
+    db.known_users.add(7, "carol", "Carol")
+    db.add_user_if_not_exists(7, "carol", "Caroline")  # queued; no users row yet
+
+    db.create_subscription_record(7, "1m", 30)
+
+    assert [tuple(row) for row in user_rows(db)] == [(7, "carol", "Caroline")]
+
+
+def test_awaitable_registration_queues_profile_changes_like_the_sync_call(db):
+    asyncio.run(database_async.add_user_if_not_exists(1, "alice", "Alice"))
+    asyncio.run(database_async.add_user_if_not_exists(1, "alice2", "Alice"))
+
+    assert [tuple(row) for row in user_rows(db)] == [(1, "alice", "Alice")]
+    assert db.flush_user_profile_updates() == 1
+    assert [tuple(row) for row in user_rows(db)] == [(1, "alice2", "Alice")]
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Tests for the scheduler leader election (leader_lease.py).
+"""
+
+import asyncio
+import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import leader_lease
+import stats_registry
+from db_migrations import apply_migrations
+from db_pool import SQLiteConnectionProvider
+from leader_lease import LeaderElector, SQLiteLease
+
+
+class FakeDatetime(datetime.datetime):
+    now_value = datetime.datetime(2024, 1, 1, 12, 0, 0)
+
+    @classmethod
+    def utcnow(cls):
+        return cls.now_value
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Controls datetime.utcnow() as seen by leader_lease."""
+    monkeypatch.setattr(leader_lease, "datetime", SimpleNamespace(datetime=FakeDatetime,
+                                                                   timedelta=datetime.timedelta))
+    FakeDatetime.now_value = datetime.datetime(2024, 1, 1, 12, 0, 0)
+
+    def advance(seconds):
+        FakeDatetime.now_value += datetime.timedelta(seconds=seconds)
+    return advance
+
+
+@pytest.fixture
+def connect(tmp_path):
+    pool = SQLiteConnectionProvider(str(tmp_path / "lease.db"))
+    with pool.connection() as conn:
+        apply_migrations(conn, "core", "sqlite")
+    yield pool.connection
+    pool.close_all()
+
+
+def lease_row(connect):
+    with connect() as conn:
+        return conn.execute("SELECT holder, acquired_at FROM scheduler_leases WHERE name = 'jobs'").fetchone()
+
+
+def test_sqlite_lease_is_taken_over_only_after_it_expires(connect, clock):
+    first = SQLiteLease(connect, "jobs", "worker-1", ttl=30)
+    second = SQLiteLease(connect, "jobs", "worker-2", ttl=30)
+
+    assert first.acquire() is True  # inserted
+    assert second.acquire() is False  # the WHERE clause keeps the row: rowcount 0
+    clock(29)
+    assert first.acquire() is True  # renewed: rowcount 1
+    clock(29)
+    assert second.acquire() is False  # renewed 29s ago, still valid
+    assert lease_row(connect)[0] == "worker-1"
+
+    clock(2)
+    assert second.acquire() is True  # expired: taken over
+    assert first.acquire() is False
+    assert lease_row(connect)[0] == "worker-2"
+
+
+def test_sqlite_lease_can_be_taken_inside_a_borrowed_connection(connect, clock):
+    lease = SQLiteLease(connect, "jobs", "worker-1", ttl=30)
+
+    with connect() as conn:
+        conn.execute("INSERT INTO scheduler_leases (name, holder, expires_at, acquired_at) VALUES ('other', 'x', ?, ?)",
+                     (FakeDatetime.now_value, FakeDatetime.now_value))
+        assert lease.acquire() is True
+    assert lease_row(connect)[0] == "worker-1"
+
+
+def test_sqlite_lease_keeps_acquired_at_on_renewal(connect, clock):
+    first = SQLiteLease(connect, "jobs", "worker-1", ttl=30)
+    second = SQLiteLease(connect, "jobs", "worker-2", ttl=30)
+    first.acquire()
+    acquired_at = lease_row(connect)[1]
+
+    clock(10)
+    first.acquire()
+    assert lease_row(connect)[1] == acquired_at
+
+    clock(60)
+    second.acquire()
+    assert lease_row(connect)[1] != acquired_at
+
+
+def test_sqlite_lease_release_only_drops_our_row(connect, clock):
+    first = SQLiteLease(connect, "jobs", "worker-1", ttl=30)
+    second = SQLiteLease(connect, "jobs", "worker-2", ttl=30)
+    first.acquire()
+
+    second.release()
+    assert lease_row(connect)[0] == "worker-1"
+    first.release()
+    assert lease_row(connect) is None
+    assert second.acquire() is True
+
+
+class FakeLease:
+    """Returns (or raises) the scripted results of acquire() one by one."""
+
+    backend = "fake"
+
+    def __init__(self, results, outlives_errors):
+        self.results = list(results)
+        self.outlives_errors = outlives_errors
+
+    def acquire(self):
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def release(self):
+        pass
+
+
+class StopElection(Exception):
+    pass
+
+
+def run_election(monkeypatch, lease, ttl=30, interval=10, on_elected=None):
+    """Run LeaderElector._run on a fake monotonic clock until the lease script is used up.
+
+    Returns the elector and (time, is_leader) seen at the start of every sleep.
+    """
+    now = [1000.0]
+    observed = []
+    events = []
+
+    async def sleep(delay):
+        await asyncio.sleep(0)  # let the leadership callbacks started so far run
+        observed.append((now[0] - 1000.0, elector.is_leader))
+        if not lease.results:
+            raise StopElection()
+        now[0] += delay
+
+    monkeypatch.setattr(leader_lease, "time", SimpleNamespace(monotonic=lambda: now[0], time=lambda: now[0]))
+    monkeypatch.setattr(leader_lease, "asyncio", SimpleNamespace(get_running_loop=asyncio.get_running_loop,
+                                                                  create_task=asyncio.create_task, sleep=sleep))
+
+    async def record_elected():
+        events.append(("elected", now[0] - 1000.0))
+
+    async def on_demoted():
+        events.append(("demoted", now[0] - 1000.0))
+
+    elector = LeaderElector(lease, ttl, interval, on_elected=on_elected or record_elected, on_demoted=on_demoted)
+    with pytest.raises(StopElection):
+        asyncio.run(elector._run())
+    return elector, observed, events
+
+
+def test_time_bound_lease_stays_leader_through_errors_until_valid_until(monkeypatch):
+    lease = FakeLease([True, RuntimeError("database is locked"), RuntimeError("database is locked")],
+                      outlives_errors=True)
+
+    elector, observed, events = run_election(monkeypatch, lease)
+
+    # Renewed at t=0, so trusted until t=0+30-10=20: the failed check at t=10 keeps leadership,
+    # the one at t=20 gives it up
+    assert observed == [(0, True), (10, True), (20, False)]
+    assert events == [("elected", 0), ("demoted", 20)]
+    assert elector.stats()["failures"] == 2
+    assert elector.stats()["last_error"] == "database is locked"
+
+
+def test_renewal_extends_valid_until(monkeypatch):
+    lease = FakeLease([True, True, RuntimeError("database is locked"), RuntimeError("database is locked")],
+                      outlives_errors=True)
+
+    elector, observed, events = run_election(monkeypatch, lease)
+
+    assert observed == [(0, True), (10, True), (20, True), (30, False)]
+    assert events == [("elected", 0), ("demoted", 30)]
+
+
+def test_session_lease_is_lost_on_the_first_error(monkeypatch):
+    lease = FakeLease([True, RuntimeError("connection closed"), True], outlives_errors=False)
+
+    elector, observed, events = run_election(monkeypatch, lease)
+
+    assert observed == [(0, True), (10, False), (20, True)]
+    assert events == [("elected", 0), ("demoted", 10), ("elected", 20)]
+
+
+def test_slow_election_callback_does_not_delay_renewals(monkeypatch):
+    lease = FakeLease([True, True, True], outlives_errors=False)
+
+    async def on_elected():
+        await asyncio.Event().wait()  # e.g. a long expiry timeline load
+
+    elector, observed, events = run_election(monkeypatch, lease, on_elected=on_elected)
+
+    assert observed == [(0, True), (10, True), (20, True)]
+
+
+def test_interval_must_be_at_most_half_the_ttl():
+    with pytest.raises(ValueError):
+        LeaderElector(FakeLease([], outlives_errors=True), ttl=30, interval=20)
+
+
+def test_leader_only_jobs_run_in_the_leader_process_only():
+    runs = []
+
+    @leader_lease.leader_only
+    async def job(context):
+        runs.append(context)
+
+    async def run():
+        await job("no election")  # no elector running: every process is leader
+        elector = LeaderElector(FakeLease([False] * 100, outlives_errors=True), ttl=30, interval=10)
+        await elector.start()
+        await asyncio.sleep(0)
+        assert stats_registry.collect()["scheduler_leader"]["is_leader"] is False
+        await job("standby")
+        await elector.stop()
+        assert "scheduler_leader" not in stats_registry.collect()
+        await job("stopped")
+
+    asyncio.run(run())
+    assert runs == ["no election", "stopped"]
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Tests for the outbound message scheduler (message_scheduler.py).
+"""
+
+import asyncio
+import time
+
+import pytest
+from telegram.error import RetryAfter
+
+import stats_registry
+from message_scheduler import MessageScheduler, Priority, TokenBucket, _LaneStats, _Ticket
+
+
+def test_token_bucket_delay_and_take():
+    bucket = TokenBucket(rate=2, burst=3, now=0.0)
+    for _ in range(3):
+        assert bucket.delay(0.0) == 0.0
+        bucket.take(0.0)
+
+    assert bucket.delay(0.0) == pytest.approx(0.5)
+    assert bucket.delay(0.25) == pytest.approx(0.25)
+    assert bucket.delay(0.5) == 0.0
+    bucket.take(0.5)
+    assert not bucket.full(0.5)
+    assert bucket.full(10.0)
+    assert bucket.tokens == 3  # refills up to the burst only
+
+
+def with_tickets(test):
+    """Run `test(scheduler, ticket)` in an event loop; `ticket(priority, chat_id)` queues a ticket."""
+    async def run():
+        loop = asyncio.get_running_loop()
+        scheduler = MessageScheduler(chat_rate=1, chat_burst=1)
+
+        def ticket(priority, chat_id):
+            queued = _Ticket(chat_id, loop.create_future(), time.monotonic())
+            scheduler._lanes[priority].append(queued)
+            return queued
+
+        test(scheduler, ticket)
+    asyncio.run(run())
+
+
+def test_pick_takes_the_most_urgent_lane_first():
+    def test(scheduler, ticket):
+        broadcast = ticket(Priority.BROADCAST, 1)
+        expiry = ticket(Priority.EXPIRY, 2)
+        payment = ticket(Priority.PAYMENT, 3)
+        now = time.monotonic()
+
+        assert scheduler._pick(now) == (payment, None)
+        assert scheduler._pick(now) == (expiry, None)
+        assert scheduler._pick(now) == (broadcast, None)
+        assert scheduler._pick(now) == (None, None)
+    with_tickets(test)
+
+
+def test_pick_skips_chats_without_tokens():
+    def test(scheduler, ticket):
+        now = time.monotonic()
+        scheduler._chat_bucket(1, now).take(now)  # chat 1 just got a message
+        first = ticket(Priority.PAYMENT, 1)
+        second = ticket(Priority.PAYMENT, 2)
+
+        assert scheduler._pick(now) == (second, None)
+        ticket_, wait = scheduler._pick(now)
+        assert ticket_ is None
+        assert wait == pytest.approx(1.0, abs=0.01)
+        assert list(scheduler._lanes[Priority.PAYMENT]) == [first]
+    with_tickets(test)
+
+
+def test_pick_drops_tickets_of_callers_that_gave_up():
+    def test(scheduler, ticket):
+        gone = ticket(Priority.PAYMENT, 1)
+        waiting = ticket(Priority.PAYMENT, 2)
+        gone.future.cancel()
+        now = time.monotonic()
+
+        assert scheduler._pick(now) == (None, 0.0)
+        assert scheduler._pick(now) == (waiting, None)
+    with_tickets(test)
+
+
+def run_scheduler(test, **kwargs):
+    async def run():
+        scheduler = MessageScheduler(**kwargs)
+        await scheduler.initialize()
+        try:
+            await test(scheduler)
+        finally:
+            await scheduler.shutdown()
+    asyncio.run(run())
+
+
+def test_retry_after_pauses_and_retries_at_the_front_of_the_lane():
+    sent = []
+
+    async def test(scheduler):
+        # One message per 0.1s overall, so the second call is still queued when the first hits the limit
+        scheduler._global = TokenBucket(10, 1, time.monotonic())
+        attempts = []
+
+        async def first():
+            attempts.append(time.monotonic())
+            if len(attempts) == 1:
+                other.append(asyncio.create_task(
+                    scheduler.process_request(second, (), {}, "sendMessage", {"chat_id": 2}, None)))
+                await asyncio.sleep(0.02)
+                raise RetryAfter(0.2)
+            sent.append("first")
+
+        async def second():
+            sent.append("second")
+
+        other = []
+        await scheduler.process_request(first, (), {}, "sendMessage", {"chat_id": 1}, None)
+        await other[0]
+
+        assert attempts[1] - attempts[0] >= 0.2
+        assert scheduler.stats()["retry_after"] == 1
+        assert scheduler.stats()["lanes"]["payment"]["retried"] == 1
+        assert scheduler.stats()["lanes"]["payment"]["sent"] == 2
+
+    run_scheduler(test)
+    assert sent == ["first", "second"]
+
+
+def test_retry_after_gives_up_after_max_retries():
+    async def test(scheduler):
+        calls = []
+
+        async def flooded():
+            calls.append(1)
+            raise RetryAfter(0.01)
+
+        with pytest.raises(RetryAfter):
+            await scheduler.process_request(flooded, (), {}, "sendMessage", {"chat_id": 1}, Priority.REMINDER)
+
+        assert len(calls) == 3
+        lane = scheduler.stats()["lanes"]["reminder"]
+        assert lane["retried"] == 3
+        assert lane["failed"] == 1
+
+    run_scheduler(test, max_retries=2, chat_burst=10)
+
+
+def test_cancelled_callers_are_dropped_from_the_lane():
+    async def test(scheduler):
+        calls = []
+
+        async def send(name):
+            calls.append(name)
+
+        scheduler._paused_until = time.monotonic() + 0.1
+        cancelled = asyncio.create_task(
+            scheduler.process_request(send, ("cancelled",), {}, "sendMessage", {"chat_id": 1}, Priority.BROADCAST))
+        await asyncio.sleep(0.01)
+        assert scheduler.stats()["queued"] == 1
+
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        await scheduler.process_request(send, ("kept",), {}, "sendMessage", {"chat_id": 1}, Priority.BROADCAST)
+
+        assert calls == ["kept"]
+        assert scheduler.stats()["queued"] == 0
+        assert scheduler._room[Priority.BROADCAST]._value == scheduler.max_queued_per_lane
+
+    run_scheduler(test)
+
+
+def test_calls_without_a_chat_are_not_queued():
+    async def test(scheduler):
+        scheduler._paused_until = time.monotonic() + 60
+
+        async def get_updates():
+            return "updates"
+
+        assert await scheduler.process_request(get_updates, (), {}, "getUpdates", {}, None) == "updates"
+
+    run_scheduler(test)
+
+
+def test_stats_are_served_on_status_while_the_scheduler_runs():
+    async def test(scheduler):
+        assert stats_registry.collect()["telegram_outbound"] == scheduler.stats()
+
+    run_scheduler(test)
+    assert "telegram_outbound" not in stats_registry.collect()
+
+
+def test_stats_retry_a_sample_deque_mutated_while_it_is_read():
+    class MutatedOnce:
+        """Raises like a deque appended to mid-iteration, the first time only."""
+        def __init__(self, values):
+            self.values = values
+            self.reads = 0
+
+        def __iter__(self):
+            self.reads += 1
+            if self.reads == 1:
+                raise RuntimeError("deque mutated during iteration")
+            return iter(self.values)
+
+    lane = _LaneStats()
+    lane.latency_ms = MutatedOnce([3.0, 1.0, 2.0])
+
+    assert lane.as_dict(0)["latency_ms"] == {"avg": 2.0, "p95": 3.0, "max": 3.0}
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Tests for the chunked, checkpointed SQLite to PostgreSQL migrator (migrate_to_postgresql.py).
+"""
+
+import datetime
+import sqlite3
+
+import pytest
+
+import config
+
+pytest.importorskip("psycopg2")
+if not config.USE_POSTGRESQL:
+    pytest.skip("migrate_to_postgresql.py needs the PostgreSQL settings (USE_POSTGRESQL=true)", allow_module_level=True)
+
+import migrate_to_postgresql as migrator  # noqa: E402
+
+
+class FakePostgres:
+    """Records the rows COPY'd into PostgreSQL; `fail_on_copy` makes that COPY raise."""
+
+    def __init__(self, fail_on_copy=None):
+        self.copied = []
+        self.copies = 0
+        self.fail_on_copy = fail_on_copy
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params=None):
+        pass
+
+    def copy_expert(self, sql, buffer):
+        self.copies += 1
+        if self.copies == self.fail_on_copy:
+            raise RuntimeError("connection lost")
+        self.copied.extend(line.split("\t") for line in buffer.read().splitlines())
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+@pytest.fixture
+def source():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, join_date TIMESTAMP)")
+    conn.executemany("INSERT INTO users VALUES (?, ?, ?, '2025-01-01 00:00:00')",
+                     [(i, f"user{i}", "Name\twith tab" if i == 3 else None) for i in range(1, 8)])
+    return conn
+
+
+def test_copy_buffer_escapes_nulls_and_control_characters():
+    buffer = migrator._copy_buffer([(1, None, "a\tb\nc\\d")])
+
+    assert buffer.read() == "1\t\\N\ta\\tb\\nc\\\\d\n"
+
+
+def test_merge_overwrites_rows_already_in_postgresql():
+    users = migrator.TABLES[0]
+
+    assert migrator._merge_sql(users, "_migrate_users") == (
+        "INSERT INTO users (user_id, username, first_name, join_date) "
+        "SELECT user_id, username, first_name, join_date FROM _migrate_users "
+        "ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username, first_name = EXCLUDED.first_name, "
+        "join_date = EXCLUDED.join_date"
+    )
+
+
+def test_interrupted_table_copy_resumes_from_the_checkpoint(source, tmp_path):
+    users = migrator.TABLES[0]
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+    checkpoint = migrator.load_checkpoint(checkpoint_path)
+
+    with pytest.raises(RuntimeError):
+        migrator.migrate_table(source, FakePostgres(fail_on_copy=2), users, 3, checkpoint, checkpoint_path)
+    saved = migrator.load_checkpoint(checkpoint_path)
+    assert saved["tables"]["users"] == {"last_key": 3, "rows": 3, "done": False}
+
+    postgres = FakePostgres()
+    assert migrator.migrate_table(source, postgres, users, 3, saved, checkpoint_path) == 7
+    assert [row[0] for row in postgres.copied] == ["4", "5", "6", "7"]
+    assert migrator.load_checkpoint(checkpoint_path)["tables"]["users"]["done"]
+
+
+def test_checksums_match_across_backends_whatever_the_timestamp_type():
+    users = migrator.TABLES[0]
+    sqlite_rows = [(1, "alice", None, "2025-01-01 10:00:00")]
+    postgres_rows = [(1, "alice", None, datetime.datetime(2025, 1, 1, 10, 0))]
+
+    assert migrator._checksum(sqlite_rows, users, 100) == migrator._checksum(postgres_rows, users, 100)
+    assert migrator._checksum([(1, "bob", None, None)], users, 100)[1] != migrator._checksum(sqlite_rows, users, 100)[1]
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Tests for the cached Outline clients (outline_utils.py) and the awaitable key calls (outline_async.py).
+"""
+
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("outline_vpn")
+
+import outline_async  # noqa: E402
+import outline_utils  # noqa: E402
+
+
+class FakeSession:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeOutlineVPN:
+    def __init__(self, api_url, cert_sha256=None):
+        self.api_url = api_url
+        self.session = FakeSession()
+        self.keys = {}
+
+    def create_key(self, name=None):
+        key = SimpleNamespace(key_id=str(len(self.keys) + 1), access_url=f"ss://{self.api_url}", name=name)
+        self.keys[key.key_id] = key
+        return key
+
+    def rename_key(self, key_id, name):
+        self.keys[key_id].name = name
+        return True
+
+
+@pytest.fixture
+def servers(monkeypatch):
+    servers = {"germany": {"api_url": "https://de.example:1/a", "cert_sha256": "aa"},
+               "netherlands": {"api_url": "https://nl.example:1/b", "cert_sha256": ""}}
+    monkeypatch.setattr(outline_utils, "OUTLINE_SERVERS", servers)
+    monkeypatch.setattr(outline_utils, "OutlineVPN", FakeOutlineVPN)
+    monkeypatch.setattr(outline_utils, "_clients", {})
+    return servers
+
+
+def test_client_is_reused_until_its_server_settings_change(servers):
+    first = outline_utils.get_outline_client("germany")
+    assert outline_utils.get_outline_client("germany") is first
+    assert outline_utils.get_outline_client("netherlands") is not first
+
+    servers["germany"]["api_url"] = "https://de2.example:1/a"
+    rebuilt = outline_utils.get_outline_client("germany")
+
+    assert rebuilt is not first
+    assert rebuilt.api_url == "https://de2.example:1/a"
+    assert first.session.closed
+
+
+def test_invalidate_drops_and_closes_cached_clients(servers):
+    germany = outline_utils.get_outline_client("germany")
+    netherlands = outline_utils.get_outline_client("netherlands")
+
+    outline_utils.invalidate_outline_clients("germany")
+    assert germany.session.closed and not netherlands.session.closed
+    assert outline_utils.get_cached_client_count() == 1
+
+    outline_utils.invalidate_outline_clients()
+    assert netherlands.session.closed
+    assert outline_utils.get_cached_client_count() == 0
+
+
+def test_calls_are_capped_per_server_and_counted(servers, monkeypatch):
+    monkeypatch.setattr(outline_async, "OUTLINE_MAX_CONCURRENCY_PER_SERVER", 2)
+    monkeypatch.setattr(outline_async, "_server_slots", {})
+    monkeypatch.setattr(outline_async, "_server_stats", {})
+    lock = threading.Lock()
+    in_flight = {}
+    peak = {}
+
+    def call(client, key_id):
+        with lock:
+            in_flight[client.api_url] = in_flight.get(client.api_url, 0) + 1
+            peak[client.api_url] = max(peak.get(client.api_url, 0), in_flight[client.api_url])
+        time.sleep(0.02)
+        with lock:
+            in_flight[client.api_url] -= 1
+        return key_id
+
+    async def run():
+        return await asyncio.gather(*(outline_async.run_outline(country, call, key_id)
+                                      for country in ("germany", "netherlands") for key_id in range(5)))
+
+    assert asyncio.run(run()) == list(range(5)) * 2
+    assert sorted(peak.values()) == [2, 2]
+    stats = outline_async.get_outline_call_stats()["servers"]["germany"]
+    assert (stats["calls"], stats["errors"], stats["in_flight"]) == (5, 0, 0)
+
+
+def test_unknown_country_fails_and_counts_an_error(servers, monkeypatch):
+    monkeypatch.setattr(outline_async, "_server_slots", {})
+    monkeypatch.setattr(outline_async, "_server_stats", {})
+
+    with pytest.raises(ValueError):
+        asyncio.run(outline_async.delete_outline_key("atlantis", "1"))
+    assert outline_async.get_outline_call_stats()["servers"]["atlantis"]["errors"] == 1
+
+
+def test_key_is_named_on_create_or_renamed_by_servers_that_ignore_the_name(servers):
+    client = outline_utils.get_outline_client("germany")
+    key_id, access_url = outline_utils.create_outline_key(client, name="alice_germany_7")
+    assert client.keys[key_id].name == "alice_germany_7"
+
+    client.create_key = lambda name=None: FakeOutlineVPN.create_key(client)  # an older server
+    key_id, _ = outline_utils.create_outline_key(client, name="alice_germany_8")
+    assert client.keys[key_id].name == "alice_germany_8"
+
+
+def test_create_outline_keys_retries_failed_countries_then_reports_them(servers, monkeypatch):
+    monkeypatch.setattr(outline_async, "_server_slots", {})
+    monkeypatch.setattr(outline_async, "_server_stats", {})
+    calls = []
+
+    async def create_outline_key(country_code, key_name_prefix="user", name=None):
+        calls.append((country_code, name))
+        if country_code == "atlantis" or (country_code == "netherlands" and len(calls) <= 3):
+            raise RuntimeError("server unreachable")
+        return f"{country_code}-id", f"ss://{country_code}"
+
+    monkeypatch.setattr(outline_async, "create_outline_key", create_outline_key)
+    keys, failed = asyncio.run(outline_async.create_outline_keys(
+        ["germany", "netherlands", "atlantis", "germany"], lambda country: f"alice_{country}_7", attempts=2
+    ))
+
+    assert [(key.country_code, key.outline_key_id) for key in keys] == [("germany", "germany-id"),
+                                                                        ("netherlands", "netherlands-id")]
+    assert failed == ["atlantis"]
+    assert sorted(calls) == [("atlantis", "alice_atlantis_7")] * 2 + [("germany", "alice_germany_7")] + \
+        [("netherlands", "alice_netherlands_7")] * 2
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Tests for provisioning a subscription's keys and activation in one transaction.
+"""
+
+import datetime
+
+import pytest
+
+
+def pending_subscription(db, user_id=1):
+    db.add_user_if_not_exists(user_id, f"user{user_id}", "Test")
+    return db.create_subscription_record(user_id, "1_month", 30)
+
+
+def subscription_row(db, subscription_id):
+    with db.get_sqlite_connection() as conn:
+        return conn.execute("SELECT status, country_package_id, end_date FROM subscriptions WHERE id = ?",
+                            (subscription_id,)).fetchone()
+
+
+def test_provision_stores_the_package_and_every_key_and_activates(db):
+    subscription_id = pending_subscription(db)
+    assert db.get_active_subscriptions(1) == []  # cached until the provision invalidates it
+
+    end_date = db.provision_subscription(
+        subscription_id, 1, "europe", [("germany", "1", "ss://1"), ("france", "2", "ss://2")], 30)
+
+    status, package, stored_end_date = subscription_row(db, subscription_id)
+    assert (status, package) == ("active", "europe")
+    assert stored_end_date == str(end_date)
+    assert end_date - datetime.datetime.utcnow() > datetime.timedelta(days=29)
+    assert sorted(row[0] for row in db.get_subscription_countries(subscription_id)) == ["france", "germany"]
+    assert [row[0] for row in db.get_active_subscriptions(1)] == [subscription_id]
+
+
+def test_failed_provision_leaves_the_subscription_untouched(db):
+    subscription_id = pending_subscription(db)
+
+    with pytest.raises(Exception):
+        # The second key cannot be bound, so the INSERT fails after the UPDATE ran
+        db.provision_subscription(subscription_id, 1, "europe", [("germany", "1", "ss://1"), ("france", {}, None)], 30)
+
+    assert subscription_row(db, subscription_id) == ("pending_payment", None, None)
+    assert db.get_subscription_countries(subscription_id) == []
+
+
+def test_provision_needs_at_least_one_key(db):
+    subscription_id = pending_subscription(db)
+
+    with pytest.raises(ValueError):
+        db.provision_subscription(subscription_id, 1, "europe", [], 30)
+
+
+def test_provision_of_an_unknown_subscription_fails_without_storing_keys(db):
+    subscription_id = pending_subscription(db)
+
+    with pytest.raises(ValueError, match="not found"):
+        db.provision_subscription(subscription_id + 1, 1, "europe", [("germany", "1", "ss://1")], 30)
+
+    with db.get_sqlite_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM subscription_countries").fetchone()[0] == 0
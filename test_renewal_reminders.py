@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Tests for the renewal reminder stages stored in the database (claim_renewal_reminders).
+"""
+
+import asyncio
+import datetime
+from unittest.mock import AsyncMock, Mock
+
+
+def active_subscription(db, user_id, ends_in):
+    db.add_user_if_not_exists(user_id, f"user{user_id}", "Test")
+    subscription_id = db.create_subscription_record(user_id, "1_month", 30)
+    db.provision_subscription(subscription_id, user_id, "pkg", [("germany", "1", "ss://1")], 30)
+    with db.get_sqlite_connection() as conn:
+        conn.execute("UPDATE subscriptions SET end_date = ? WHERE id = ?",
+                     (datetime.datetime.utcnow() + ends_in, subscription_id))
+    return subscription_id
+
+
+def claimed_ids(db, stage, hours):
+    now = datetime.datetime.utcnow()
+    return [reminder.id for reminder in db.claim_renewal_reminders(stage, now, datetime.timedelta(hours=hours), 10)]
+
+
+def test_each_stage_is_claimed_once(db):
+    soon = active_subscription(db, 1, datetime.timedelta(hours=2))
+    later = active_subscription(db, 2, datetime.timedelta(days=10))
+
+    assert claimed_ids(db, 1, 72) == [soon]
+    assert claimed_ids(db, 1, 72) == []
+    assert claimed_ids(db, 2, 24) == [soon]  # a more urgent stage is still due
+    assert claimed_ids(db, 1, 24 * 30) == [later]
+
+
+def test_renewal_resets_the_reminder_stage(db):
+    subscription_id = active_subscription(db, 1, datetime.timedelta(hours=2))
+    assert claimed_ids(db, 1, 72) == [subscription_id]
+
+    db.activate_subscription(subscription_id, 1, 2)
+
+    assert claimed_ids(db, 1, 72) == [subscription_id]
+
+
+def test_scheduler_sends_only_the_most_urgent_due_stage(db, monkeypatch):
+    # scheduler_tasks needs python-telegram-bot
+    import scheduler_tasks
+
+    monkeypatch.setattr(scheduler_tasks, "RENEWAL_REMINDER_STAGES_HOURS", (72, 24, 1))
+    bot = Mock()
+    bot.send_message = AsyncMock()
+    active_subscription(db, 1, datetime.timedelta(hours=2))
+
+    async def sweep():
+        return await scheduler_tasks.send_renewal_reminders(bot, datetime.datetime.utcnow(), asyncio.Semaphore(5))
+
+    assert asyncio.run(sweep()) == 1
+    assert asyncio.run(sweep()) == 0
+
+    bot.send_message.assert_awaited_once()
+    with db.get_sqlite_connection() as conn:
+        assert conn.execute("SELECT reminder_stage FROM subscriptions").fetchone()[0] == 2
+
+
+def test_release_hands_a_reminder_back_unless_it_was_renewed(db):
+    now = datetime.datetime.utcnow()
+    failed = active_subscription(db, 1, datetime.timedelta(hours=2))
+    renewed = active_subscription(db, 2, datetime.timedelta(hours=2))
+    reminders = db.claim_renewal_reminders(1, now, datetime.timedelta(hours=72), 10)
+    assert [(reminder.stage, reminder.previous_stage) for reminder in reminders] == [(1, 0), (1, 0)]
+
+    db.activate_subscription(renewed, 2, 30)
+    for reminder in reminders:
+        db.release_renewal_reminder(reminder)
+
+    assert claimed_ids(db, 1, 72) == [failed]
+
+
+def test_scheduler_retries_a_reminder_whose_send_failed(db, monkeypatch):
+    # scheduler_tasks needs python-telegram-bot
+    import scheduler_tasks
+
+    monkeypatch.setattr(scheduler_tasks, "RENEWAL_REMINDER_STAGES_HOURS", (72,))
+    bot = Mock()
+    bot.send_message = AsyncMock(side_effect=[RuntimeError("timed out"), None])
+    active_subscription(db, 1, datetime.timedelta(hours=2))
+
+    async def sweep():
+        return await scheduler_tasks.send_renewal_reminders(bot, datetime.datetime.utcnow(), asyncio.Semaphore(5))
+
+    asyncio.run(sweep())
+    asyncio.run(sweep())
+    asyncio.run(sweep())
+
+    assert bot.send_message.await_count == 2
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Tests for routing reads to the PostgreSQL read replica (database_postgresql.routed).
+"""
+
+import contextvars
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import pytest
+
+import config
+
+pytest.importorskip("psycopg2")
+if not config.USE_POSTGRESQL:
+    pytest.skip("database_postgresql.py needs the PostgreSQL settings (USE_POSTGRESQL=true)", allow_module_level=True)
+
+import psycopg2  # noqa: E402
+
+import database_postgresql as pg  # noqa: E402
+
+
+@pytest.fixture
+def replica(monkeypatch):
+    """A configured replica whose last lag probe has just run; returns the routing counters."""
+    monkeypatch.setattr(pg, "POSTGRES_REPLICA_URL", "postgresql://replica")
+    monkeypatch.setattr(pg, "DB_REPLICA_LAG_CHECK_INTERVAL", 3600)
+    monkeypatch.setattr(pg, "DB_REPLICA_MAX_LAG_SECONDS", 5)
+    for key, value in {"checked_at": time.monotonic(), "replay_lsn": 100, "caught_up": False, "lag_seconds": 1.0,
+                       "down_until": 0.0, "last_error": None}.items():
+        monkeypatch.setitem(pg._replica_state, key, value)
+    for key in pg._routing_stats:
+        monkeypatch.setitem(pg._routing_stats, key, 0)
+    monkeypatch.setattr(pg, "_session_lsns", OrderedDict())
+    monkeypatch.setattr(pg, "_process_lsn", 0)
+    monkeypatch.setattr(pg, "_forgotten_lsn", 0)
+    return pg._routing_stats
+
+
+def where_it_ran(route):
+    @pg.routed(route)
+    def query():
+        return "replica" if getattr(pg._route_local, "replica", False) else "primary"
+    return query
+
+
+def test_read_only_queries_use_a_replica_within_the_lag_bound(replica):
+    assert where_it_ran(pg.READ_ONLY)() == "replica"
+    assert where_it_ran(pg.PRIMARY)() == "primary"
+    assert replica["replica"] == 1
+
+
+def test_a_lagging_replica_is_skipped(replica, monkeypatch):
+    monkeypatch.setitem(pg._replica_state, "lag_seconds", 30.0)
+
+    assert where_it_ran(pg.READ_ONLY)() == "primary"
+    assert replica["fallback_lag"] == 1
+
+
+def test_replica_errors_retry_on_the_primary_and_pause_the_replica(replica):
+    @pg.routed(pg.READ_ONLY)
+    def query():
+        if getattr(pg._route_local, "replica", False):
+            raise psycopg2.OperationalError("replica went away")
+        return "primary"
+
+    assert query() == "primary"
+    assert where_it_ran(pg.READ_ONLY)() == "primary"  # still paused
+    assert replica["fallback_error"] == 1
+    assert pg._replica_state["down_until"] > time.monotonic()
+
+
+def test_replica_is_unused_without_a_replica_url(replica, monkeypatch):
+    monkeypatch.setattr(pg, "POSTGRES_REPLICA_URL", None)
+
+    assert where_it_ran(pg.READ_ONLY)() == "primary"
+
+
+def in_session(key, func):
+    """Run `func` in a fresh context whose queries belong to session `key`."""
+    def run():
+        pg.set_session(key)
+        return func()
+    return contextvars.copy_context().run(run)
+
+
+def test_read_your_writes_waits_for_the_session_s_own_last_commit(replica):
+    in_session(1, lambda: pg._record_commit_lsn(150))  # user 1 wrote past what the replica replayed
+    in_session(2, lambda: pg._record_commit_lsn(90))
+
+    assert in_session(1, where_it_ran(pg.READ_YOUR_WRITES)) == "primary"
+    assert in_session(2, where_it_ran(pg.READ_YOUR_WRITES)) == "replica"
+    assert in_session(3, where_it_ran(pg.READ_YOUR_WRITES)) == "replica"  # no writes of its own
+    assert where_it_ran(pg.READ_YOUR_WRITES)() == "primary"  # outside a session: every commit counts
+
+
+def test_nested_routed_calls_keep_the_outer_route(replica):
+    @pg.routed(pg.READ_ONLY)
+    def outer():
+        where_it_ran(pg.PRIMARY)()
+        return "replica" if pg._route_local.replica else "primary"
+
+    assert outer() == "replica"
+    assert pg._route_local.replica is False
+
+
+class FakePool:
+    """A primary pool whose connections record every statement and report WAL position 200."""
+
+    def __init__(self):
+        self.statements = []
+
+    @contextmanager
+    def connection(self):
+        yield self
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params=None):
+        self.statements.append(" ".join(sql.split()))
+
+    def fetchone(self):
+        return (200,)
+
+    def commit(self):
+        pass
+
+
+def test_only_writes_record_their_commit_position(replica, monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(pg, "get_pool", lambda: pool)
+
+    with pg.get_connection() as conn:
+        conn.cursor().execute("SELECT 1")
+    assert pool.statements == ["SELECT 1"]
+    assert pg._process_lsn == 0
+
+    with pg.get_connection(write=True) as conn:
+        conn.cursor().execute("UPDATE subscriptions SET status = 'expired'")
+    assert pool.statements[-1] == "SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), '0/0')"
+    assert pg._process_lsn == 200
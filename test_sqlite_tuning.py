@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Tests for the SQLite connection profile, the hot-query indexes and the maintenance job.
+"""
+
+
+def query_plan(db, sql, params=()):
+    with db.get_sqlite_connection() as conn:
+        return " ".join(row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+
+
+def test_pooled_connections_get_the_performance_profile(db):
+    with db.get_sqlite_connection() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+        assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == db.SQLITE_BUSY_TIMEOUT_MS
+        assert conn.execute("PRAGMA temp_store").fetchone()[0] == 2  # MEMORY
+
+
+def test_hot_queries_use_their_indexes(db):
+    plan = query_plan(db, "SELECT id FROM subscriptions WHERE user_id = ? AND status = 'active'", (1,))
+    assert "idx_subscriptions_user_status_end" in plan
+
+    plan = query_plan(db, "SELECT id FROM subscriptions WHERE status = 'active' AND end_date < ?", ("2024-01-01",))
+    assert "idx_subscriptions_status_end" in plan
+
+    plan = query_plan(db, "SELECT country_code FROM subscription_countries WHERE subscription_id = ?", (1,))
+    assert "idx_subscription_countries_subscription_id" in plan
+
+
+def test_maintenance_analyzes_once_then_optimizes(db):
+    def has_statistics():
+        with db.get_sqlite_connection() as conn:
+            return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone() is not None
+
+    assert not has_statistics()
+    db.run_db_maintenance()
+    assert has_statistics()
+    db.run_db_maintenance()  # PRAGMA optimize and a checkpoint on later runs
+    assert has_statistics()
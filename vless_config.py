@@ -43,6 +43,9 @@ ADMIN_USER_ID = os.getenv('ADMIN_USER_ID')
 
 # Database Configuration
 DB_PATH = "vless_subscriptions.db"
+# Cache in front of get_user_subscription (seconds of staleness allowed for writes from other processes)
+VLESS_CACHE_TTL_SECONDS = float(os.getenv("VLESS_CACHE_TTL_SECONDS", "60"))
+VLESS_CACHE_MAX_ENTRIES = int(os.getenv("VLESS_CACHE_MAX_ENTRIES", "10000"))
 
 # Payment Configuration (optional)
 CRYPTOBOT_TESTNET_API_TOKEN = os.getenv('CRYPTOBOT_TESTNET_API_TOKEN', 'dummy_testnet_token')
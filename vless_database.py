@@ -5,40 +5,35 @@ Database functions for VLESS-only Telegram Bot
 
 import sqlite3
 import datetime
-from vless_config import DB_PATH
+import threading
+from vless_config import DB_PATH, VLESS_CACHE_TTL_SECONDS, VLESS_CACHE_MAX_ENTRIES
+from db_cache import TTLCache
+from db_metrics import timed_query
+from db_migrations import apply_migrations
+
+# user_id -> get_user_subscription(user_id), invalidated by add/remove below
+vless_subscription_cache = TTLCache("vless_subscription", VLESS_CACHE_TTL_SECONDS, VLESS_CACHE_MAX_ENTRIES)
+
+_schema_lock = threading.Lock()
+_schema_ready = False
 
 def init_vless_db():
-    """Initialize VLESS subscriptions table."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS vless_subscriptions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            vless_uuid TEXT,
-            vless_uri TEXT,
-            start_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            end_date TIMESTAMP,
-            expiry_date TIMESTAMP,
-            status TEXT DEFAULT 'active',
-            FOREIGN KEY(user_id) REFERENCES users(user_id)
-        )
-    ''')
-    
-    # Users table (if not exists)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    """Initialize VLESS subscriptions table (versioned migrations; only the first call per process does any work)."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        conn = sqlite3.connect(DB_PATH)
+        try:
+            apply_migrations(conn, "vless", "sqlite")
+        finally:
+            conn.close()
+        _schema_ready = True
     print("VLESS database initialized successfully")
 
+@timed_query(backend="vless")
 def add_vless_subscription(user_id, vless_uuid, vless_uri, expiry_date):
     """Add a new VLESS subscription."""
     conn = sqlite3.connect(DB_PATH)
@@ -58,10 +53,15 @@ def add_vless_subscription(user_id, vless_uuid, vless_uri, expiry_date):
     
     conn.commit()
     conn.close()
+    vless_subscription_cache.invalidate(user_id)
     print(f"VLESS subscription added for user {user_id}")
 
 def get_user_subscription(user_id):
-    """Get the most recent active subscription for a user."""
+    """Get the most recent active subscription for a user (served from vless_subscription_cache)."""
+    return vless_subscription_cache.get_or_load(user_id, lambda: _load_user_subscription(user_id))
+
+@timed_query("get_user_subscription", backend="vless")
+def _load_user_subscription(user_id):
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
@@ -85,6 +85,7 @@ def get_user_subscription(user_id):
         }
     return None
 
+@timed_query(backend="vless")
 def remove_vless_subscription(user_id):
     """Remove all subscriptions for a user."""
     conn = sqlite3.connect(DB_PATH)
@@ -98,8 +99,10 @@ def remove_vless_subscription(user_id):
     
     conn.commit()
     conn.close()
+    vless_subscription_cache.invalidate(user_id)
     print(f"VLESS subscriptions removed for user {user_id}")
 
+@timed_query(backend="vless")
 def get_vless_subscriptions(user_id):
     """Get all VLESS subscriptions for a user."""
     conn = sqlite3.connect(DB_PATH)